@@ -0,0 +1,90 @@
+import sys
+import os
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+import trimesh
+from tqdm import tqdm
+
+from lib.mesh_io import load_obj_mesh
+from lib.data.occupancy_volume import bake_occupancy_volume, occupancy_volume_path, OccupancyVolume
+
+
+
+# Modify the variables below as needed.
+mesh_directory = "rendering_script/THuman2.0_Release"
+subject_list_files = ["train_set_list.txt"] # subjects whose meshes are baked
+volume_resolution = 256 # grid points along the longest side of the bounding box of each mesh
+num_bake_workers = None # processes baking the subjects in parallel, None for one per cpu
+overwrite = False
+
+# accuracy check of the baked labels against mesh.contains on subjects of the test set (not used for training)
+check_subject_list_file = "test_set_list.txt"
+num_subjects_to_check = 5
+num_points_to_check = 10000
+sigma_to_check = 3.5 # noise of the near-surface points, as opt.sigma_low_resolution_pifu
+
+
+
+
+def bake_subject(subject):
+    mesh_path = os.path.join(mesh_directory, subject, '%s.obj' % subject)
+    volume_path = occupancy_volume_path(mesh_path)
+    if overwrite or not os.path.exists(volume_path) or os.path.getmtime(volume_path) < os.path.getmtime(mesh_path):
+        vertices, faces = load_obj_mesh(mesh_path)
+        OccupancyVolume(**bake_occupancy_volume(vertices, faces, resolution=volume_resolution)).save(volume_path)
+    return subject
+
+
+def check_subject(subject):
+    '''
+    Agreement of the baked volume with mesh.contains on points drawn as the spatial sampling of TrainDataset, the
+    largest distance to the surface of the points they disagree on, and the time of both inside tests.
+    '''
+    mesh_path = os.path.join(mesh_directory, subject, '%s.obj' % subject)
+    vertices, faces = load_obj_mesh(mesh_path)
+    start = time.perf_counter()
+    volume = OccupancyVolume(**bake_occupancy_volume(vertices, faces, resolution=volume_resolution))
+    bake_time = time.perf_counter() - start
+
+    mesh = trimesh.Trimesh(vertices, faces, process=False)
+    sigma_multiplier = (np.abs(mesh.vertices[:, 1].max()) + np.abs(mesh.vertices[:, 1].min())) / 188
+    surface_points, _ = trimesh.sample.sample_surface(mesh, num_points_to_check)
+    length = mesh.bounds[1] - mesh.bounds[0]
+    points = np.concatenate([surface_points + np.random.normal(scale=sigma_to_check * sigma_multiplier, size=surface_points.shape),
+                             np.random.rand(num_points_to_check // 16, 3) * length * 1.2 + mesh.bounds[0] - length * 0.1], 0)
+
+    start = time.perf_counter()
+    inside_mesh = mesh.contains(points)
+    contains_time = time.perf_counter() - start
+    start = time.perf_counter()
+    inside_volume = volume.contains(points)
+    volume_time = time.perf_counter() - start
+
+    disagree = points[inside_mesh != inside_volume]
+    max_distance = np.abs(trimesh.proximity.signed_distance(mesh, disagree)).max() / volume.voxel_size if len(disagree) else 0.0
+    print('  {0}: agreement {1:.4%} | disagreeing points up to {2:.3f} voxels from the surface | watertight: {3} | '
+          'bake: {4:5.1f}s | mesh.contains: {5:7.3f}s | volume: {6:7.4f}s'.format(
+          subject, (inside_mesh == inside_volume).mean(), max_distance, mesh.is_watertight, bake_time, contains_time, volume_time))
+
+
+
+
+if __name__ == '__main__':
+
+    subjects = sorted(set(sum([np.atleast_1d(np.loadtxt(f, dtype=str)).tolist() for f in subject_list_files], [])))
+    print('Baking the occupancy volumes of {0} subjects'.format(len(subjects)))
+    if num_bake_workers is None:
+        num_bake_workers = multiprocessing.cpu_count()
+    with multiprocessing.get_context('fork').Pool(num_bake_workers) as pool:
+        for _ in tqdm(pool.imap_unordered(bake_subject, subjects), total=len(subjects)):
+            pass
+
+    if num_subjects_to_check:
+        print('Accuracy against mesh.contains:')
+        np.random.seed(0)
+        for subject in np.atleast_1d(np.loadtxt(check_subject_list_file, dtype=str)).tolist()[:num_subjects_to_check]:
+            check_subject(subject)
@@ -0,0 +1,854 @@
+import sys
+import os
+import time
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from lib.sdf import create_grid_coords, create_grid_matrix, eval_grid, eval_grid_octree, eval_grid_tensor, fill_homogeneous_cells, BatchedQuery
+from lib.octree import eval_grid_octree_sparse, eval_grid_narrow_band
+from lib.mesh_util import evaluate_grid, extract_surface, refine_surface, create_depth_interval, marching_cubes_parallel, lift_level, stream_surface_slabs, surface_from_slabs
+from lib.mesh_util import save_obj_mesh, save_obj_mesh_with_color, save_obj_mesh_with_uv, save_mesh
+from lib.mesh_io import CACHE_SUFFIX, load_obj_mesh, open_mesh_store
+from skimage import measure
+
+
+# Modify the variables below as needed.
+resolutions_to_benchmark = [256, 512, 1024]
+max_dense_resolution = 512 # the dense octree needs roughly 10 bytes per voxel (sdf + masks) plus temporaries, so 1024 is skipped by default
+num_samples_to_use = 50000
+measure_peak_memory = True # tracing slows down python-heavy code a lot, so memory is measured in a separate run
+
+
+
+
+def synthetic_eval_func(points):
+    '''
+    Stand-in for the network: soft occupancy of a torso, a head and two limbs.
+    :param points: [3, N] points in the [-1, 1] bounding box
+    :return: [N] occupancy in [0, 1]
+    '''
+    def capsule(a, b, r):
+        a = np.array(a).reshape(3, 1)
+        b = np.array(b).reshape(3, 1)
+        ab = b - a
+        t = np.clip(((points - a) * ab).sum(0) / (ab * ab).sum(), 0, 1)
+        return np.sqrt(((points - a - t * ab) ** 2).sum(0)) - r
+
+    d = capsule([0, -0.3, 0], [0, 0.3, 0], 0.25)
+    d = np.minimum(d, capsule([0, 0.55, 0], [0, 0.6, 0], 0.15))
+    d = np.minimum(d, capsule([-0.15, -0.3, 0], [-0.2, -0.9, 0.05], 0.08))
+    d = np.minimum(d, capsule([0.3, 0.2, 0], [0.8, 0.25, -0.1], 0.06))
+    return 1.0 / (1.0 + np.exp(np.clip(d * 60.0, -50, 50)))
+
+
+class CountingEvalFunc():
+    def __init__(self, eval_func):
+        self.eval_func = eval_func
+        self.num_queries = 0
+
+    def __call__(self, points):
+        self.num_queries += points.shape[1]
+        return self.eval_func(points)
+
+
+def run_benchmark(name, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+
+    peak = float('nan')
+    if measure_peak_memory:
+        del result
+        tracemalloc.start()
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    print('{0:<28} time: {1:8.2f}s | peak memory: {2:9.1f} MB'.format(name, elapsed, peak / 2 ** 20))
+    return result
+
+
+def benchmark_octree(resolution):
+    print('resolution: {0}'.format(resolution))
+    b_min = np.array([-1, -1, -1])
+    b_max = np.array([1, 1, 1])
+
+    if resolution <= max_dense_resolution:
+        def dense():
+            eval_func.num_queries = 0
+            coords = create_grid_coords(resolution, resolution, resolution, b_min=b_min, b_max=b_max)
+            return eval_grid_octree(coords, eval_func, num_samples=num_samples_to_use)
+        eval_func = CountingEvalFunc(synthetic_eval_func)
+        run_benchmark('eval_grid_octree', dense)
+        print('{0:<28} queries: {1}'.format('', eval_func.num_queries))
+    else:
+        print('{0:<28} skipped (resolution > max_dense_resolution)'.format('eval_grid_octree'))
+
+    def sparse():
+        eval_func.num_queries = 0
+        mat = create_grid_matrix(resolution, resolution, resolution, b_min=b_min, b_max=b_max)
+        return eval_grid_octree_sparse(resolution, mat, eval_func, num_samples=num_samples_to_use)
+    eval_func = CountingEvalFunc(synthetic_eval_func)
+    grid = run_benchmark('eval_grid_octree_sparse', sparse)
+    print('{0:<28} queries: {1} | stored: {2:.1f} MB'.format('', eval_func.num_queries, grid.nbytes / 2 ** 20))
+
+
+
+def fill_homogeneous_cells_loop(sdf, notprocessed, skip_grid, v, reso):
+    # per-cell loop that eval_grid_octree used before fill_homogeneous_cells, kept as the reference
+    xs, ys, zs = np.where(skip_grid)
+    for x, y, z in zip(xs*reso, ys*reso, zs*reso):
+        sdf[x:(x+reso+1), y:(y+reso+1), z:(z+reso+1)] = v[x//reso,y//reso,z//reso]
+        notprocessed[x:(x+reso+1), y:(y+reso+1), z:(z+reso+1)] = False
+
+
+def benchmark_fill(resolution, init_resolution=64, threshold=0.05):
+    '''
+    Per-level wall time of the homogeneous-cell fill of eval_grid_octree, loop versus vectorized.
+    Every level sees the cells found on the lattice of that level, as if nothing had been filled before.
+    '''
+    print('resolution: {0} (fill of homogeneous cells)'.format(resolution))
+    mat = create_grid_matrix(resolution, resolution, resolution)
+    reso = resolution // init_resolution
+    while reso > 1:
+        ticks = np.arange(0, resolution, reso)
+        idx = np.stack(np.meshgrid(ticks, ticks, ticks, indexing='ij'), 0).reshape(3, -1)
+        v = synthetic_eval_func(np.matmul(mat[:3, :3], idx) + mat[:3, 3:4]).reshape(len(ticks), len(ticks), len(ticks))
+        v = np.stack([v[:-1,:-1,:-1], v[:-1,:-1,1:], v[:-1,1:,:-1], v[:-1,1:,1:], v[1:,:-1,:-1], v[1:,:-1,1:], v[1:,1:,:-1], v[1:,1:,1:]], 0)
+        v_min = v.min(0)
+        v_max = v.max(0)
+        v = 0.5*(v_min+v_max)
+        skip_grid = (v_max - v_min) < threshold
+
+        timings = []
+        results = []
+        for fill in [fill_homogeneous_cells_loop, fill_homogeneous_cells]:
+            sdf = np.zeros((resolution, resolution, resolution))
+            notprocessed = np.ones((resolution, resolution, resolution), dtype=bool)
+            start = time.perf_counter()
+            fill(sdf, notprocessed, skip_grid, v, reso)
+            timings.append(time.perf_counter() - start)
+            results.append((sdf, notprocessed))
+        identical = np.array_equal(results[0][0], results[1][0]) and np.array_equal(results[0][1], results[1][1])
+        del results, sdf, notprocessed
+
+        print('  step {0:3d} | cells skipped: {1:9d} | loop: {2:7.3f}s | vectorized: {3:7.3f}s | identical: {4}'.format(
+            reso, int(skip_grid.sum()), timings[0], timings[1], identical))
+        reso //= 2
+
+
+
+def benchmark_narrow_band(resolution, bands=[0, 1, 2]):
+    '''
+    Query count and latency of the narrow-band evaluator against eval_grid and eval_grid_octree on the same subject,
+    with both relative to eval_grid_octree. Run over resolutions to see where the narrow band starts to pay off.
+    '''
+    print('resolution: {0} (queries and latency)'.format(resolution))
+    coords = create_grid_coords(resolution, resolution, resolution)
+    evaluators = [('eval_grid', lambda eval_func: eval_grid(coords, eval_func, num_samples=num_samples_to_use)),
+                  ('eval_grid_octree', lambda eval_func: eval_grid_octree(coords, eval_func, num_samples=num_samples_to_use))]
+    for band in bands:
+        evaluators.append(('eval_grid_narrow_band(band={0})'.format(band), lambda eval_func, band=band: eval_grid_narrow_band(
+            resolution, coords.coords_matrix, eval_func, band=band, num_samples=num_samples_to_use)))
+
+    octree = None
+    for name, evaluate in evaluators:
+        eval_func = CountingEvalFunc(synthetic_eval_func)
+        start = time.perf_counter()
+        evaluate(eval_func)
+        elapsed = time.perf_counter() - start
+        if name == 'eval_grid_octree':
+            octree = (eval_func.num_queries, elapsed)
+        relative = '' if octree is None else ' | vs octree: {0:5.2f}x queries, {1:5.2f}x time'.format(
+            eval_func.num_queries / octree[0], elapsed / octree[1])
+        print('  {0:<32} queries: {1:11d} ({2:6.2%} of the grid) | time: {3:7.2f}s{4}'.format(
+            name, eval_func.num_queries, eval_func.num_queries / resolution ** 3, elapsed, relative))
+
+
+def benchmark_batch(resolution, batch_sizes=[1, 2, 4, 8], use_narrow_band=True, num_samples=10000):
+    '''
+    Grids per second when B grids share one query stream, as reconstruction_batch does.
+    The stand-in network runs the high-resolution MLP of the default options on every [B, 3, N] block for
+    its cost and returns the synthetic occupancy, so all batch sizes refine the same cells.
+    '''
+    import torch
+    from lib.model.MLP import MLP
+
+    print('resolution: {0} (batched query stream)'.format(resolution))
+    mlp = MLP(filter_channels=[272, 512, 256, 128, 1], res_layers=[1, 2], norm='no_norm', last_op=torch.nn.Sigmoid()).eval()
+    for batch_size in batch_sizes:
+        coords = create_grid_coords(resolution, resolution, resolution)
+        num_calls = [0]
+        def query_func(points):
+            num_calls[0] += 1
+            with torch.inference_mode():
+                mlp(torch.zeros(points.shape[0], 272, points.shape[2]))
+            return synthetic_eval_func(points.transpose(1, 0, 2).reshape(3, -1)).reshape(points.shape[0], -1)
+
+        batched_query = BatchedQuery(query_func, batch_size)
+        def run(i):
+            try:
+                evaluate_grid(coords, batched_query.eval_func(i), num_samples=num_samples,
+                              use_octree=not use_narrow_band, use_narrow_band=use_narrow_band)
+            finally:
+                batched_query.finish(i)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(batch_size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        print('  B = {0:2d} | query calls: {1:5d} | time: {2:7.2f}s | grids per second: {3:6.2f}'.format(
+            batch_size, num_calls[0], elapsed, batch_size / elapsed))
+
+
+def canonical_mesh(verts, faces):
+    # vertices in order of the grid edge they lie on and faces as sorted index triples, so meshes can be compared
+    # regardless of order. The edge is found from the one fractional coordinate, so float32 rounding does not matter
+    edge = np.round(verts)
+    axis = np.argmax(np.abs(verts - edge), axis=1)
+    rows = np.arange(len(verts))
+    edge[rows, axis] = np.floor(verts[rows, axis]) + 0.5
+    order = np.lexsort(edge.T[::-1])
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    faces = np.sort(rank[faces], axis=1)
+    return verts[order], faces[np.lexsort(faces.T[::-1])]
+
+
+def benchmark_marching_cubes(resolution, workers=[1, 2, 4, 8], block_size=128):
+    '''
+    Wall time of marching cubes on the whole volume against the block-parallel version, and whether the meshes match.
+    The blocks are lifted off the level (lift_level), so the reference is the whole volume lifted the same way; the
+    default single-volume mesh differs from it around the samples that lie on the level, which are counted.
+    '''
+    print('resolution: {0} (marching cubes)'.format(resolution))
+    coords = create_grid_coords(resolution, resolution, resolution)
+    sdf = eval_grid(coords, synthetic_eval_func, num_samples=num_samples_to_use).astype(np.float32)
+
+    start = time.perf_counter()
+    verts, faces, _, _ = measure.marching_cubes_lewiner(sdf, 0.5)
+    print('  {0:<24} time: {1:7.2f}s | verts: {2} | samples on the level: {3}'.format(
+        'marching_cubes_lewiner', time.perf_counter() - start, len(verts), int(np.count_nonzero(sdf == np.float32(0.5)))))
+    verts, faces, _, _ = measure.marching_cubes_lewiner(lift_level(sdf, 0.5), 0.5)
+    print('  {0:<24} verts: {1}'.format('lifted', len(verts)))
+    verts, faces = canonical_mesh(verts, faces)
+
+    for num_workers in workers:
+        start = time.perf_counter()
+        block_verts, block_faces, _, _ = marching_cubes_parallel(sdf, 0.5, block_size=block_size, num_workers=num_workers)
+        elapsed = time.perf_counter() - start
+        # same triangles, and the same vertices up to float32 rounding of the coordinates
+        block_verts, block_faces = canonical_mesh(block_verts, block_faces)
+        identical = len(block_verts) == len(verts) and np.abs(block_verts - verts).max() < 1e-4 and np.array_equal(block_faces, faces)
+        print('  {0:<24} time: {1:7.2f}s | verts: {2} | identical to lifted: {3}'.format(
+            'workers = {0}'.format(num_workers), elapsed, len(block_verts), identical))
+
+
+def peak_memory(fn, device):
+    '''
+    Run fn and measure the peak memory it adds: allocated device memory on CUDA, resident memory of the process on
+    the CPU (torch tensors are not seen by tracemalloc; the peak is reset through /proc/self/clear_refs, Linux)
+    :return: result of fn, peak in bytes
+    '''
+    import ctypes
+    import torch
+
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        result = fn()
+        torch.cuda.synchronize(device)
+        return result, torch.cuda.max_memory_allocated(device) - base
+
+    def status(key):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    ctypes.CDLL('libc.so.6').malloc_trim(0) # give the memory of the previous run back
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5') # reset the peak resident size to the current one
+    base = status('VmRSS')
+    result = fn()
+    return result, status('VmHWM') - base
+
+
+def benchmark_streaming(resolution, slab_size=32, device='cpu'):
+    '''
+    End-to-end latency of evaluating the dense grid and then meshing it, against the slab pipeline that meshes
+    finished slabs in the background while the next one is evaluated. The peak is measured with peak_memory.
+    '''
+    import torch
+
+    print('resolution: {0} (evaluate then mesh vs pipelined slabs)'.format(resolution))
+    mat = create_grid_matrix(resolution, resolution, resolution)
+    def eval_func_tensor(samples):
+        return torch.from_numpy(synthetic_eval_func(samples.double().cpu().numpy())).to(samples.device)
+
+    times = {}
+    def sequential():
+        start = time.perf_counter()
+        with torch.inference_mode():
+            sdf = eval_grid_tensor((resolution, resolution, resolution), mat, eval_func_tensor, device=device, num_samples=num_samples_to_use)
+        sdf = sdf.cpu().numpy()
+        times['eval'] = time.perf_counter() - start
+        verts, _, _, _ = measure.marching_cubes_lewiner(sdf, 0.5)
+        times['total'] = time.perf_counter() - start
+        return len(verts)
+    num_verts, peak = peak_memory(sequential, device)
+    print('  {0:<24} time: {1:7.2f}s (eval {2:.2f}s + mesh {3:.2f}s) | peak memory: {4:8.1f} MB | verts: {5}'.format(
+        'sequential', times['total'], times['eval'], times['total'] - times['eval'], peak / 2 ** 20, num_verts))
+
+    first_slab_time = [None]
+    def streaming():
+        start = time.perf_counter()
+        def on_slab(verts, faces):
+            if first_slab_time[0] is None:
+                first_slab_time[0] = time.perf_counter() - start
+        verts, _, _, _ = surface_from_slabs(stream_surface_slabs(eval_func_tensor, resolution, mat, device, num_samples=num_samples_to_use,
+                                                                 slab_size=slab_size), mat, on_slab=on_slab)
+        times['total'] = time.perf_counter() - start
+        return len(verts)
+    num_verts, peak = peak_memory(streaming, device)
+    print('  {0:<24} time: {1:7.2f}s (first slab mesh after {2:.2f}s) | peak memory: {3:8.1f} MB | verts: {4}'.format(
+        'streaming', times['total'], first_slab_time[0], peak / 2 ** 20, num_verts))
+
+
+def benchmark_occupancy_dtype(resolution, dtypes=[np.float64, np.float32, np.float16, np.uint8], num_metric_samples=10000):
+    '''
+    Memory of the occupancy volume of eval_grid_octree per storage dtype, and the Chamfer / P2S distance
+    (as in apps/evaluate_model.py) of its mesh to the float64 mesh.
+    '''
+    import trimesh
+    from evaluate_model import quick_get_chamfer_and_surface_dist
+
+    print('resolution: {0} (occupancy storage)'.format(resolution))
+    coords = create_grid_coords(resolution, resolution, resolution)
+    reference = None
+    for dtype in dtypes:
+        sdf = eval_grid_octree(coords, synthetic_eval_func, num_samples=num_samples_to_use, dtype=dtype)
+        verts, faces, _, _ = extract_surface(sdf, coords.coords_matrix)
+        mesh = trimesh.Trimesh(verts, faces)
+        if reference is None:
+            reference = mesh
+        np.random.seed(0)
+        chamfer_distance, point_to_surface_distance = quick_get_chamfer_and_surface_dist(mesh, reference, num_samples=num_metric_samples)
+        print('  {0:<8} volume: {1:8.1f} MB (at 512: {2:7.1f} MB) | chamfer: {3:.3e} | p2s: {4:.3e}'.format(
+            np.dtype(dtype).name, sdf.nbytes / 2 ** 20, 512 ** 3 * np.dtype(dtype).itemsize / 2 ** 20, chamfer_distance, point_to_surface_distance))
+
+
+def render_synthetic_depth(yaw, size=256, num_steps=512):
+    '''
+    Calib of an orthographic view of the synthetic subject rotated by yaw, with its front and back depth maps
+    (normalized as in TrainDataset: depth = 1 - z, 0 for the background).
+    '''
+    calib = np.identity(4)
+    calib[:3, :3] = np.array([[np.cos(yaw), 0, np.sin(yaw)], [0, 1, 0], [-np.sin(yaw), 0, np.cos(yaw)]])
+    u = np.linspace(-1, 1, size)
+    uv = np.stack(np.meshgrid(u, u), 0).reshape(2, -1)
+    front = np.zeros(size * size)
+    back = np.zeros(size * size)
+    found = np.zeros(size * size, dtype=bool)
+    for z in np.linspace(1, -1, num_steps): # from the camera to the back
+        points = np.matmul(calib[:3, :3].T, np.concatenate([uv, np.full((1, size * size), z)], 0))
+        occupied = synthetic_eval_func(points) > 0.5
+        front[occupied & ~found] = 1 - z
+        back[occupied] = 1 - z
+        found |= occupied
+    return calib, front.reshape(size, size), back.reshape(size, size)
+
+
+def benchmark_depth_interval(resolution, yaws=[0, np.pi / 4], margins=[2, 4, 8]):
+    '''
+    Queries of the z-interval mode against eval_grid_octree, and the Chamfer / P2S distance of its mesh to the full one.
+    '''
+    import trimesh
+    from evaluate_model import quick_get_chamfer_and_surface_dist
+
+    print('resolution: {0} (depth-map z-interval)'.format(resolution))
+    b_min = np.array([-1, -1, -1])
+    b_max = np.array([1, 1, 1])
+    coords = create_grid_coords(resolution, resolution, resolution, b_min=b_min, b_max=b_max)
+    for yaw in yaws:
+        calib, front, back = render_synthetic_depth(yaw)
+        eval_func = CountingEvalFunc(synthetic_eval_func)
+        verts, faces, _, _ = extract_surface(eval_grid_octree(coords, eval_func, num_samples=num_samples_to_use), coords.coords_matrix)
+        reference = trimesh.Trimesh(verts, faces)
+        print('  yaw {0:5.2f} | {1:<26} queries: {2:10d}'.format(yaw, 'eval_grid_octree', eval_func.num_queries))
+        for back_depth in [None, back]:
+            for margin in margins:
+                eval_func = CountingEvalFunc(synthetic_eval_func)
+                interval = create_depth_interval(calib, front, back_depth, margin, b_min, b_max, resolution)
+                verts, faces, _, _ = extract_surface(eval_grid_octree(coords, interval.wrap(eval_func), num_samples=num_samples_to_use), coords.coords_matrix)
+                np.random.seed(0)
+                chamfer_distance, point_to_surface_distance = quick_get_chamfer_and_surface_dist(trimesh.Trimesh(verts, faces), reference)
+                name = '{0}, margin {1}'.format('front + back' if back_depth is not None else 'front', margin)
+                print('  yaw {0:5.2f} | {1:<26} queries: {2:10d} | chamfer: {3:.3e} | p2s: {4:.3e}'.format(
+                    yaw, name, eval_func.num_queries, chamfer_distance, point_to_surface_distance))
+
+
+
+
+def benchmark_refinement(resolutions=[128, 256], reference_resolution=512, steps=[1, 2, 4], tolerance=1e-5, num_metric_samples=10000):
+    '''
+    Chamfer / P2S distance to the mesh of a finer grid against the number of queries, for eval_grid_octree meshes with
+    and without the sub-voxel refinement of their vertices. The surface error is the mean distance of the vertices
+    to the 0.5 level of the stand-in network, whose logit is a signed distance.
+    '''
+    import trimesh
+    from evaluate_model import quick_get_chamfer_and_surface_dist
+
+    def surface_error(verts):
+        occupancy = np.clip(synthetic_eval_func(verts.T), 1e-12, 1 - 1e-12)
+        return np.mean(np.abs(np.log(1 / occupancy - 1))) / 60.0
+
+    print('surface refinement (reference: {0})'.format(reference_resolution))
+    coords = create_grid_coords(reference_resolution, reference_resolution, reference_resolution)
+    reference_eval_func = CountingEvalFunc(synthetic_eval_func)
+    verts, faces, _, _ = extract_surface(eval_grid_octree(coords, reference_eval_func, num_samples=num_samples_to_use), coords.coords_matrix)
+    reference = trimesh.Trimesh(verts, faces)
+    print('  {0:4d}            queries: {1:10d} | surface error: {2:.3e}'.format(reference_resolution, reference_eval_func.num_queries, surface_error(verts)))
+
+    for resolution in resolutions:
+        coords = create_grid_coords(resolution, resolution, resolution)
+        eval_func = CountingEvalFunc(synthetic_eval_func)
+        sdf = eval_grid_octree(coords, eval_func, num_samples=num_samples_to_use)
+        verts, faces, _, _ = extract_surface(sdf, coords.coords_matrix)
+        for num_steps in [0] + steps:
+            refined = verts
+            num_queries = 0
+            if num_steps > 0:
+                refined, num_queries = refine_surface(verts, synthetic_eval_func, coords.coords_matrix, sdf, num_steps=num_steps, tolerance=tolerance)
+            np.random.seed(0)
+            chamfer_distance, point_to_surface_distance = quick_get_chamfer_and_surface_dist(trimesh.Trimesh(refined, faces), reference, num_samples=num_metric_samples)
+            print('  {0:4d} + {1} steps | queries: {2:10d} | surface error: {3:.3e} | chamfer: {4:.3e} | p2s: {5:.3e}'.format(
+                resolution, num_steps, eval_func.num_queries + num_queries, surface_error(refined), chamfer_distance, point_to_surface_distance))
+
+
+def benchmark_normals(num_points=50000, image_size=512, repeat=3):
+    '''
+    Cost of the network normals relative to a plain query, per mode of calc_vertex_normals and for calc_normal
+    (forward differences on 4N points), on a randomly initialized network of the default options.
+    The agreement is the median angle and the mean cosine to the autograd normals. The central differences are also
+    taken with a step of one feature pixel, which is too coarse to follow the gradient.
+    '''
+    import torch
+    from lib.options import BaseOptions
+    from lib.model.HGPIFuNetwNML import HGPIFuNetwNML
+
+    opt = BaseOptions().parse([])
+    torch.manual_seed(0)
+    net = HGPIFuNetwNML(opt).eval()
+    with torch.no_grad():
+        net.filter(torch.randn(1, 3, image_size, image_size))
+    calib = torch.eye(4)[None]
+    points = torch.rand(1, 3, num_points) * 2 - 1
+
+    def run_query():
+        net.query(points, calib)
+        return None
+
+    def run_calc_normal():
+        net.calc_normal(points, calib)
+        return net.nmls
+
+    modes = [('query', run_query, torch.inference_mode),
+             ('calc_normal (forward)', run_calc_normal, torch.inference_mode),
+             ('autograd', lambda: net.calc_vertex_normals(points, calib, mode='autograd'), torch.no_grad),
+             ('central', lambda: net.calc_vertex_normals(points, calib, mode='central'), torch.inference_mode),
+             ('central (feature pixel)', lambda: net.calc_vertex_normals(points, calib, mode='central', delta=2.0 / (net.im_feat_list[-1].shape[-1] - 1)),
+              torch.inference_mode)]
+    print('network normals ({0} points)'.format(num_points))
+    reference = None
+    query_time = None
+    for name, fn, context in modes:
+        with context():
+            elapsed = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                normals = fn()
+                elapsed.append(time.perf_counter() - start)
+        elapsed = min(elapsed)
+        query_time = query_time or elapsed
+        agreement = ''
+        if name == 'autograd':
+            reference = normals
+        elif normals is not None and reference is not None:
+            cos = (normals * reference).sum(1).clamp(-1, 1)
+            agreement = '| median angle to autograd: {0:6.2f} deg | mean cosine: {1:.3f}'.format(
+                float(torch.rad2deg(torch.acos(cos)).median()), float(cos.mean()))
+        print('  {0:<23} time: {1:7.3f}s | {2:5.2f}x query {3}'.format(name, elapsed, elapsed / query_time, agreement))
+
+
+def save_obj_mesh_loop(mesh_path, verts, faces=None):
+    # per-line writers that lib/mesh_util.py used before the vectorized ones, kept as the reference
+    file = open(mesh_path, 'w')
+    for v in verts:
+        file.write('v %.4f %.4f %.4f\n' % (v[0], v[1], v[2]))
+    if faces is not None:
+        for f in faces:
+            if f[0] == f[1] or f[1] == f[2] or f[0] == f[2]:
+                continue
+            f_plus = f + 1
+            file.write('f %d %d %d\n' % (f_plus[0], f_plus[2], f_plus[1]))
+    file.close()
+
+
+def save_obj_mesh_with_color_loop(mesh_path, verts, faces, colors):
+    file = open(mesh_path, 'w')
+    for idx, v in enumerate(verts):
+        c = colors[idx]
+        file.write('v %.4f %.4f %.4f %.4f %.4f %.4f\n' % (v[0], v[1], v[2], c[0], c[1], c[2]))
+    for f in faces:
+        f_plus = f + 1
+        file.write('f %d %d %d\n' % (f_plus[0], f_plus[2], f_plus[1]))
+    file.close()
+
+
+def save_obj_mesh_with_uv_loop(mesh_path, verts, faces, uvs):
+    file = open(mesh_path, 'w')
+    for idx, v in enumerate(verts):
+        vt = uvs[idx]
+        file.write('v %.4f %.4f %.4f\n' % (v[0], v[1], v[2]))
+        file.write('vt %.4f %.4f\n' % (vt[0], vt[1]))
+    for f in faces:
+        f_plus = f + 1
+        file.write('f %d/%d %d/%d %d/%d\n' % (f_plus[0], f_plus[0], f_plus[2], f_plus[2], f_plus[1], f_plus[1]))
+    file.close()
+
+
+def synthetic_mesh(num_verts):
+    '''
+    Random mesh with about two faces per vertex (as marching cubes meshes), a few of them degenerate
+    '''
+    np.random.seed(0)
+    verts = (np.random.rand(num_verts, 3) * 2 - 1).astype(np.float32)
+    faces = np.random.randint(0, num_verts, size=(2 * num_verts, 3))
+    faces[::1000, 1] = faces[::1000, 0]
+    colors = np.random.rand(num_verts, 3).astype(np.float32)
+    uvs = np.random.rand(num_verts, 2).astype(np.float32)
+    return verts, faces, colors, uvs
+
+
+def benchmark_obj_writers(num_verts=1000000, path='/tmp/benchmark_mesh'):
+    '''
+    Wall time of the OBJ writers of lib/mesh_util.py against the per-line writers, and whether the files are identical.
+    '''
+    verts, faces, colors, uvs = synthetic_mesh(num_verts)
+    print('OBJ writers ({0} vertices, {1} faces)'.format(num_verts, len(faces)))
+    writers = [('save_obj_mesh', save_obj_mesh_loop, save_obj_mesh, (verts, faces)),
+               ('save_obj_mesh_with_color', save_obj_mesh_with_color_loop, save_obj_mesh_with_color, (verts, faces, colors)),
+               ('save_obj_mesh_with_uv', save_obj_mesh_with_uv_loop, save_obj_mesh_with_uv, (verts, faces, uvs))]
+    for name, loop_writer, writer, args in writers:
+        timings = []
+        for suffix, fn in [('_loop.obj', loop_writer), ('.obj', writer)]:
+            start = time.perf_counter()
+            fn(path + suffix, *args)
+            timings.append(time.perf_counter() - start)
+        with open(path + '_loop.obj', 'rb') as f_loop, open(path + '.obj', 'rb') as f:
+            identical = f_loop.read() == f.read()
+        print('  {0:<26} loop: {1:7.2f}s | vectorized: {2:6.2f}s | speedup: {3:5.1f}x | identical: {4} | {5:.1f} MB'.format(
+            name, timings[0], timings[1], timings[0] / timings[1], identical, os.path.getsize(path + '.obj') / 2 ** 20))
+        os.remove(path + '_loop.obj')
+        os.remove(path + '.obj')
+
+
+def benchmark_mesh_formats(num_verts=1000000, path='/tmp/benchmark_mesh'):
+    '''
+    Size, write time (save_mesh) and trimesh.load time of a colored mesh with normals and of a colored point cloud,
+    per export format.
+    '''
+    import trimesh
+
+    verts, faces, colors, _ = synthetic_mesh(num_verts)
+    normals = verts / np.linalg.norm(verts, axis=1, keepdims=True)
+    print('mesh formats ({0} vertices, {1} faces)'.format(num_verts, len(faces)))
+    for name, mesh_faces, mesh_normals in [('mesh', faces, normals), ('point cloud', None, None)]:
+        for extension in ['.obj', '.ply', '.glb']:
+            if extension == '.obj' and mesh_faces is None:
+                # the ASCII point cloud is the PLY of save_samples_truncted_prob
+                start = time.perf_counter()
+                np.savetxt(path + '.ply', np.concatenate([verts, colors * 255], 1), fmt='%.6f %.6f %.6f %d %d %d', comments='',
+                           header='ply\nformat ascii 1.0\nelement vertex {:d}\nproperty float x\nproperty float y\nproperty float z\n'
+                                  'property uchar red\nproperty uchar green\nproperty uchar blue\nend_header'.format(num_verts))
+                file_name = path + '.ply'
+                extension = '.ply (ASCII)'
+            else:
+                file_name = path + extension
+                start = time.perf_counter()
+                save_mesh(file_name, verts, mesh_faces, colors, mesh_normals)
+            write_time = time.perf_counter() - start
+            start = time.perf_counter()
+            loaded = trimesh.load(file_name, process=False)
+            if isinstance(loaded, trimesh.Scene):
+                loaded = list(loaded.geometry.values())[0]
+            read_time = time.perf_counter() - start
+            print('  {0:<11} {1:<12} size: {2:7.1f} MB | write: {3:6.2f}s | read: {4:6.2f}s | vertices read: {5}'.format(
+                name, extension, os.path.getsize(file_name) / 2 ** 20, write_time, read_time, len(loaded.vertices)))
+            os.remove(file_name)
+
+
+def load_obj_mesh_loop(mesh_file):
+    '''
+    Vertices and faces as the per-line load_obj_mesh of the rendering scripts read them (reference for benchmark_obj_loader)
+    '''
+    vertex_data = []
+    face_data = []
+    with open(mesh_file, 'r') as f:
+        for line in f:
+            values = line.split()
+            if not values or values[0].startswith('#'):
+                continue
+            if values[0] == 'v':
+                vertex_data.append(list(map(float, values[1:4])))
+            elif values[0] == 'f':
+                face_data.append(list(map(lambda x: int(x.split('/')[0]), values[1:4])))
+                if len(values) > 4:
+                    face_data.append(list(map(lambda x: int(x.split('/')[0]), [values[3], values[4], values[1]])))
+    return np.array(vertex_data), np.array(face_data) - 1
+
+
+def benchmark_obj_loader(num_verts=1000000, path='/tmp/benchmark_mesh.obj'):
+    '''
+    Load time of a textured OBJ (v/vt face indices, as the THuman scans) with the per-line loader, trimesh.load,
+    load_obj_mesh on a cold cache and load_obj_mesh from its side-car cache.
+    '''
+    import trimesh
+
+    verts, faces, _, uvs = synthetic_mesh(num_verts)
+    save_obj_mesh_with_uv(path, verts, faces, uvs)
+    print('OBJ loader ({0} vertices, {1} faces, {2:.1f} MB)'.format(num_verts, len(faces), os.path.getsize(path) / 2 ** 20))
+
+    start = time.perf_counter()
+    reference = load_obj_mesh_loop(path)
+    print('  per-line loop:        {0:6.2f}s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    trimesh.load(path, process=False)
+    print('  trimesh.load:         {0:6.2f}s'.format(time.perf_counter() - start))
+    for name in ['load_obj_mesh (cold)', 'load_obj_mesh (cache)']:
+        start = time.perf_counter()
+        loaded = load_obj_mesh(path)
+        print('  {0:<21} {1:6.2f}s | same vertices and faces: {2}'.format(name + ':', time.perf_counter() - start,
+              np.array_equal(loaded[0], reference[0]) and np.array_equal(loaded[1], reference[1])))
+    os.remove(path)
+    os.remove(path + CACHE_SUFFIX)
+
+
+def proportional_set_size():
+    '''
+    Memory of this process in bytes, with the pages it shares with other processes split between them (Linux)
+    '''
+    with open('/proc/self/smaps_rollup', 'r') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+worker_meshes = None
+
+
+def set_worker_meshes(meshes):
+    global worker_meshes
+    worker_meshes = meshes
+
+
+def touch_meshes(_):
+    '''
+    What select_sampling_method reads of every subject: the height of the mesh
+    '''
+    for subject in worker_meshes.keys():
+        vertices = worker_meshes.arrays(subject)[0] if hasattr(worker_meshes, 'arrays') else worker_meshes[subject].vertices
+        np.abs(vertices.max(0)[1]) + np.abs(vertices.min(0)[1])
+    return proportional_set_size()
+
+
+def benchmark_mesh_store(num_subjects=16, num_verts=200000, workers=[1, 2, 4, 8], path='/tmp/benchmark_meshes'):
+    '''
+    Startup time and total memory of the meshes as the pickled dict of premesh.npy and as a MeshStore: the sum of the
+    proportional set sizes of the main process and of workers reading every subject, forked (DataLoader default on
+    Linux) or spawned (the dataset is pickled to every worker).
+    '''
+    import ctypes
+    import multiprocessing
+    import shutil
+    import trimesh
+
+    mesh_paths = {}
+    for i in range(num_subjects):
+        subject = '%04d' % i
+        verts, faces, _, _ = synthetic_mesh(num_verts)
+        os.makedirs(os.path.join(path, subject), exist_ok=True)
+        mesh_paths[subject] = os.path.join(path, subject, subject + '.obj')
+        save_obj_mesh(mesh_paths[subject], verts, faces)
+    print('mesh store ({0} subjects of {1} vertices)'.format(num_subjects, num_verts))
+
+    premesh_path = os.path.join(path, 'premesh.npy')
+    np.save(premesh_path, {subject: trimesh.load(mesh_path) for subject, mesh_path in mesh_paths.items()}, allow_pickle=True)
+    start = time.perf_counter()
+    open_mesh_store(os.path.join(path, 'mesh_store'), mesh_paths)
+    print('  MeshStore build:      {0:6.2f}s'.format(time.perf_counter() - start))
+
+    def open_premesh():
+        return np.load(premesh_path, allow_pickle=True).item()
+
+    def open_store():
+        return open_mesh_store(os.path.join(path, 'mesh_store'), mesh_paths)
+
+    for name, open_meshes in [('premesh.npy', open_premesh), ('MeshStore', open_store)]:
+        for method in ['fork', 'spawn']:
+            ctypes.CDLL('libc.so.6').malloc_trim(0) # give the meshes of the previous run back
+            base = proportional_set_size()
+            start = time.perf_counter()
+            meshes = open_meshes()
+            startup_time = time.perf_counter() - start
+            memory = []
+            for num_workers in workers:
+                with multiprocessing.get_context(method).Pool(num_workers, initializer=set_worker_meshes, initargs=(meshes,)) as pool:
+                    memory.append(sum(pool.map(touch_meshes, range(num_workers), chunksize=1)) + proportional_set_size() - base)
+            print('  {0:<21} startup: {1:6.2f}s | memory over the main process with {2} {3}ed workers: {4} MB'.format(
+                name + ':', startup_time, '/'.join(map(str, workers)), method, '/'.join('%.0f' % (m / 2 ** 20) for m in memory)))
+            del meshes
+    shutil.rmtree(path)
+
+
+def synthetic_body_mesh(resolution):
+    '''
+    Closed mesh of the synthetic occupancy (marching cubes), about 1.6 * resolution^2 faces
+    '''
+    coords = np.linspace(-1, 1, resolution)
+    grid = np.stack(np.meshgrid(coords, coords, coords, indexing='ij'), 0).reshape(3, -1)
+    sdf = synthetic_eval_func(grid).reshape(resolution, resolution, resolution)
+    verts, faces, _, _ = measure.marching_cubes(sdf, 0.5)
+    return verts * (2.0 / (resolution - 1)) - 1, faces
+
+
+def benchmark_ray_caster(resolution=256, num_points=100000, num_reference_points=200, threads=[1, 4], path='/tmp/benchmark_bvh'):
+    '''
+    lib.ray_caster.BVH against trimesh (without embree) on the queries of the samplers of TrainDataset: inside tests
+    of points near the surface and in the bounding box, and first hits of rays along z. The marching cubes mesh is
+    subdivided once to the size of a THuman2.0 scan (about 400k faces). trimesh only answers a small subset of the
+    points, which both are compared on.
+    '''
+    import shutil
+    import trimesh
+    from lib.ray_caster import BVH, load_or_build_bvh
+
+    mesh = trimesh.Trimesh(*synthetic_body_mesh(resolution), process=False).subdivide()
+    verts, faces = mesh.vertices, mesh.faces
+    print('ray caster ({0} faces)'.format(len(faces)))
+    start = time.perf_counter()
+    load_or_build_bvh(verts, faces, bvh_dir=path)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    bvh = BVH.load(path)
+    print('  build and save: {0:6.2f}s | load (memory-mapped): {1:8.5f}s'.format(build_time, time.perf_counter() - start))
+
+    np.random.seed(0)
+    surface_points, _ = trimesh.sample.sample_surface(mesh, num_points)
+    points = np.concatenate([surface_points[:num_points * 15 // 16] + np.random.normal(scale=0.02, size=(num_points * 15 // 16, 3)),
+                             np.random.rand(num_points - num_points * 15 // 16, 3) * 2 - 1], 0)
+    np.random.shuffle(points)
+    directions = np.tile([0.0, 0.0, 1.0], (num_points, 1)) * np.sign(np.random.rand(num_points, 1) - 0.5)
+    subset = slice(0, num_reference_points)
+
+    for name, bvh_query, trimesh_query, compare in [
+            ('contains', lambda n, t: bvh.contains(points[:n], num_threads=t), lambda: mesh.contains(points[subset]),
+             lambda a, b: 'agreement {0:.2%}'.format((a == b).mean())),
+            ('first hit', lambda n, t: bvh.first_hit(points[:n], directions[:n], num_threads=t),
+             lambda: trimesh.proximity.longest_ray(mesh, points[subset], directions[subset]),
+             lambda a, b: 'same misses {0:.2%} | max difference {1:.1e}'.format(
+                 (np.isinf(a) == np.isinf(b)).mean(), np.abs(a[np.isfinite(a) & np.isfinite(b)] - b[np.isfinite(a) & np.isfinite(b)]).max(initial=0)))]:
+        start = time.perf_counter()
+        reference = trimesh_query()
+        trimesh_rate = num_reference_points / (time.perf_counter() - start)
+        rates = []
+        for num_threads in threads:
+            start = time.perf_counter()
+            result = bvh_query(num_points, num_threads)
+            rates.append(num_points / (time.perf_counter() - start))
+        print('  {0:<9} | trimesh: {1:9.0f} points/s | BVH with {2} threads: {3} points/s | speedup: {4:.0f}x | {5}'.format(
+            name, trimesh_rate, '/'.join(map(str, threads)), '/'.join('%.0f' % rate for rate in rates), rates[0] / trimesh_rate,
+            compare(result[subset], reference)))
+    shutil.rmtree(path)
+
+
+def benchmark_factorized_mlp(resolution, columns_per_chunk=[64, 256], feature_channels=256):
+    '''
+    Points per second of the MLP of the default low-resolution options on grid columns: the module on the
+    concatenated per-point input, against FactorizedMLP on the per-column features, and the largest difference.
+    '''
+    import torch
+    from lib.model.MLP import MLP, FactorizedMLP
+
+    print('resolution: {0} (points per column)'.format(resolution))
+    mlp = MLP(filter_channels=[feature_channels + 1, 1024, 512, 256, 128, 1], merge_layer=2, res_layers=[2, 3, 4],
+              norm='no_norm', last_op=torch.nn.Sigmoid()).eval()
+    factorized_mlp = FactorizedMLP(mlp)
+    for num_columns in columns_per_chunk:
+        pixel_feat = torch.randn(1, feature_channels, num_columns)
+        z_feat = torch.linspace(-1, 1, resolution).expand(1, 1, num_columns, resolution)
+        with torch.inference_mode():
+            start = time.perf_counter()
+            point_feat = torch.cat([pixel_feat[:, :, :, None].expand(-1, -1, num_columns, resolution), z_feat], 1)
+            pred = mlp(point_feat.view(1, feature_channels + 1, -1))[0]
+            mlp_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            pred_factorized = factorized_mlp(pixel_feat, z_feat)[0]
+            factorized_time = time.perf_counter() - start
+        num_points = num_columns * resolution
+        print('  {0:4d} columns | MLP: {1:10.0f} points/s | FactorizedMLP: {2:10.0f} points/s | speedup: {3:5.2f}x | max difference: {4:.2e}'.format(
+            num_columns, num_points / mlp_time, num_points / factorized_time, mlp_time / factorized_time,
+            float((pred - pred_factorized).abs().max())))
+
+
+
+
+if __name__ == "__main__":
+
+    for resolution in resolutions_to_benchmark:
+        benchmark_octree(resolution)
+
+    for resolution in [256, 512]:
+        benchmark_fill(resolution)
+
+    for resolution in [128, 256, 512]:
+        benchmark_narrow_band(resolution)
+
+    benchmark_batch(256)
+
+    for resolution in [256, 512]:
+        benchmark_marching_cubes(resolution)
+
+    for resolution in [256, 512]:
+        benchmark_streaming(resolution)
+
+    benchmark_occupancy_dtype(256)
+
+    benchmark_depth_interval(256)
+
+    benchmark_factorized_mlp(512)
+
+    benchmark_refinement()
+
+    benchmark_normals()
+
+    benchmark_obj_writers()
+
+    benchmark_mesh_formats()
+
+    benchmark_obj_loader()
+
+    benchmark_mesh_store()
+
+    benchmark_ray_caster()
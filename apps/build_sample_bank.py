@@ -0,0 +1,66 @@
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from lib.options import BaseOptions
+from lib.data import TrainDataset
+from lib.data.sample_bank import SampleBank, build_sample_bank
+
+
+
+parser = BaseOptions()
+opt = parser.parse()
+
+
+
+# Modify the variables below as needed.
+sample_bank_dir = opt.sample_bank_dir if opt.sample_bank_dir is not None else "rendering_script/sample_bank"
+build_for_high_res_component = False # draw with High_Res_Component_sigma, as train_integratedPIFu.py does for the high resolution component
+num_builder_workers = None # processes drawing the subjects in parallel, None for one per cpu
+benchmark_get_item = True # after building, compare the get_item throughput of online sampling and of the sample bank
+num_items_to_benchmark = 50
+
+
+
+if build_for_high_res_component:
+    opt.sigma_low_resolution_pifu = opt.High_Res_Component_sigma
+
+
+
+
+def benchmark_sampling(dataset, use_dos, num_items):
+    '''
+    get_item throughput of one sampling mode, sampling the meshes online and drawing from the sample bank
+    '''
+    opt.useDOS = use_dos
+    indices = np.random.RandomState(0).randint(len(dataset), size=num_items)
+    for name, sample_bank in [('online', None), ('sample bank', SampleBank(sample_bank_dir, opt, use_dos))]:
+        dataset.sample_bank = sample_bank
+        dataset.get_item(indices[0]) # warm up (mesh construction and ray structures)
+        start = time.perf_counter()
+        for index in indices:
+            dataset.get_item(index)
+        elapsed = time.perf_counter() - start
+        print('  {0:<5} {1:<12} {2:6.2f} items/s'.format('DOS' if use_dos else 'spatial', name, num_items / elapsed))
+
+
+
+
+if __name__ == '__main__':
+
+    datasets = [TrainDataset(opt, projection='orthogonal', phase = 'train')]
+    if opt.useValidationSet:
+        datasets.append(TrainDataset(opt, projection='orthogonal', phase = 'train', validation_mode=True))
+
+    for dataset in datasets:
+        print('Drawing {0} sample sets per view of {1} subjects into {2}'.format(opt.sample_bank_draws, len(dataset.subjects), sample_bank_dir))
+        build_sample_bank(dataset, sample_bank_dir, num_draws=opt.sample_bank_draws, use_dos_modes=[False, True], num_workers=num_builder_workers)
+
+    if benchmark_get_item:
+        print('get_item throughput:')
+        for use_dos in [False, True]:
+            benchmark_sampling(datasets[0], use_dos, num_items_to_benchmark)
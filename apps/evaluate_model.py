@@ -41,13 +41,18 @@ def run_test_mesh_already_prepared():
             else:
                 GT_mesh_path = os.path.join("rendering_script", 'THuman2.0_Release' ,  subject, '%s.obj' % subject)
 
-            source_mesh_path = os.path.join(source_mesh_folder, 'test_%s.obj' % subject)
-            if not os.path.exists(source_mesh_path):
-                source_mesh_path = os.path.join(source_mesh_folder, 'test_%s_1.obj' % subject)
+            # the meshes may have been exported as binary PLY or GLB (mesh_export_format in train_integratedPIFu.py)
+            for name in ['test_%s' % subject, 'test_%s_1' % subject]:
+                for extension in ['.obj', '.ply', '.glb']:
+                    source_mesh_path = os.path.join(source_mesh_folder, name + extension)
+                    if os.path.exists(source_mesh_path):
+                        break
+                if os.path.exists(source_mesh_path):
+                    break
 
 
             GT_mesh = trimesh.load(GT_mesh_path)
-            source_mesh = trimesh.load(source_mesh_path)
+            source_mesh = trimesh.load(source_mesh_path, force='mesh')
 
 
             chamfer_distance = get_chamfer_dist(src_mesh=source_mesh, tgt_mesh=GT_mesh, num_samples=num_samples_to_use )
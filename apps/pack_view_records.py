@@ -0,0 +1,81 @@
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from lib.options import BaseOptions
+from lib.data import TrainDataset
+from lib.data.view_records import ViewRecords, pack_view_records
+from lib.data.sample_bank import subject_yaws
+
+
+
+parser = BaseOptions()
+opt = parser.parse()
+
+
+
+# Modify the variables below as needed.
+view_record_dir = opt.view_record_dir if opt.view_record_dir is not None else "rendering_script/view_records"
+num_packer_workers = None # processes packing the subjects in parallel, None for one per cpu
+benchmark_get_item = True # after packing, compare the get_item throughput and the bytes read per view of the separate files and of the records
+num_items_to_benchmark = 50
+
+
+
+
+def view_file_bytes(dataset, subject, yaw):
+    '''
+    Size of the files load_view_from_files reads for a view
+    '''
+    paths = [os.path.join(dataset.root, subject, name + "{0:03d}".format(yaw) + ext) for name, ext in
+             [("rendered_image_", ".png"), ("rendered_mask_", ".png"), ("rendered_params_", ".npy")]]
+    normal_ext = ".exr" if opt.use_groundtruth_normal_maps else ".npy"
+    paths += [os.path.join(dataset.normal_directory_high_res, subject, name + "{0:03d}".format(yaw) + normal_ext) for name in ["rendered_nmlF_", "rendered_nmlB_"]]
+    if opt.use_depth_map:
+        paths.append(os.path.join(dataset.depth_map_directory, subject, "rendered_depthmap_" + "{0:03d}".format(yaw) + (".exr" if opt.useGTdepthmap else ".npy")))
+    if opt.use_human_parse_maps:
+        paths.append(os.path.join(dataset.human_parse_map_directory, subject, "rendered_parse_" + "{0:03d}".format(yaw) + ".npy"))
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def benchmark_loading(dataset, num_items):
+    '''
+    get_item throughput without the sampling of the meshes (see apps/build_sample_bank.py for that part), reading the
+    separate files and the packed records, and the bytes each reads per view
+    '''
+    evaluation_mode = dataset.evaluation_mode
+    dataset.evaluation_mode = True
+    indices = np.random.RandomState(0).randint(len(dataset), size=num_items)
+    subject = dataset.subjects[0]
+    records = ViewRecords(view_record_dir, opt)
+    for name, view_records, view_bytes in [('files', None, view_file_bytes(dataset, subject, subject_yaws(dataset, subject)[0])),
+                                           ('records', records, records.open_record(subject)[1].dtype.itemsize)]:
+        dataset.view_records = view_records
+        dataset.get_item(indices[0]) # warm up
+        start = time.perf_counter()
+        for index in indices:
+            dataset.get_item(index)
+        elapsed = time.perf_counter() - start
+        print('  {0:<8} {1:6.2f} items/s | {2:6.1f} MB read per view'.format(name, num_items / elapsed, view_bytes / 2 ** 20))
+    dataset.evaluation_mode = evaluation_mode
+
+
+
+
+if __name__ == '__main__':
+
+    datasets = [TrainDataset(opt, projection='orthogonal', phase = 'train')]
+    if opt.useValidationSet:
+        datasets.append(TrainDataset(opt, projection='orthogonal', phase = 'train', validation_mode=True))
+
+    for dataset in datasets:
+        print('Packing the views of {0} subjects into {1}'.format(len(dataset.subjects), view_record_dir))
+        pack_view_records(dataset, view_record_dir, num_workers=num_packer_workers)
+
+    if benchmark_get_item:
+        print('get_item throughput (inputs only):')
+        benchmark_loading(datasets[0], num_items_to_benchmark)
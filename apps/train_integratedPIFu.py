@@ -19,7 +19,7 @@ import io
 from lib.options import BaseOptions
 from lib.model import HGPIFuNetwNML 
 from lib.data import TrainDataset
-from lib.mesh_util import save_obj_mesh_with_color, reconstruction
+from lib.mesh_util import save_mesh, reconstruction, reconstruction_batch
 from lib.geometry import index
 
 
@@ -47,6 +47,18 @@ checkpoint_folder_to_load_low_res = 'apps/checkpoints/Date_15_Jul_22_Time_10_51_
 checkpoint_folder_to_load_high_res = 'apps/checkpoints/Date_28_Jun_22_Time_02_49_38' # Date_28_Jun_22_Time_02_49_38 is folder to load
 epoch_to_load_from_low_res = 24
 epoch_to_load_from_high_res = 2
+gen_mesh_batch_size = 4 # number of test subjects that are filtered and reconstructed together by the testing script
+num_marching_cubes_workers = 1 # processes that run marching cubes on blocks of the volume during mesh generation
+reconstruction_occupancy_dtype = np.float32 # storage of the occupancy volume during mesh generation: np.float32, np.float16 or np.uint8
+use_visual_hull_culling = False # skip the grid points that project outside the silhouette mask during mesh generation
+use_depth_interval = False # only query the grid points near the front depth map during mesh generation (needs opt.use_depth_map)
+depth_interval_margin = 4 # slack of the depth interval, in grid cells
+use_column_features = False # sample the image features once per grid column (dense grid instead of the octree; needs a view direction along a grid axis)
+surface_refinement_steps = 0 # network queries per vertex that move the marching cubes vertices onto the 0.5 level, 0 to disable
+export_normal_mode = 'autograd' # None, 'autograd' or 'central': write the surface normals of the network into the exported meshes. 'central' costs about twice as much as 'autograd'
+mesh_export_format = 'obj' # format of the generated meshes: 'obj' (ASCII), 'ply' (binary) or 'glb'
+sample_export_format = 'ascii_ply' # format of the sample visualization pred.ply: 'ascii_ply', 'ply' (binary) or 'glb'
+reconstruction_memory_budget = None # bytes of device memory for one query chunk during mesh generation, e.g. 2 * 1024**3. None queries 50000 points at a time
 
 
 
@@ -65,20 +77,24 @@ class CPU_Unpickler(pickle.Unpickler):
             return super().find_class(module, name)
 
 
-def save_samples_truncted_prob(fname, points, prob):
+def save_samples_truncted_prob(fname, points, prob, binary=False):
     '''
     Save the visualization of sampling to a ply file.
     Red points represent positive predictions.
     Green points represent negative predictions.
-    :param fname: File name to save
+    :param fname: File name to save (a .glb file name writes binary glTF)
     :param points: [N, 3] array of points
     :param prob: [N, 1] array of predictions in the range [0~1]
+    :param binary: write binary little-endian PLY instead of ASCII
     :return:
     '''
     r = (prob >= 0.5).reshape([-1, 1]) * 255
     g = (prob < 0.5).reshape([-1, 1]) * 255
     b = np.zeros(r.shape)
 
+    if binary or fname.endswith('.glb'):
+        return save_mesh(fname, points, colors=np.concatenate([r, g, b], axis=-1).astype(np.uint8))
+
     to_save = np.concatenate([points, r, g, b], axis=-1)
     return np.savetxt(fname,
                       to_save,
@@ -106,42 +122,45 @@ def adjust_learning_rate(optimizer, epoch, lr, schedule, learning_rate_decay):
 
 def gen_mesh(resolution, net, device, data, save_path, thresh=0.5, use_octree=True):
     """Generate mesh from SDF"""
+    gen_mesh_batch(resolution, net, device, [data], [save_path], thresh=thresh, use_octree=use_octree)
+
+
+
+def gen_mesh_batch(resolution, net, device, data_list, save_path_list, thresh=0.5, use_octree=True):
+    """Generate one mesh per subject / view of data_list. The images are filtered together and queried as one batch"""
+
+    def stack(key):
+        return torch.stack([data[key] for data in data_list], 0).to(device=device)
     
-    calib_tensor = data['calib'].to(device=device)
-    calib_tensor = torch.unsqueeze(calib_tensor,0)
+    calib_tensor = stack('calib')
     
-    b_min = data['b_min']
-    b_max = data['b_max']
+    b_min = np.stack([data['b_min'] for data in data_list], 0)
+    b_max = np.stack([data['b_max'] for data in data_list], 0)
 
     # low-resolution image that is required by both models
-    image_low_tensor = data['render_low_pifu'].to(device=device)  
-    image_low_tensor = image_low_tensor.unsqueeze(0)
+    image_low_tensor = stack('render_low_pifu')
 
     if opt.use_front_normal:
-        nmlF_low_tensor = data['nmlF'].to(device=device)
-        nmlF_low_tensor = nmlF_low_tensor.unsqueeze(0)
+        nmlF_low_tensor = stack('nmlF')
     else:
         nmlF_low_tensor = None
 
 
     if opt.use_back_normal:
-        nmlB_low_tensor = data['nmlB'].to(device=device)
-        nmlB_low_tensor = nmlB_low_tensor.unsqueeze(0)
+        nmlB_low_tensor = stack('nmlB')
     else:
         nmlB_low_tensor = None
 
 
     if opt.use_depth_map:
-        depth_map_low_res = data['depth_map_low_res'].to(device=device)
-        depth_map_low_res = depth_map_low_res.unsqueeze(0)
+        depth_map_low_res = stack('depth_map_low_res')
     else: 
         depth_map_low_res = None
 
 
 
     if opt.use_human_parse_maps:
-        human_parse_map = data['human_parse_map'].to(device=device)
-        human_parse_map = human_parse_map.unsqueeze(0)
+        human_parse_map = stack('human_parse_map')
     else:
         human_parse_map=None
 
@@ -153,19 +172,16 @@ def gen_mesh(resolution, net, device, data, save_path, thresh=0.5, use_octree=Tr
         netG, highRes_netG = net
         net = highRes_netG
 
-        image_high_tensor = data['original_high_res_render'].to(device=device)  # the renders. Shape of [Batch_size, Channels, Height, Width]
-        image_high_tensor = torch.unsqueeze(image_high_tensor,0)
+        image_high_tensor = stack('original_high_res_render')  # the renders. Shape of [Batch_size, Channels, Height, Width]
         
         if opt.use_front_normal:
-            nmlF_high_tensor = data['nmlF_high_res'].to(device=device)
-            nmlF_high_tensor = nmlF_high_tensor.unsqueeze(0)
+            nmlF_high_tensor = stack('nmlF_high_res')
         else:
             nmlF_high_tensor = None
 
 
         if opt.use_back_normal:
-            nmlB_high_tensor = data['nmlB_high_res'].to(device=device)
-            nmlB_high_tensor = nmlB_high_tensor.unsqueeze(0)
+            nmlB_high_tensor = stack('nmlB_high_res')
         else:
             nmlB_high_tensor = None
 
@@ -173,8 +189,7 @@ def gen_mesh(resolution, net, device, data, save_path, thresh=0.5, use_octree=Tr
 
 
         if opt.use_depth_map and opt.allow_highres_to_use_depth:
-            depth_map_high_res = data['depth_map'].to(device=device)
-            depth_map_high_res = depth_map_high_res.unsqueeze(0)
+            depth_map_high_res = stack('depth_map')
 
         else: 
             depth_map_high_res = None
@@ -183,8 +198,7 @@ def gen_mesh(resolution, net, device, data, save_path, thresh=0.5, use_octree=Tr
 
 
         if opt.use_mask_for_rendering_high_res:
-            mask_high_res_tensor = data['mask'].to(device=device)
-            mask_high_res_tensor = mask_high_res_tensor.unsqueeze(0)
+            mask_high_res_tensor = stack('mask')
         else:
             mask_high_res_tensor = None
 
@@ -204,8 +218,7 @@ def gen_mesh(resolution, net, device, data, save_path, thresh=0.5, use_octree=Tr
 
 
         if opt.use_mask_for_rendering_low_res:
-            mask_low_res_tensor = data['mask_low_pifu'].to(device=device)
-            mask_low_res_tensor = mask_low_res_tensor.unsqueeze(0)
+            mask_low_res_tensor = stack('mask_low_pifu')
         else:
             mask_low_res_tensor = None
 
@@ -216,32 +229,51 @@ def gen_mesh(resolution, net, device, data, save_path, thresh=0.5, use_octree=Tr
 
 
     try:
-        save_img_path = save_path[:-4] + '.png'
-        save_img_list = []
-        for v in range(image_tensor.shape[0]):
-            save_img = (np.transpose(image_tensor[v].detach().cpu().numpy(), (1, 2, 0)) * 0.5 + 0.5)[:, :, ::-1] * 255.0
-            save_img_list.append(save_img)
-        save_img = np.concatenate(save_img_list, axis=1)
-        cv2.imwrite(save_img_path, save_img)
+        for i, save_path in enumerate(save_path_list):
+            save_img_path = save_path[:-4] + '.png'
+            save_img = (np.transpose(image_tensor[i].detach().cpu().numpy(), (1, 2, 0)) * 0.5 + 0.5)[:, :, ::-1] * 255.0
+            cv2.imwrite(save_img_path, save_img)
 
-        verts, faces, _, _ = reconstruction(
-            net, device, calib_tensor, resolution, thresh, use_octree=use_octree, num_samples=50000, b_min=b_min , b_max=b_max )
+        if use_visual_hull_culling:
+            masks = stack('mask' if opt.use_High_Res_Component else 'mask_low_pifu')
+        else:
+            masks = None
 
+        if use_depth_interval and opt.use_depth_map:
+            depth_maps = stack('depth_map')
+        else:
+            depth_maps = None
 
-        verts_tensor = torch.from_numpy(verts.T).unsqueeze(0).to(device=device).float()
+        results = reconstruction_batch(
+            net, device, calib_tensor, resolution, b_min, b_max, thresh, use_octree=use_octree and not use_column_features, num_samples=50000, memory_budget=reconstruction_memory_budget, num_mc_workers=num_marching_cubes_workers,
+            occupancy_dtype=reconstruction_occupancy_dtype, masks=masks, depth_maps=depth_maps, depth_margin=depth_interval_margin,
+            use_column_features=use_column_features, refine_steps=surface_refinement_steps, normal_mode=export_normal_mode )
 
-        xyz_tensor = net.projection(verts_tensor, calib_tensor)  
-        uv = xyz_tensor[:, :2, :]
-        color = index(image_tensor, uv).detach().cpu().numpy()[0].T
-        color = color * 0.5 + 0.5
+    except Exception as e:
+        print(e)
+        print("Cannot create marching cubes at this time.")
+        return
 
 
-        save_obj_mesh_with_color(save_path, verts, faces, color)
+    for i, save_path in enumerate(save_path_list):
+        try:
+            verts, faces, normals, _ = results[i]
 
 
-    except Exception as e:
-        print(e)
-        print("Cannot create marching cubes at this time.")
+            verts_tensor = torch.from_numpy(verts.T).unsqueeze(0).to(device=device).float()
+
+            xyz_tensor = net.projection(verts_tensor, calib_tensor[i:i+1])  
+            uv = xyz_tensor[:, :2, :]
+            color = index(image_tensor[i:i+1], uv).detach().cpu().numpy()[0].T
+            color = color * 0.5 + 0.5
+
+
+            save_mesh(save_path, verts, faces, color, normals=normals if export_normal_mode is not None else None)
+
+
+        except Exception as e:
+            print(e)
+            print("Cannot create marching cubes at this time.")
 
 
 
@@ -381,6 +413,8 @@ def train(opt):
                 len_to_iterate = len(train_dataset)
             else:
                 len_to_iterate = 72
+            data_list = []
+            save_path_list = []
             for gen_idx in tqdm(range(len_to_iterate)):
 
                 if test_script_activate_option_use_BUFF_dataset:
@@ -389,14 +423,20 @@ def train(opt):
                     index_to_use = gen_test_counter % len(train_dataset)
                 gen_test_counter += 10 # 10 is the number of images for each class
                 train_data = train_dataset.get_item(index=index_to_use) 
-                save_path = '%s/%s/test_%s.obj' % (
-                    opt.results_path, opt.name, train_data['name'])
+                save_path = '%s/%s/test_%s.%s' % (
+                    opt.results_path, opt.name, train_data['name'], mesh_export_format)
+                data_list.append(train_data)
+                save_path_list.append(save_path)
 
+                if len(data_list) < gen_mesh_batch_size and gen_idx < len_to_iterate - 1:
+                    continue
 
                 if opt.use_High_Res_Component:
-                    gen_mesh(resolution=opt.resolution, net=[netG, highRes_netG] , device = device, data = train_data, save_path = save_path)
+                    gen_mesh_batch(resolution=opt.resolution, net=[netG, highRes_netG] , device = device, data_list = data_list, save_path_list = save_path_list)
                 else:
-                    gen_mesh(resolution=opt.resolution, net=netG, device = device, data = train_data, save_path = save_path)
+                    gen_mesh_batch(resolution=opt.resolution, net=netG, device = device, data_list = data_list, save_path_list = save_path_list)
+                data_list = []
+                save_path_list = []
 
         print("Testing is Done! Exiting...")
         return
@@ -639,8 +679,8 @@ def train(opt):
                     gen_test_counter += 10 # 10 is the number of images for each class
                     train_data = train_dataset.get_item(index=index_to_use) 
                     # train_data["img"].shape  has shape of [1, 3, 512, 512]
-                    save_path = '%s/%s/train_eval_epoch%d_%s.obj' % (
-                        opt.results_path, opt.name, epoch, train_data['name'])
+                    save_path = '%s/%s/train_eval_epoch%d_%s.%s' % (
+                        opt.results_path, opt.name, epoch, train_data['name'], mesh_export_format)
 
                     # build mesh with marching cubes and save as obj file
                     if opt.use_High_Res_Component:
@@ -651,10 +691,10 @@ def train(opt):
 
                 try: #build point cloud
                     # save visualization of model performance
-                    save_path = '%s/%s/pred.ply' % (opt.results_path, opt.name)
+                    save_path = '%s/%s/pred.%s' % (opt.results_path, opt.name, 'glb' if sample_export_format == 'glb' else 'ply')
                     r = r[0].cpu() # get only the first example in the batch (i.e. 1 CAD model or subject). [1, Num of sampled points]
                     points = samples_low_res_pifu_tensor[0].transpose(0, 1).cpu()    # note that similar to res[0], we only take sample_tensor[0] i.e. the first CAD model. Shape of [Num of sampled points, 3] after the transpose. 
-                    save_samples_truncted_prob(save_path, points.detach().numpy(), r.detach().numpy())
+                    save_samples_truncted_prob(save_path, points.detach().numpy(), r.detach().numpy(), binary=sample_export_format != 'ascii_ply')
                 except:
                     print("Unable to save point cloud.")
                     
@@ -689,8 +729,8 @@ def train(opt):
                     index_to_use_list.append(index_to_use)
                     val_data = validation_dataset.get_item(index=index_to_use*10)  # as each subject has 10 images
 
-                    save_path = '%s/%s/val_eval_epoch%d_%s.obj' % (
-                        opt.results_path, opt.name, epoch, val_data['name'])
+                    save_path = '%s/%s/val_eval_epoch%d_%s.%s' % (
+                        opt.results_path, opt.name, epoch, val_data['name'], mesh_export_format)
 
                     val_mesh_paths.append(save_path)
 
@@ -703,13 +743,13 @@ def train(opt):
                 total_point_to_surface_distance = []
                 for val_path in val_mesh_paths:
                     subject = val_path.split('_')[-1]
-                    subject = subject.replace('.obj','')
+                    subject = os.path.splitext(subject)[0]
                     GT_mesh = validation_dataset.mesh_dic[subject]
                     
 
                     try: 
                         print('Computing CD and P2S for {0}'.format( os.path.basename(val_path) ) )
-                        source_mesh = trimesh.load(val_path)
+                        source_mesh = trimesh.load(val_path, force='mesh')
                         chamfer_distance, point_to_surface_distance = quick_get_chamfer_and_surface_dist(src_mesh=source_mesh, tgt_mesh=GT_mesh, num_samples=num_samples_to_use )
                         total_chamfer_distance.append(chamfer_distance)
                         total_point_to_surface_distance.append(point_to_surface_distance)
@@ -736,7 +776,7 @@ def train(opt):
                 # Delete files that are created for validation
                 for file_path in val_mesh_paths:
                     mesh_path = file_path
-                    image_path = file_path.replace('.obj', '.png')
+                    image_path = os.path.splitext(file_path)[0] + '.png'
                     os.remove(mesh_path)
                     os.remove(image_path)
 
@@ -16,6 +16,8 @@ from torch.utils.data import Dataset
 import torchvision.transforms as transforms
 import torch.nn.functional as F
 
+from .pyramid import pyramid_level
+
 
 produce_normal_maps = True 
 produce_coarse_depth_maps = True
@@ -124,10 +126,8 @@ class BuffDataset(Dataset):
 
 
         # resize the 1024 x 1024 image to 512 x 512 for the low-resolution pifu
-        render_low_pifu = F.interpolate(torch.unsqueeze(render,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-        mask_low_pifu = F.interpolate(torch.unsqueeze(mask,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-        render_low_pifu = render_low_pifu[0]
-        mask_low_pifu = mask_low_pifu[0]
+        render_low_pifu = pyramid_level(render, self.opt.loadSizeGlobal)
+        mask_low_pifu = pyramid_level(mask, self.opt.loadSizeGlobal)
 
         if produce_normal_maps:
             nmlF_high_res = np.load(nmlF_high_res_path) # shape of [3, 1024,1024]
@@ -137,10 +137,8 @@ class BuffDataset(Dataset):
             nmlF_high_res = mask.expand_as(nmlF_high_res) * nmlF_high_res
             nmlB_high_res = mask.expand_as(nmlB_high_res) * nmlB_high_res
 
-            nmlF  = F.interpolate(torch.unsqueeze(nmlF_high_res,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-            nmlF = nmlF[0]
-            nmlB  = F.interpolate(torch.unsqueeze(nmlB_high_res,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-            nmlB = nmlB[0]
+            nmlF = pyramid_level(nmlF_high_res, self.opt.loadSizeGlobal)
+            nmlB = pyramid_level(nmlB_high_res, self.opt.loadSizeGlobal)
         else:
             nmlF_high_res = nmlB_high_res = 0
             nmlF = nmlB = 0 
@@ -157,8 +155,7 @@ class BuffDataset(Dataset):
             fine_depth_map = np.load(fine_depth_map_path)
             fine_depth_map = torch.Tensor(fine_depth_map)
             fine_depth_map = mask.expand_as(fine_depth_map) * fine_depth_map # shape of [C,H,W]
-            depth_map_low_res = F.interpolate(torch.unsqueeze(fine_depth_map,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-            depth_map_low_res = depth_map_low_res[0] 
+            depth_map_low_res = pyramid_level(fine_depth_map, self.opt.loadSizeGlobal)
         else: 
             fine_depth_map = 0
             depth_map_low_res = 0 
@@ -168,6 +165,7 @@ class BuffDataset(Dataset):
             human_parse_map = torch.Tensor(human_parse_map)
             human_parse_map = torch.unsqueeze(human_parse_map,0) # shape of (1,1024,1024)
             human_parse_map = mask.expand_as(human_parse_map) * human_parse_map # shape of [1,H,W]
+            human_parse_map = pyramid_level(human_parse_map, self.opt.loadSizeGlobal) # one-hot encoded at the low resolution (the same as encoding then downsampling)
 
             human_parse_map_0 = (human_parse_map == 0).float()
             human_parse_map_1 = (human_parse_map == 1).float()
@@ -179,8 +177,6 @@ class BuffDataset(Dataset):
             human_parse_map_list = [human_parse_map_0, human_parse_map_1, human_parse_map_2, human_parse_map_3, human_parse_map_4, human_parse_map_5, human_parse_map_6]
 
             human_parse_map = torch.cat(human_parse_map_list, dim=0)
-            human_parse_map = F.interpolate(torch.unsqueeze(human_parse_map,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-            human_parse_map = human_parse_map[0] 
         else:
             human_parse_map = 0
 
@@ -17,6 +17,8 @@ from torch.utils.data import Dataset
 import torchvision.transforms as transforms
 import torch.nn.functional as F
 
+from .pyramid import pyramid_level
+
 os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
 
 CAMERA_TO_MESH_DISTANCE = 10.0 # This is an arbitrary value set by the rendering script. Can be modified by changing the rendering script.
@@ -118,10 +120,8 @@ class DepthDataset(Dataset):
         center_indicator = torch.Tensor(center_indicator).float()
 
         # resize the 1024 x 1024 image to 512 x 512 for the low-resolution pifu
-        render_low_pifu = F.interpolate(torch.unsqueeze(render,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-        mask_low_pifu = F.interpolate(torch.unsqueeze(mask,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-        render_low_pifu = render_low_pifu[0]
-        mask_low_pifu = mask_low_pifu[0]
+        render_low_pifu = pyramid_level(render, self.opt.loadSizeGlobal)
+        mask_low_pifu = pyramid_level(mask, self.opt.loadSizeGlobal)
 
 
 
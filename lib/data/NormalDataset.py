@@ -16,6 +16,8 @@ from torch.utils.data import Dataset
 import torchvision.transforms as transforms
 import torch.nn.functional as F
 
+from .pyramid import pyramid_level
+
 
 
 
@@ -98,10 +100,8 @@ class NormalDataset(Dataset):
 
 
         # resize the 1024 x 1024 image to 512 x 512 for the low-resolution pifu
-        render_low_pifu = F.interpolate(torch.unsqueeze(render,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-        mask_low_pifu = F.interpolate(torch.unsqueeze(mask,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-        render_low_pifu = render_low_pifu[0]
-        mask_low_pifu = mask_low_pifu[0]
+        render_low_pifu = pyramid_level(render, self.opt.loadSizeGlobal)
+        mask_low_pifu = pyramid_level(mask, self.opt.loadSizeGlobal)
 
 
         nmlF_high_res = cv2.imread(nmlF_high_res_path, cv2.IMREAD_UNCHANGED).astype(np.float32) # numpy of [1024,1024,3]
@@ -17,34 +17,34 @@ import torchvision.transforms as transforms
 import torch.nn.functional as F
 from numpy.linalg import inv
 
+from ..mesh_io import open_mesh_store
+from .pyramid import pyramid_level
+from .sample_bank import SampleBank
+from .view_records import ViewRecords
+from .occupancy_volume import OccupancyVolume, occupancy_volume_path
+
 log = logging.getLogger('trimesh')
 log.setLevel(40)
 
 
-def load_trimesh(root_dir, training_subject_list = None):
-
-    # load preloaded meshes
-    if os.path.exists('premesh.npy'):
-        meshs = np.load('premesh.npy', allow_pickle=True)
-        return meshs
+def load_trimesh(root_dir, training_subject_list = None, store_dir = None):
+    """Meshes of the subjects as a lib.mesh_io.MeshStore (a dict-like of lazily constructed trimesh.Trimesh).
+    The store is packed into store_dir on first use and rebuilt when a mesh file changes.
+    """
+    if store_dir is None:
+        store_dir = os.path.join(root_dir, 'mesh_store')
 
-    # reload meshes
-    folders = os.listdir(root_dir)
-    meshs = {}
-    for f in tqdm(folders):
+    mesh_paths = {}
+    for f in os.listdir(root_dir):
         if f == ".DS_Store":
             continue
 
         if f not in training_subject_list: # only load meshes that are in the training set
             continue
 
-        meshs[f] = trimesh.load(os.path.join(root_dir, f, '%s.obj' % f))
-
-    # with open('premesh.npy', 'wb') as f:
-    #     np.save(f,meshs,allow_pickle=True)
-    # assert False
+        mesh_paths[f] = os.path.join(root_dir, f, '%s.obj' % f)
 
-    return meshs
+    return open_mesh_store(store_dir, mesh_paths)
 
 
 
@@ -63,6 +63,7 @@ class TrainDataset(Dataset):
         self.opt = opt
         self.projection_mode = projection
         self.training_subject_list = np.loadtxt("train_set_list.txt", dtype=str)
+        mesh_store_subject_list = self.training_subject_list.tolist() # training and validation datasets share one mesh store
 
         #if opt.debug_mode:
         #    self.training_subject_list = np.loadtxt("/mnt/lustre/kennard.chan/getTestSet/fake_train_set_list.txt", dtype=str)
@@ -107,7 +108,22 @@ class TrainDataset(Dataset):
         if (evaluation_mode):
             pass 
         else:
-            self.mesh_dic = load_trimesh(self.mesh_directory,  training_subject_list = self.training_subject_list)  # a dict containing the meshes of all the CAD models.
+            self.mesh_dic = load_trimesh(self.mesh_directory,  training_subject_list = mesh_store_subject_list)  # a dict-like of the meshes of all the CAD models, memory-mapped and shared by the workers.
+
+        # occupancy volumes baked next to the meshes (apps/bake_occupancy_volumes.py), loaded when a subject is first sampled
+        self.occupancy_volumes = {}
+
+        # pre-drawn samples (apps/build_sample_bank.py) replace the online sampling of the meshes
+        if self.opt.sample_bank_dir is not None and not evaluation_mode:
+            self.sample_bank = SampleBank(self.opt.sample_bank_dir, self.opt, self.opt.useDOS)
+        else:
+            self.sample_bank = None
+
+        # inputs of the views packed into one memory-mapped record per subject (apps/pack_view_records.py)
+        if self.opt.view_record_dir is not None:
+            self.view_records = ViewRecords(self.opt.view_record_dir, self.opt)
+        else:
+            self.view_records = None
 
 
 
@@ -147,11 +163,8 @@ class TrainDataset(Dataset):
         self.img_files = sorted(self.img_files)
 
 
-        # PIL to tensor
-        self.to_tensor = transforms.Compose([
-            transforms.ToTensor(), #  ToTensor converts input to a shape of (C x H x W) in the range [0.0, 1.0] for each dimension
-            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))  # normalise with mean of 0.5 and std_dev of 0.5 for each dimension. Finally range will be [-1,1] for each dimension
-        ])
+        # the uint8 render is converted to [0,1] as transforms.ToTensor does, then normalised
+        self.normalize = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))  # normalise with mean of 0.5 and std_dev of 0.5 for each dimension. Finally range will be [-1,1] for each dimension
 
 
 
@@ -161,9 +174,30 @@ class TrainDataset(Dataset):
 
 
 
-    def select_sampling_method(self, subject, calib, b_min, b_max, R = None):
+    def get_occupancy_volume(self, subject):
+        if subject not in self.occupancy_volumes:
+            self.occupancy_volumes[subject] = OccupancyVolume.load(occupancy_volume_path(os.path.join(self.mesh_directory, subject, '%s.obj' % subject)))
+        return self.occupancy_volumes[subject]
+
+    def get_ray_caster(self, subject):
+        # lib.ray_caster.BVH of the subject, cached in the mesh store and shared by the workers
+        return self.mesh_dic.ray_caster(subject)
+
+    def longest_ray(self, subject, points, directions):
+        # distance along each ray to the first hit of the mesh (inf when there is none), as trimesh.proximity.longest_ray
+        if self.opt.ray_caster == 'bvh':
+            return self.get_ray_caster(subject).first_hit(points, directions)
+        return trimesh.proximity.longest_ray(self.mesh_dic[subject], points, directions)
+
+
+
+
+    def select_sampling_method(self, subject, calib, b_min, b_max, R = None, use_dos = None):
         """Draws self.num_sample_inout number of 3d query points with occupancy labels based on selected sampling method (spatial/DOS)
+        use_dos overrides self.opt.useDOS (the sample bank builder draws both)
         """
+        if use_dos is None:
+            use_dos = self.opt.useDOS
 
         compensation_factor = 0.25 # not sure what this is
 
@@ -182,7 +216,7 @@ class TrainDataset(Dataset):
 
         # add random points within image space
         length = b_max - b_min # has shape of (3,)
-        if not self.opt.useDOS: # spatial sampling method
+        if not use_dos: # spatial sampling method
 
             random_points = np.random.rand( int(compensation_factor * self.num_sample_inout // 4) , 3) * length + b_min # shape of [compensation_factor*num_sample_inout/4, 3] # draw N random 3D points inside volume
             surface_points_shape = list(surface_points.shape)
@@ -190,13 +224,18 @@ class TrainDataset(Dataset):
             sample_points_low_res_pifu = surface_points + random_noise # sample_points are points very near the surface. The sigma represents the std dev of the normal distribution
             sample_points_low_res_pifu = np.concatenate([sample_points_low_res_pifu, random_points], 0) # shape of [compensation_factor*0.25*num_sample_inout, 3]
             np.random.shuffle(sample_points_low_res_pifu)
-            inside_low_res_pifu = mesh.contains(sample_points_low_res_pifu) # return a boolean 1D array of size (num of sample points,) #get labels for whether the points lie inside mesh
+            if self.opt.use_occupancy_volumes:
+                inside_low_res_pifu = self.get_occupancy_volume(subject).contains(sample_points_low_res_pifu)
+            elif self.opt.ray_caster == 'bvh':
+                inside_low_res_pifu = self.get_ray_caster(subject).contains(sample_points_low_res_pifu)
+            else:
+                inside_low_res_pifu = mesh.contains(sample_points_low_res_pifu) # return a boolean 1D array of size (num of sample points,) #get labels for whether the points lie inside mesh
             inside_points_low_res_pifu = sample_points_low_res_pifu[inside_low_res_pifu]
       
 
 
         # Depth oriented sampling
-        if self.opt.useDOS:
+        if use_dos:
             # we have 16x more samples than required. why?
             num_of_pts_in_section = self.num_sample_inout // 3 # 1:3 ratio
 
@@ -228,9 +267,14 @@ class TrainDataset(Dataset):
             # get way inside points: #(5%)
             num_of_way_inside_pts = round(self.num_sample_inout * self.opt.ratio_of_way_inside_points) #0.05 of points are way inside.
             way_inside_pts = surface_points[0: num_of_way_inside_pts ] - z_displacement[0:num_of_way_inside_pts] * sigma_multiplier * (4.0  + np.random.uniform(low=0.0, high=2.0, size=None) )  # draw points up to 2.0 inside mesh
-            proximity = trimesh.proximity.longest_ray(mesh, way_inside_pts, -z_displacement[0:num_of_way_inside_pts]) # shape of [num_of_sample_pts]
+            proximity = self.longest_ray(subject, way_inside_pts, -z_displacement[0:num_of_way_inside_pts]) # shape of [num_of_sample_pts]
             way_inside_pts[ proximity< (sigma_multiplier* 4.0 ) ] = 0 # remove points that are too near the opposite z direction
-            proximity = trimesh.proximity.signed_distance(mesh, way_inside_pts) # [num_of_sample_pts]
+            if self.opt.use_occupancy_volumes:
+                proximity = self.get_occupancy_volume(subject).signed_distance(way_inside_pts) # only the sign is used
+            elif self.opt.ray_caster == 'bvh':
+                proximity = np.where(self.get_ray_caster(subject).contains(way_inside_pts), 1.0, -1.0) # only the sign is used
+            else:
+                proximity = trimesh.proximity.signed_distance(mesh, way_inside_pts) # [num_of_sample_pts]
             way_inside_pts[proximity<0, :] = 0 # remove pts that are actually outside the mesh
 
 
@@ -241,7 +285,7 @@ class TrainDataset(Dataset):
             # get way outside points #(5%)
             num_of_outside_pts = round(self.num_sample_inout * self.opt.ratio_of_outside_points)
             outside_surface_points = surface_points[0: num_of_outside_pts ] + z_displacement[0:num_of_outside_pts] * sigma_multiplier * (5.0 + np.random.uniform(low=0.0, high=50.0, size=None) )  
-            proximity = trimesh.proximity.longest_ray(mesh, outside_surface_points, z_displacement[0:num_of_outside_pts]) # shape of [num_of_sample_pts]
+            proximity = self.longest_ray(subject, outside_surface_points, z_displacement[0:num_of_outside_pts]) # shape of [num_of_sample_pts]
             outside_surface_points[ proximity< (sigma_multiplier* 5.0 ) ] = 0 # remove points that are too near the opposite z direction
 
             all_points_low_res_pifu = np.concatenate([   inside_points_low_res_pifu , outside_surface_points ], 0) 
@@ -253,7 +297,7 @@ class TrainDataset(Dataset):
 
         # reduce the number of inside and outside points if there are too many inside points. (it is very likely that "nin > self.num_sample_inout // 2" is true)
         nin = inside_points_low_res_pifu.shape[0]
-        if not ( self.opt.useDOS):
+        if not ( use_dos):
             inside_points_low_res_pifu = inside_points_low_res_pifu[
                             :self.num_sample_inout // 2] if nin > self.num_sample_inout // 2 else inside_points_low_res_pifu  # should have shape of [2500, 3]
             outside_points_low_res_pifu = outside_points_low_res_pifu[
@@ -264,7 +308,7 @@ class TrainDataset(Dataset):
 
 
 
-        if self.opt.useDOS:
+        if use_dos:
             samples_low_res_pifu = all_points_low_res_pifu.T   # should have shape of [3, 5000]
             
             labels_low_res_pifu = np.concatenate([  labels_with_normal_sigma, np.ones((1, way_inside_pts.shape[0])) * 1.0 ,  np.ones((1, outside_surface_points.shape[0])) * 0.0 ], 1) # should have shape of [1, 5000]. If element is 1, it means the point is inside. If element is 0, it means the point is outside.
@@ -287,46 +331,31 @@ class TrainDataset(Dataset):
 
 
 
-    def get_item(self, index):
-
-        img_path = self.img_files[index]
-        img_name = os.path.splitext(os.path.basename(img_path))[0]
-
-        # get yaw
-        yaw = img_name.split("_")[-1]
-        yaw = int(yaw)
-
-        # get subject
-        subject = img_path.split('/')[-2] # e.g. "0507"
-
-        # get paths
+    def load_camera_params(self, subject, yaw):
+        """Camera of a rendered view: center, R and scale_factor
+        """
         param_path = os.path.join(self.root, subject , "rendered_params_" + "{0:03d}".format(yaw) + ".npy"  )
-        render_path = os.path.join(self.root, subject, "rendered_image_" + "{0:03d}".format(yaw) + ".png"  )
-        mask_path = os.path.join(self.root, subject, "rendered_mask_" + "{0:03d}".format(yaw) + ".png"  )
-        
+        param = np.load(param_path, allow_pickle=True)  # param is a np.array that looks similar to a dict.  # ortho_ratio = 0.4 , e.g. scale or y_scale = 0.961994278, e.g. center or vmed = [-1.0486  92.56105  1.0101 ]
+        center = param.item().get('center') # is camera 3D center position in the 3D World point space (without any rotation being applied).
+        R = param.item().get('R')   # R is used to rotate the CAD model according to a given pitch and yaw.
+        scale_factor = param.item().get('scale_factor') # is camera 3D center position in the 3D World point space (without any rotation being applied).
+        return center, R, scale_factor
 
-        if self.opt.use_groundtruth_normal_maps:
-            nmlF_high_res_path =  os.path.join(self.normal_directory_high_res, subject, "rendered_nmlF_" + "{0:03d}".format(yaw) + ".exr"  )
-            nmlB_high_res_path =  os.path.join(self.normal_directory_high_res, subject, "rendered_nmlB_" + "{0:03d}".format(yaw) + ".exr"  )
-        else:
-            nmlF_high_res_path =  os.path.join(self.normal_directory_high_res, subject, "rendered_nmlF_" + "{0:03d}".format(yaw) + ".npy"  )
-            nmlB_high_res_path =  os.path.join(self.normal_directory_high_res, subject, "rendered_nmlB_" + "{0:03d}".format(yaw) + ".npy"  )
 
-        if self.opt.useGTdepthmap:
-            depth_map_path =  os.path.join(self.depth_map_directory, subject, "rendered_depthmap_" + "{0:03d}".format(yaw) + ".exr"  )
-        else:
-            depth_map_path =  os.path.join(self.depth_map_directory, subject, "rendered_depthmap_" + "{0:03d}".format(yaw) + ".npy"  )
 
-        human_parse_map_path = os.path.join(self.human_parse_map_directory,  subject, "rendered_parse_" + "{0:03d}".format(yaw) + ".npy"  )
+    def get_calib(self, subject, yaw, camera_params = None):
+        """Calibration of a rendered view and the bounding volume around the subject
+        camera_params (center, R, scale_factor) are read from the rendered_params file of the view when not given
+        returns calib, extrinsic, b_min, b_max, R (rotation of the view) and b_range (size of the bounding volume)
+        """
+        if camera_params is None:
+            camera_params = self.load_camera_params(subject, yaw)
+        center, R, scale_factor = camera_params
 
         load_size_associated_with_scale_factor = 1024
 
 
         ### Construct calibration matrix
-        param = np.load(param_path, allow_pickle=True)  # param is a np.array that looks similar to a dict.  # ortho_ratio = 0.4 , e.g. scale or y_scale = 0.961994278, e.g. center or vmed = [-1.0486  92.56105  1.0101 ]
-        center = param.item().get('center') # is camera 3D center position in the 3D World point space (without any rotation being applied).
-        R = param.item().get('R')   # R is used to rotate the CAD model according to a given pitch and yaw.
-        scale_factor = param.item().get('scale_factor') # is camera 3D center position in the 3D World point space (without any rotation being applied).
 
         # b_min and b_max defines a cubic volume with the camera position in the center. Subject should fit within volume.
         b_range = load_size_associated_with_scale_factor / scale_factor # e.g. 512/scale_factor
@@ -354,22 +383,43 @@ class TrainDataset(Dataset):
         calib = torch.Tensor(np.matmul(intrinsic, extrinsic)).float()  #P = KR
         extrinsic = torch.Tensor(extrinsic).float()
 
+        return calib, extrinsic, b_min, b_max, R, b_range
 
 
-        ### Load mask and image
-        mask = Image.open(mask_path).convert('L')  
-        render = Image.open(render_path).convert('RGB')
 
-        mask = transforms.ToTensor()(mask).float()
 
-        render = self.to_tensor(render)  # normalize render  
-        render = mask.expand_as(render) * render # apply mask to rendered image
+    def load_view_from_files(self, subject, yaw):
+        """Reads and decodes the inputs of a rendered view from their separate files
+        returns a dict of the arrays get_item builds its tensors from: rgb [H,W,3] uint8, mask [H,W] uint8, nmlF and nmlB [3,H,W],
+        depth [C,H,W] (before masking, None if not self.opt.use_depth_map), parse [H,W] (None if not self.opt.use_human_parse_maps)
+        and the camera params center, R and scale_factor
+        """
+        # get paths
+        render_path = os.path.join(self.root, subject, "rendered_image_" + "{0:03d}".format(yaw) + ".png"  )
+        mask_path = os.path.join(self.root, subject, "rendered_mask_" + "{0:03d}".format(yaw) + ".png"  )
+        
 
-        # downsample to low res image and mask
-        render_low_pifu = F.interpolate(torch.unsqueeze(render,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-        mask_low_pifu = F.interpolate(torch.unsqueeze(mask,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-        render_low_pifu = render_low_pifu[0]
-        mask_low_pifu = mask_low_pifu[0]
+        if self.opt.use_groundtruth_normal_maps:
+            nmlF_high_res_path =  os.path.join(self.normal_directory_high_res, subject, "rendered_nmlF_" + "{0:03d}".format(yaw) + ".exr"  )
+            nmlB_high_res_path =  os.path.join(self.normal_directory_high_res, subject, "rendered_nmlB_" + "{0:03d}".format(yaw) + ".exr"  )
+        else:
+            nmlF_high_res_path =  os.path.join(self.normal_directory_high_res, subject, "rendered_nmlF_" + "{0:03d}".format(yaw) + ".npy"  )
+            nmlB_high_res_path =  os.path.join(self.normal_directory_high_res, subject, "rendered_nmlB_" + "{0:03d}".format(yaw) + ".npy"  )
+
+        if self.opt.useGTdepthmap:
+            depth_map_path =  os.path.join(self.depth_map_directory, subject, "rendered_depthmap_" + "{0:03d}".format(yaw) + ".exr"  )
+        else:
+            depth_map_path =  os.path.join(self.depth_map_directory, subject, "rendered_depthmap_" + "{0:03d}".format(yaw) + ".npy"  )
+
+        human_parse_map_path = os.path.join(self.human_parse_map_directory,  subject, "rendered_parse_" + "{0:03d}".format(yaw) + ".npy"  )
+
+        center, R, scale_factor = self.load_camera_params(subject, yaw)
+
+
+
+        ### Load mask and image
+        mask = np.array(Image.open(mask_path).convert('L'))
+        render = np.array(Image.open(render_path).convert('RGB'))
 
 
 
@@ -384,23 +434,13 @@ class TrainDataset(Dataset):
             nmlF_high_res = np.load(nmlF_high_res_path) # shape of [3, 1024,1024]
             nmlB_high_res = np.load(nmlB_high_res_path) # shape of [3, 1024,1024]
 
-        nmlF_high_res = torch.Tensor(nmlF_high_res)
-        nmlB_high_res = torch.Tensor(nmlB_high_res)
-
-        nmlF_high_res = mask.expand_as(nmlF_high_res) * nmlF_high_res # apply mask to normal map
-        nmlB_high_res = mask.expand_as(nmlB_high_res) * nmlB_high_res # apple mask to normal map
-
-        # downsample to low res normal maps
-        nmlF  = F.interpolate(torch.unsqueeze(nmlF_high_res,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-        nmlF = nmlF[0]
-        nmlB  = F.interpolate(torch.unsqueeze(nmlB_high_res,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-        nmlB = nmlB[0]
 
 
         ### Load depth maps
         if self.opt.use_depth_map:
 
             if self.opt.useGTdepthmap:
+                b_range = self.get_calib(subject, yaw, camera_params = (center, R, scale_factor))[5]
                 depth_map = cv2.imread(depth_map_path, cv2.IMREAD_UNCHANGED).astype(np.float32) 
                 depth_map = depth_map[:,:,0]
                 mask_depth = depth_map > 100
@@ -411,43 +451,101 @@ class TrainDataset(Dataset):
                 depth_map = depth_map + 1.0 # convert into range of [0,2.0] where the center pixel has value of 1.0
                 depth_map[mask_depth] = 0 # the invalid values are set to 0.
                 depth_map = np.expand_dims(depth_map,0) # shape of [1,1024,1024]
-                depth_map = torch.Tensor(depth_map)
-                depth_map = mask.expand_as(depth_map) * depth_map
-                # downsample depth_map
-                if self.opt.depth_in_front:
-                    depth_map_low_res = F.interpolate(torch.unsqueeze(depth_map,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-                    depth_map_low_res = depth_map_low_res[0] 
-                else: 
-                    depth_map_low_res = 0 
-                
             else:
                 depth_map = np.load(depth_map_path)
-                depth_map = torch.Tensor(depth_map)
-                
-                depth_map = mask.expand_as(depth_map) * depth_map # shape of [C,H,W]
-
-                if self.opt.depth_in_front:
-                    depth_map_low_res = F.interpolate(torch.unsqueeze(depth_map,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-                    depth_map_low_res = depth_map_low_res[0] 
-                else: 
-                    depth_map_low_res = 0 
 
         else:
             depth_map = None
-            depth_map_low_res = 0 
 
-        if not self.opt.use_depth_map: # could have just set it to 0 directly
-            depth_map = 0
+
+
+        ### Load human parse maps
+        if self.opt.use_human_parse_maps:
+            human_parse_map = np.load(human_parse_map_path) # shape of (1024,1024)
+        else:
+            human_parse_map = None
+
+
+        return {'rgb': render, 'mask': mask, 'nmlF': nmlF_high_res, 'nmlB': nmlB_high_res, 'depth': depth_map, 'parse': human_parse_map,
+                'center': center, 'R': R, 'scale_factor': scale_factor}
+
+
+
+
+    def get_item(self, index):
+
+        img_path = self.img_files[index]
+        img_name = os.path.splitext(os.path.basename(img_path))[0]
+
+        # get yaw
+        yaw = img_name.split("_")[-1]
+        yaw = int(yaw)
+
+        # get subject
+        subject = img_path.split('/')[-2] # e.g. "0507"
+
+        render_path = os.path.join(self.root, subject, "rendered_image_" + "{0:03d}".format(yaw) + ".png"  )
+
+        # the inputs of the view, from its packed record (apps/pack_view_records.py) or decoded from the separate files
+        if self.view_records is not None:
+            view = self.view_records.read(subject, yaw)
+        else:
+            view = self.load_view_from_files(subject, yaw)
+
+        calib, extrinsic, b_min, b_max, R, b_range = self.get_calib(subject, yaw, camera_params = (view['center'], view['R'], view['scale_factor']))
+
+
+
+        ### Load mask and image
+        mask = torch.from_numpy(view['mask'])[None].float().div(255) # as transforms.ToTensor
+        render = torch.from_numpy(view['rgb']).permute(2, 0, 1).float().div(255)
+
+        render = self.normalize(render)  # normalize render  
+        render = mask.expand_as(render) * render # apply mask to rendered image
+
+        # downsample to low res image and mask
+        render_low_pifu = pyramid_level(render, self.opt.loadSizeGlobal)
+        mask_low_pifu = pyramid_level(mask, self.opt.loadSizeGlobal)
+
+
+
+        ### Load normal maps
+        nmlF_high_res = torch.Tensor(view['nmlF'])
+        nmlB_high_res = torch.Tensor(view['nmlB'])
+
+        nmlF_high_res = mask.expand_as(nmlF_high_res) * nmlF_high_res # apply mask to normal map
+        nmlB_high_res = mask.expand_as(nmlB_high_res) * nmlB_high_res # apple mask to normal map
+
+        # downsample to low res normal maps
+        nmlF = pyramid_level(nmlF_high_res, self.opt.loadSizeGlobal)
+        nmlB = pyramid_level(nmlB_high_res, self.opt.loadSizeGlobal)
+
+
+        ### Load depth maps
+        if self.opt.use_depth_map:
+
+            depth_map = torch.Tensor(view['depth'])
+            depth_map = mask.expand_as(depth_map) * depth_map # shape of [C,H,W]
+
+            # downsample depth_map
+            if self.opt.depth_in_front:
+                depth_map_low_res = pyramid_level(depth_map, self.opt.loadSizeGlobal)
+            else: 
+                depth_map_low_res = 0 
+
+        else:
+            depth_map = 0 
+            depth_map_low_res = 0 
 
 
 
 
         ### Load human parse maps
         if self.opt.use_human_parse_maps:
-            human_parse_map = np.load(human_parse_map_path) # shape of (1024,1024)
-            human_parse_map = torch.Tensor(human_parse_map)
+            human_parse_map = torch.Tensor(view['parse'])
             human_parse_map = torch.unsqueeze(human_parse_map,0) # shape of (1,1024,1024)
             human_parse_map = mask.expand_as(human_parse_map) * human_parse_map # shape of [1,H,W]
+            human_parse_map = pyramid_level(human_parse_map, self.opt.loadSizeGlobal) # one-hot encoded at the low resolution (the same as encoding then downsampling)
 
             if self.opt.use_groundtruth_human_parse_maps:
                 human_parse_map_1 = (human_parse_map == 0.5).float()
@@ -470,8 +568,6 @@ class TrainDataset(Dataset):
 
             human_parse_map = torch.cat(human_parse_map_list, dim=0)
 
-            human_parse_map = F.interpolate(torch.unsqueeze(human_parse_map,0), size=(self.opt.loadSizeGlobal,self.opt.loadSizeGlobal) )
-            human_parse_map = human_parse_map[0] 
         else:
             human_parse_map = 0
 
@@ -482,7 +578,9 @@ class TrainDataset(Dataset):
             sample_data = {'samples_low_res_pifu':0, 'labels_low_res_pifu':0 }
 
         else:
-            if self.opt.num_sample_inout:  # opt.num_sample_inout has default of 8000 # number of points to sample?
+            if self.sample_bank is not None:
+                sample_data = self.sample_bank.draw(subject, yaw)
+            elif self.opt.num_sample_inout:  # opt.num_sample_inout has default of 8000 # number of points to sample?
                 sample_data = self.select_sampling_method(subject, calib, b_min = b_min, b_max = b_max, R = R)
 
 
@@ -0,0 +1,147 @@
+import os
+
+import numpy as np
+
+
+def parity_votes(grid_verts, faces, dims, axis):
+    '''
+    Inside votes of the grid points from rays cast along one grid axis, in both directions: a point is inside for a
+    ray when the ray crosses the surface an odd number of times. The triangles are rasterized onto the grid columns
+    of the axis, so no ray is cast explicitly.
+    :param grid_verts: [N, 3] vertices in grid index coordinates (grid point i lies at i)
+    :param dims: (3,) grid size
+    :return: [dims] uint8 number of the two rays that see the point inside
+    '''
+    other = [i for i in range(3) if i != axis]
+    # the columns are shifted off the grid by a small irrational amount so that no column passes exactly through an edge or vertex
+    tri = grid_verts[faces][:, :, other + [axis]] - np.array([np.sqrt(2) * 1e-4, np.sqrt(3) * 1e-4, 0])
+    lo = np.maximum(np.ceil(tri[:, :, :2].min(1)), 0).astype(np.int64)
+    hi = np.minimum(np.floor(tri[:, :, :2].max(1)), np.array([dims[other[0]], dims[other[1]]]) - 1).astype(np.int64)
+    size = np.maximum(hi - lo + 1, 0)
+    count = size[:, 0] * size[:, 1]
+
+    # every (triangle, column) pair of the bounding rectangles
+    face = np.repeat(np.arange(len(tri)), count)
+    offset = np.arange(len(face)) - np.repeat(np.cumsum(count) - count, count)
+    column = lo[face] + np.stack([offset // np.maximum(size[face, 1], 1), offset % np.maximum(size[face, 1], 1)], 1)
+
+    # 2D barycentric coordinates of the column in the projected triangle
+    a, b, c = tri[face, 0], tri[face, 1], tri[face, 2]
+    v0, v1, p = b[:, :2] - a[:, :2], c[:, :2] - a[:, :2], column - a[:, :2]
+    det = v0[:, 0] * v1[:, 1] - v0[:, 1] * v1[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = (p[:, 0] * v1[:, 1] - p[:, 1] * v1[:, 0]) / det
+        v = (v0[:, 0] * p[:, 1] - v0[:, 1] * p[:, 0]) / det
+        hit = (det != 0) & (u >= 0) & (v >= 0) & (u + v <= 1)
+    depth = a[hit, 2] + u[hit] * (b[hit, 2] - a[hit, 2]) + v[hit] * (c[hit, 2] - a[hit, 2])
+    column = column[hit]
+
+    # crossings below each grid point: histogram of the first grid point above every crossing, accumulated along the ray
+    num_columns = dims[other[0]] * dims[other[1]]
+    first_above = np.clip(np.ceil(depth), 0, dims[axis]).astype(np.int64)
+    crossings = np.bincount((column[:, 0] * dims[other[1]] + column[:, 1]) * (dims[axis] + 1) + first_above,
+                            minlength=num_columns * (dims[axis] + 1)).reshape(num_columns, dims[axis] + 1)
+    below = np.cumsum(crossings[:, :-1], axis=1)
+    above = crossings.sum(1, keepdims=True) - below
+    votes = ((below & 1) + (above & 1)).astype(np.uint8).reshape(dims[other[0]], dims[other[1]], dims[axis])
+    return np.moveaxis(votes, 2, axis)
+
+
+def bake_occupancy_volume(vertices, faces, resolution=256, band=3.0, margin=0.05, surface_spacing=0.5):
+    '''
+    Signed distance volume of a mesh, quantized to int8 and clamped to a narrow band around the surface.
+    The sign comes from a vote of the ray parities along the 3 grid axes in both directions (inside when at least 4
+    of the 6 rays agree), which also closes small holes of non-watertight scans. The corners of the cells the surface
+    passes through get the distance to the tangent plane at the nearest of a dense set of surface samples, so
+    trilinear lookups place the surface between the grid points; the other grid points are clamped to the band.
+    :param resolution: grid points along the longest side of the bounding box
+    :param band: half width of the band, in voxels
+    :param surface_spacing: spacing of the surface samples, in voxels
+    :return: dict of sdf [X, Y, Z] int8 (negative inside, +-127 beyond the band), b_min (3,), voxel_size and band (in voxels)
+    '''
+    import trimesh
+
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    b_min, b_max = vertices.min(0), vertices.max(0)
+    pad = (b_max - b_min).max() * margin
+    b_min, b_max = b_min - pad, b_max + pad
+    voxel_size = (b_max - b_min).max() / (resolution - 1)
+    dims = np.ceil((b_max - b_min) / voxel_size).astype(np.int64) + 1
+
+    grid_verts = (vertices - b_min) / voxel_size
+    votes = sum(parity_votes(grid_verts, faces, dims, axis) for axis in range(3))
+    inside = votes >= 4
+
+    # every surface sample offers its tangent plane to the 8 corners of its cell; a corner keeps the plane of its nearest sample
+    mesh = trimesh.Trimesh(vertices=grid_verts, faces=faces, process=False)
+    samples, face_index = trimesh.sample.sample_surface(mesh, int(mesh.area / surface_spacing ** 2) + 1)
+    normals = mesh.face_normals[face_index]
+    cells = np.minimum(np.floor(samples).astype(np.int64), dims - 2)
+    corners = (cells[:, None, :] + np.array(list(np.ndindex(2, 2, 2)))[None]).reshape(-1, 3)
+    offsets = corners - np.repeat(samples, 8, axis=0)
+    corner_index = np.ravel_multi_index(corners.T, dims)
+    order = np.lexsort(((offsets ** 2).sum(1), corner_index))
+    first = order[np.r_[True, corner_index[order][1:] != corner_index[order][:-1]]]
+    distance = np.abs((offsets[first] * np.repeat(normals, 8, axis=0)[first]).sum(1))
+
+    sdf = np.full(dims, band, dtype=np.float32)
+    sdf.reshape(-1)[corner_index[first]] = np.minimum(distance, band)
+    sdf[inside] *= -1
+    return {'sdf': np.round(sdf / band * 127).astype(np.int8), 'b_min': b_min, 'voxel_size': voxel_size, 'band': band}
+
+
+def occupancy_volume_path(mesh_path):
+    return os.path.splitext(mesh_path)[0] + '_occupancy.npz'
+
+
+class OccupancyVolume(object):
+    '''
+    Baked volume of a mesh (bake_occupancy_volume) with vectorized trilinear lookups, in the mesh coordinates.
+    Points outside the volume are outside the mesh.
+    '''
+    def __init__(self, sdf, b_min, voxel_size, band):
+        self.sdf = sdf
+        self.b_min = np.asarray(b_min, dtype=np.float64)
+        self.voxel_size = float(voxel_size)
+        self.band = float(band)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as volume:
+            return OccupancyVolume(volume['sdf'], volume['b_min'], volume['voxel_size'], volume['band'])
+
+    def save(self, path):
+        np.savez_compressed(path, sdf=self.sdf, b_min=self.b_min, voxel_size=self.voxel_size, band=self.band)
+
+    def lookup(self, points):
+        '''
+        :param points: [N, 3] points
+        :return: [N] trilinearly interpolated signed distance (negative inside), in voxels
+        '''
+        dims = np.array(self.sdf.shape)
+        grid = (np.asarray(points, dtype=np.float64) - self.b_min) / self.voxel_size
+        valid = np.all((grid >= 0) & (grid <= dims - 1), axis=1)
+        grid = grid[valid]
+        base = np.minimum(np.floor(grid).astype(np.int64), dims - 2)
+        t = grid - base
+        values = np.zeros(len(grid))
+        for corner in np.ndindex(2, 2, 2):
+            weight = np.prod(np.where(np.array(corner), t, 1 - t), axis=1)
+            values += weight * self.sdf[base[:, 0] + corner[0], base[:, 1] + corner[1], base[:, 2] + corner[2]]
+        result = np.full(len(points), self.band)
+        result[valid] = values * (self.band / 127)
+        return result
+
+    def contains(self, points):
+        '''
+        Inside test, as trimesh.Trimesh.contains
+        '''
+        return self.lookup(points) < 0
+
+    def signed_distance(self, points):
+        '''
+        Signed distance clamped to the band, in mesh units, with the sign of trimesh.proximity.signed_distance
+        (positive inside)
+        '''
+        return -self.lookup(points) * self.voxel_size
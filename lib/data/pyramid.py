@@ -0,0 +1,18 @@
+import torch.nn.functional as F
+
+
+def pyramid_level(image, size):
+    '''
+    The size x size level of an image pyramid, with the nearest neighbour semantics of
+    F.interpolate(image[None], size=(size, size))[0].
+    Nearest neighbour downsampling by an integer factor k keeps every k-th pixel, so when size divides the image the
+    level is the strided slice image[..., ::k, ::k] of the full resolution: nothing is interpolated, and as the level
+    is a subset of the pixels it commutes with pointwise operations (masking, one-hot encoding), which can then run on
+    the smaller level.
+    :param image: [C, H, W] tensor
+    :return: [C, size, size] tensor (a contiguous copy, not a view of the full resolution)
+    '''
+    height, width = image.shape[-2:]
+    if height % size == 0 and width % size == 0:
+        return image[..., ::height // size, ::width // size].contiguous()
+    return F.interpolate(image[None], size=(size, size))[0]
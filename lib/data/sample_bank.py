@@ -0,0 +1,142 @@
+import os
+import json
+import zlib
+import multiprocessing
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+def sampling_settings(opt, use_dos):
+    '''
+    The options that select_sampling_method depends on; a bank drawn with other settings is not used
+    '''
+    settings = {'useDOS': bool(use_dos), 'num_sample_inout': int(opt.num_sample_inout),
+                'sigma_low_resolution_pifu': float(opt.sigma_low_resolution_pifu),
+                'use_occupancy_volumes': bool(getattr(opt, 'use_occupancy_volumes', False)),
+                'ray_caster': str(getattr(opt, 'ray_caster', 'trimesh'))}
+    if use_dos:
+        settings['ratio_of_way_inside_points'] = float(opt.ratio_of_way_inside_points)
+        settings['ratio_of_outside_points'] = float(opt.ratio_of_outside_points)
+    return settings
+
+
+def shard_paths(bank_dir, subject, use_dos):
+    '''
+    A subject's shard: [num_yaws, num_draws, 4, max_points] float32 points (xyz) and labels, and its index
+    '''
+    shard_dir = os.path.join(bank_dir, 'dos' if use_dos else 'spatial')
+    return os.path.join(shard_dir, subject + '.npy'), os.path.join(shard_dir, subject + '.json')
+
+
+def subject_yaws(dataset, subject):
+    return sorted(int(os.path.splitext(os.path.basename(f))[0].split('_')[-1]) for f in dataset.img_files if f.split('/')[-2] == subject)
+
+
+class SampleBank(object):
+    '''
+    Occupancy samples drawn offline by build_sample_bank: num_draws independent draws of select_sampling_method per
+    subject and yaw. The shards are memory-mapped when a subject is first used in a process.
+    '''
+    def __init__(self, bank_dir, opt, use_dos):
+        self.bank_dir = bank_dir
+        self.use_dos = use_dos
+        self.settings = sampling_settings(opt, use_dos)
+        self.shards = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['shards'] = {} # reopened by the workers
+        return state
+
+    def open_shard(self, subject):
+        if subject not in self.shards:
+            samples_path, index_path = shard_paths(self.bank_dir, subject, self.use_dos)
+            if not os.path.exists(index_path):
+                raise IOError('No sample bank for subject {0} in {1}, run apps/build_sample_bank.py'.format(subject, self.bank_dir))
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if index['settings'] != self.settings:
+                raise ValueError('The sample bank of subject {0} was drawn with {1}, not {2}'.format(subject, index['settings'], self.settings))
+            samples = np.load(samples_path, mmap_mode='r')
+            self.shards[subject] = ({yaw: i for i, yaw in enumerate(index['yaws'])}, np.array(index['counts']), samples)
+        return self.shards[subject]
+
+    def draw(self, subject, yaw):
+        '''
+        One of the pre-drawn sets of the view, at random
+        :return: dict of samples_low_res_pifu [3, N] and labels_low_res_pifu [1, N] tensors, as select_sampling_method
+        '''
+        yaw_index, counts, samples = self.open_shard(subject)
+        i = yaw_index[yaw]
+        k = np.random.randint(counts.shape[1])
+        drawn = np.array(samples[i, k, :, :counts[i, k]])
+        return {
+            'samples_low_res_pifu': torch.Tensor(drawn[:3]).float(),
+            'labels_low_res_pifu': torch.Tensor(drawn[3:]).float()
+            }
+
+
+build_dataset = None # inherited by the forked builder processes
+
+
+def build_subject_shard(args):
+    '''
+    Draw and write the shard of one subject
+    '''
+    bank_dir, subject, num_draws, use_dos, seed = args
+    dataset = build_dataset
+    np.random.seed((seed + zlib.crc32(subject.encode('utf-8')) + int(use_dos)) % 2 ** 32)
+
+    yaws = subject_yaws(dataset, subject)
+    draws = []
+    for yaw in yaws:
+        _, _, b_min, b_max, R, _ = dataset.get_calib(subject, yaw)
+        for _ in range(num_draws):
+            sample_data = dataset.select_sampling_method(subject, None, b_min = b_min, b_max = b_max, R = R, use_dos = use_dos)
+            draws.append(torch.cat([sample_data['samples_low_res_pifu'], sample_data['labels_low_res_pifu']], 0).numpy())
+
+    counts = np.array([draw.shape[1] for draw in draws]).reshape(len(yaws), num_draws)
+    samples_path, index_path = shard_paths(bank_dir, subject, use_dos)
+    samples = np.lib.format.open_memmap(samples_path + '.tmp', mode='w+', dtype=np.float32, shape=(len(yaws), num_draws, 4, int(counts.max())))
+    for j, draw in enumerate(draws):
+        samples[j // num_draws, j % num_draws, :, :draw.shape[1]] = draw
+    samples.flush()
+    del samples
+    os.replace(samples_path + '.tmp', samples_path)
+    with open(index_path, 'w') as f:
+        json.dump({'yaws': yaws, 'counts': counts.tolist(), 'settings': sampling_settings(dataset.opt, use_dos)}, f)
+    return subject
+
+
+def build_sample_bank(dataset, bank_dir, num_draws=8, use_dos_modes=[False, True], num_workers=None, seed=0, overwrite=False):
+    '''
+    Draw the occupancy samples of every subject and view of a TrainDataset offline, num_draws times per sampling
+    mode, in parallel over the subjects. Subjects whose shard already has the settings of the dataset are skipped
+    unless overwrite is set.
+    '''
+    global build_dataset
+    build_dataset = dataset
+    tasks = []
+    for use_dos in use_dos_modes:
+        os.makedirs(os.path.dirname(shard_paths(bank_dir, '', use_dos)[0]), exist_ok=True)
+        for subject in dataset.subjects:
+            index_path = shard_paths(bank_dir, subject, use_dos)[1]
+            if not overwrite and os.path.exists(index_path):
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+                if index['settings'] == sampling_settings(dataset.opt, use_dos) and len(index['counts'][0]) == num_draws:
+                    continue
+            tasks.append((bank_dir, subject, num_draws, use_dos, seed))
+
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if num_workers <= 1:
+        for task in tqdm(tasks):
+            build_subject_shard(task)
+    else:
+        with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+            for _ in tqdm(pool.imap_unordered(build_subject_shard, tasks), total=len(tasks)):
+                pass
+    build_dataset = None
@@ -0,0 +1,160 @@
+import os
+import json
+import multiprocessing
+
+import numpy as np
+from tqdm import tqdm
+
+from .sample_bank import subject_yaws
+
+
+def record_settings(opt):
+    '''
+    The options that decide what the views hold (sources of the maps and the inputs in use); records packed with
+    other settings are not used
+    '''
+    settings = {'use_groundtruth_normal_maps': bool(opt.use_groundtruth_normal_maps),
+                'use_depth_map': bool(opt.use_depth_map),
+                'use_human_parse_maps': bool(opt.use_human_parse_maps)}
+    if settings['use_depth_map']:
+        settings['useGTdepthmap'] = bool(opt.useGTdepthmap)
+        if settings['useGTdepthmap']:
+            settings['resolution'] = int(opt.resolution) # the ground truth depth maps are normalized with it
+    if settings['use_human_parse_maps']:
+        settings['use_groundtruth_human_parse_maps'] = bool(opt.use_groundtruth_human_parse_maps)
+    return settings
+
+
+def parse_scale(settings):
+    # the ground truth parse maps hold the labels 0.5, 0.6, ..., 1.0, stored as tenths
+    return 10 if settings['use_groundtruth_human_parse_maps'] else 1
+
+
+def view_record_dtype(size, settings):
+    '''
+    Fixed layout of a view: uint8 render and mask, float16 normal and depth maps, uint8 parse labels and the float64
+    camera params (so that the calibration is exactly the one of the rendered_params files)
+    '''
+    fields = [('rgb', np.uint8, (size, size, 3)), ('mask', np.uint8, (size, size)),
+              ('nmlF', np.float16, (3, size, size)), ('nmlB', np.float16, (3, size, size))]
+    if settings['use_depth_map']:
+        fields.append(('depth', np.float16, (1, size, size)))
+    if settings['use_human_parse_maps']:
+        fields.append(('parse', np.uint8, (size, size)))
+    fields += [('center', np.float64, (3,)), ('R', np.float64, (3, 3)), ('scale_factor', np.float64)]
+    return np.dtype(fields)
+
+
+def record_paths(record_dir, subject):
+    '''
+    A subject's record: [num_yaws] views of view_record_dtype, and its index
+    '''
+    return os.path.join(record_dir, subject + '.npy'), os.path.join(record_dir, subject + '.json')
+
+
+class ViewRecords(object):
+    '''
+    The inputs of every view of a subject packed by pack_view_records into one memory-mapped file, so that a view is
+    read as one contiguous slice without decoding PNG/EXR files or unpickling the camera params. The records are
+    opened when a subject is first used in a process.
+    '''
+    def __init__(self, record_dir, opt):
+        self.record_dir = record_dir
+        self.settings = record_settings(opt)
+        self.records = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['records'] = {} # reopened by the workers
+        return state
+
+    def open_record(self, subject):
+        if subject not in self.records:
+            record_path, index_path = record_paths(self.record_dir, subject)
+            if not os.path.exists(index_path):
+                raise IOError('No view record for subject {0} in {1}, run apps/pack_view_records.py'.format(subject, self.record_dir))
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if index['settings'] != self.settings:
+                raise ValueError('The view record of subject {0} was packed with {1}, not {2}'.format(subject, index['settings'], self.settings))
+            self.records[subject] = ({yaw: i for i, yaw in enumerate(index['yaws'])}, np.load(record_path, mmap_mode='r'))
+        return self.records[subject]
+
+    def read(self, subject, yaw):
+        '''
+        :return: dict of the arrays of TrainDataset.load_view_from_files (the maps as float32)
+        '''
+        yaw_index, records = self.open_record(subject)
+        record = records[yaw_index[yaw]]
+        view = {'rgb': np.array(record['rgb']), 'mask': np.array(record['mask']),
+                'nmlF': record['nmlF'].astype(np.float32), 'nmlB': record['nmlB'].astype(np.float32),
+                'depth': None, 'parse': None,
+                'center': np.array(record['center']), 'R': np.array(record['R']), 'scale_factor': float(record['scale_factor'])}
+        if self.settings['use_depth_map']:
+            view['depth'] = record['depth'].astype(np.float32) + 1 # stored centered on 0, where float16 is more precise
+        if self.settings['use_human_parse_maps']:
+            view['parse'] = record['parse'].astype(np.float32) / parse_scale(self.settings)
+        return view
+
+
+pack_dataset = None # inherited by the forked packer processes
+
+
+def pack_subject(args):
+    '''
+    Read the files of every view of a subject and write its record
+    '''
+    record_dir, subject = args
+    dataset = pack_dataset
+    settings = record_settings(dataset.opt)
+    yaws = subject_yaws(dataset, subject)
+
+    record_path, index_path = record_paths(record_dir, subject)
+    records = None
+    for i, yaw in enumerate(yaws):
+        view = dataset.load_view_from_files(subject, yaw)
+        if records is None:
+            dtype = view_record_dtype(view['mask'].shape[0], settings)
+            records = np.lib.format.open_memmap(record_path + '.tmp', mode='w+', dtype=dtype, shape=(len(yaws),))
+        record = records[i:i + 1]
+        for name in ['rgb', 'mask', 'nmlF', 'nmlB', 'center', 'R', 'scale_factor']:
+            record[name] = view[name]
+        if settings['use_depth_map']:
+            record['depth'] = np.asarray(view['depth'], dtype=np.float32) - 1
+        if settings['use_human_parse_maps']:
+            record['parse'] = np.round(np.asarray(view['parse']) * parse_scale(settings))
+    records.flush()
+    del records
+    os.replace(record_path + '.tmp', record_path)
+    with open(index_path, 'w') as f:
+        json.dump({'yaws': yaws, 'settings': settings}, f)
+    return subject
+
+
+def pack_view_records(dataset, record_dir, num_workers=None, overwrite=False):
+    '''
+    Pack the views of every subject of a TrainDataset into records, in parallel over the subjects. Subjects whose
+    record already has the settings of the dataset are skipped unless overwrite is set.
+    '''
+    global pack_dataset
+    pack_dataset = dataset
+    os.makedirs(record_dir, exist_ok=True)
+    tasks = []
+    for subject in dataset.subjects:
+        index_path = record_paths(record_dir, subject)[1]
+        if not overwrite and os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                if json.load(f)['settings'] == record_settings(dataset.opt):
+                    continue
+        tasks.append((record_dir, subject))
+
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if num_workers <= 1:
+        for task in tqdm(tasks):
+            pack_subject(task)
+    else:
+        with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+            for _ in tqdm(pool.imap_unordered(pack_subject, tasks), total=len(tasks)):
+                pass
+    pack_dataset = None
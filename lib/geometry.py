@@ -37,6 +37,27 @@ def index(feat, uv):
     samples = torch.nn.functional.grid_sample(feat, uv, align_corners=True)
     return samples[:, :, :, 0]
 
+def index_aligned(feat, uv, eps=1e-4):
+    '''
+    same as index, but when every uv lands on a pixel center the bilinear lookup collapses to a gather
+    args:
+        feat: [B, C, H, W] image features
+        uv: [B, 2, N] normalized image coordinates ranged in [-1, 1]
+        eps: largest distance to a pixel center (in pixels) that still counts as aligned
+    return:
+        [B, C, N] sampled pixel values
+    '''
+    B, C, H, W = feat.shape
+    size = torch.tensor([W - 1, H - 1], dtype=uv.dtype, device=uv.device).view(1, 2, 1)
+    pix = (uv + 1) * 0.5 * size # pixel centers are at the ends of [-1, 1] (align_corners=True)
+    pix_rounded = torch.round(pix)
+    aligned = ((pix - pix_rounded).abs() <= eps) & (pix_rounded >= 0) & (pix_rounded <= size)
+    if not bool(aligned.all()):
+        return index(feat, uv)
+    pix_rounded = pix_rounded.long()
+    flat = pix_rounded[:, 1, :] * W + pix_rounded[:, 0, :] # [B, N]
+    return torch.gather(feat.reshape(B, C, H * W), 2, flat.unsqueeze(1).expand(B, C, flat.shape[1]))
+
 def orthogonal(points, calib, transform=None):
     '''
     project points onto screen space using orthogonal projection
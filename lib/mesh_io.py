@@ -0,0 +1,308 @@
+import os
+import re
+import json
+import numpy as np
+
+
+CACHE_SUFFIX = '.cache.npz'
+MESH_STORE_VERSION = 2 # 2: meshes are stored as processed by trimesh.load
+
+
+KEYWORDS = {'v': b'v', 'vn': b'vn', 'vt': b'vt', 'f': b'f'}
+
+
+class ObjBuffer(object):
+    '''
+    The bytes of an OBJ file with its lines classified by keyword, so that the records of one kind are gathered and
+    parsed by NumPy in one go instead of line by line.
+    '''
+    def __init__(self, data):
+        self.chars = np.full(len(data) + 3, 10, dtype=np.uint8) # padded so that the keyword bytes of the last line exist
+        self.chars[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        ends = np.append(np.flatnonzero(self.chars[:len(data)] == 10) + 1, len(data)) # a line owns its newline
+        self.starts = np.append(0, ends[:-1])
+        self.lengths = ends - self.starts
+        if np.any((self.chars[self.starts] == 32) | (self.chars[self.starts] == 9)):
+            self.__init__(re.sub(rb'(?m)^[ \t]+', b'', data)) # indented records
+
+    def select(self, keyword):
+        '''
+        The lines of the keyword without it, concatenated, and the start of each of them in the result (once per keyword:
+        the keyword is blanked in place)
+        '''
+        chars = self.chars
+        first, second, third = chars[self.starts], chars[self.starts + 1], chars[self.starts + 2]
+        if len(keyword) == 1:
+            lines = (first == keyword[0]) & (second <= 32) & (second != 10)
+        else:
+            lines = (first == keyword[0]) & (second == keyword[1]) & (third <= 32) & (third != 10)
+        lines &= self.lengths > len(keyword)
+        # blank the keyword so that only the values remain on the lines
+        for i in range(len(keyword)):
+            chars[self.starts[lines] + i] = 32
+        buffer = chars[:len(chars) - 3][np.repeat(lines, self.lengths)]
+        lengths = self.lengths[lines]
+        return buffer, np.cumsum(lengths) - lengths
+
+
+def count_per_line(flags, line_starts):
+    positions = np.flatnonzero(flags)
+    return np.diff(np.searchsorted(positions, np.append(line_starts, len(flags))))
+
+
+def token_starts(buffer):
+    is_token = buffer > 32
+    starts = is_token.copy()
+    starts[1:] &= ~is_token[:-1]
+    return starts
+
+
+def parse_values(obj, keyword, num_values):
+    '''
+    First num_values numbers of each keyword line (v, vn, vt) as a [N, num_values] float64 array
+    '''
+    buffer, line_starts = obj.select(keyword)
+    if len(line_starts) == 0:
+        return np.zeros((0, num_values), dtype=np.float64)
+    values = np.fromstring(buffer.tobytes(), dtype=np.float64, sep=' ')
+    if len(values) == len(line_starts) * num_values:
+        return values.reshape(-1, num_values)
+    # more values on some lines (e.g. vertex colors)
+    counts = count_per_line(token_starts(buffer), line_starts)
+    starts = np.cumsum(counts) - counts
+    return values[starts[:, None] + np.arange(num_values)]
+
+
+def parse_faces(obj):
+    '''
+    Corner indices of the OBJ face records, as load_obj_mesh reads them: a polygon gives the triangle of its first three
+    corners and, from four corners on, the triangle of corners 3, 4 and 1.
+    :return: [F, 3, 3] int64 (vertex, uv, normal) 1-based indices, 0 where a component is missing
+    '''
+    buffer, line_starts = obj.select(KEYWORDS['f'])
+    if len(line_starts) == 0:
+        return np.zeros((0, 3, 3), dtype=np.int64)
+    counts = count_per_line(token_starts(buffer), line_starts)
+    slashes = count_per_line(buffer == 47, line_starts) # b'/'
+    num_slashes = slashes[0] // max(counts[0], 1)
+
+    # every corner becomes v/vt/vn, so the components of all the corners parse as one array
+    num_tokens = int(counts.sum())
+    corners = np.zeros((num_tokens, 3), dtype=np.int64)
+    data = buffer.tobytes()
+    if np.array_equal(slashes, counts * num_slashes) and num_slashes <= 2:
+        components = np.fromstring(data.replace(b'//', b'/0/').replace(b'/', b' '), dtype=np.int64, sep=' ')
+        corners[:, :num_slashes + 1] = components.reshape(num_tokens, num_slashes + 1)
+    else:
+        # mixed index forms in one file
+        for i, corner in enumerate(data.split()):
+            components = [int(c) if c else 0 for c in corner.split(b'/')]
+            corners[i, :len(components)] = components
+
+    starts = np.cumsum(counts) - counts
+    faces_per_line = np.where(counts > 3, 2, 1)
+    line = np.repeat(np.arange(len(counts)), faces_per_line)
+    second = np.arange(len(line)) - np.repeat(np.cumsum(faces_per_line) - faces_per_line, faces_per_line) # 1 for the second triangle of a quad
+    offsets = np.where(second[:, None] == 1, np.array([2, 3, 0]), np.array([0, 1, 2]))
+    return corners[starts[line][:, None] + offsets]
+
+
+def parse_obj(mesh_file):
+    '''
+    Parse an OBJ file on the whole buffer at once instead of line by line.
+    :param mesh_file: path or file object
+    :return: dict of vertices [N, 3], faces [F, 3], normals, face_normals, uvs and face_uvs (empty when the file has none)
+    '''
+    if isinstance(mesh_file, str):
+        with open(mesh_file, 'rb') as f:
+            data = f.read()
+    else:
+        data = mesh_file.read()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+    obj = ObjBuffer(data)
+    corners = parse_faces(obj)
+    mesh = {'vertices': parse_values(obj, KEYWORDS['v'], 3),
+            'normals': parse_values(obj, KEYWORDS['vn'], 3),
+            'uvs': parse_values(obj, KEYWORDS['vt'], 2),
+            'faces': corners[:, :, 0] - 1}
+    # faces without uv or normal indices have none
+    mesh['face_uvs'] = corners[:, :, 1] - 1 if np.all(corners[:, :, 1] > 0) and len(corners) else np.zeros((0, 3), dtype=np.int64)
+    mesh['face_normals'] = corners[:, :, 2] - 1 if np.all(corners[:, :, 2] > 0) and len(corners) else np.zeros((0, 3), dtype=np.int64)
+    return mesh
+
+
+def load_obj_arrays(mesh_file, use_cache=True):
+    '''
+    parse_obj with a side-car cache: the arrays are stored next to the OBJ file (mesh_file + CACHE_SUFFIX), keyed by
+    its modification time and size, and reused while the file is unchanged.
+    A cache that cannot be written (e.g. read-only dataset) is skipped.
+    '''
+    if not (use_cache and isinstance(mesh_file, str)):
+        return parse_obj(mesh_file)
+
+    stat = os.stat(mesh_file)
+    key = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+    cache_file = mesh_file + CACHE_SUFFIX
+    if os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as cache:
+                if np.array_equal(cache['key'], key):
+                    return {name: cache[name] for name in cache.files if name != 'key'}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    mesh = parse_obj(mesh_file)
+    try:
+        tmp_file = cache_file + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmp_file, key=key, **mesh)
+        os.replace(tmp_file, cache_file) # concurrent loaders never see a partial cache
+    except OSError:
+        pass
+    return mesh
+
+
+def load_obj_mesh(mesh_file, with_normal=False, with_texture=False, use_cache=True):
+    '''
+    Drop-in for the load_obj_mesh of the rendering scripts
+    :return: vertices, faces (then normals, face_normals with with_normal and uvs, face_uvs with with_texture)
+    '''
+    mesh = load_obj_arrays(mesh_file, use_cache=use_cache)
+    result = [mesh['vertices'], mesh['faces']]
+    if with_normal:
+        norms = mesh['normals']
+        norms = norms / np.maximum(np.linalg.norm(norms, axis=1, keepdims=True), 1e-8)
+        result += [norms, mesh['face_normals']]
+    if with_texture:
+        result += [mesh['uvs'], mesh['face_uvs']]
+    return tuple(result)
+
+
+class MeshStore(object):
+    '''
+    Meshes of many subjects packed into one directory: vertices.f32 ([N, 3] float32) and faces.i32 ([F, 3] int32) hold
+    the concatenated arrays, index.json the vertex and face ranges of each subject and the sources they were built from.
+    The arrays are opened with np.memmap, so the DataLoader workers share their pages, and a subject's
+    trimesh.Trimesh is only constructed (from views of the arrays) the first time it is used in a process.
+    The BVHs of lib.ray_caster are cached in the bvh subdirectory and memory-mapped the same way.
+    Pickling the store (spawned workers) only sends the directory.
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'index.json'), 'r') as f:
+            self.index = json.load(f)
+        num_verts = sum(entry['num_verts'] for entry in self.index['subjects'].values())
+        num_faces = sum(entry['num_faces'] for entry in self.index['subjects'].values())
+        # np.memmap cannot map an empty file
+        self.vertices = np.memmap(os.path.join(store_dir, 'vertices.f32'), dtype=np.float32, mode='r', shape=(num_verts, 3)) \
+            if num_verts else np.zeros((0, 3), dtype=np.float32)
+        self.faces = np.memmap(os.path.join(store_dir, 'faces.i32'), dtype=np.int32, mode='r', shape=(num_faces, 3)) \
+            if num_faces else np.zeros((0, 3), dtype=np.int32)
+        self.meshes = {}
+        self.ray_casters = {}
+
+    def __getstate__(self):
+        return {'store_dir': self.store_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['store_dir'])
+
+    def __len__(self):
+        return len(self.index['subjects'])
+
+    def __contains__(self, subject):
+        return subject in self.index['subjects']
+
+    def keys(self):
+        return self.index['subjects'].keys()
+
+    def arrays(self, subject):
+        '''
+        :return: [N, 3] float32 vertices and [F, 3] int32 faces of the subject (read-only views of the store)
+        '''
+        entry = self.index['subjects'][subject]
+        return (self.vertices[entry['vertex_offset']:entry['vertex_offset'] + entry['num_verts']],
+                self.faces[entry['face_offset']:entry['face_offset'] + entry['num_faces']])
+
+    def __getitem__(self, subject):
+        '''
+        trimesh.Trimesh of the subject, kept for the later calls of this process (so are its ray and proximity
+        structures). trimesh converts the views to its own float64/int64 arrays when the mesh is constructed.
+        The store holds the meshes as processed by trimesh.load (see build_mesh_store), so they are not processed again.
+        '''
+        if subject not in self.meshes:
+            import trimesh
+            vertices, faces = self.arrays(subject)
+            self.meshes[subject] = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+        return self.meshes[subject]
+
+    def ray_caster(self, subject):
+        '''
+        lib.ray_caster.BVH of the subject, built into the store the first time it is needed (and again when the
+        subject's mesh changed)
+        '''
+        if subject not in self.ray_casters:
+            from .ray_caster import load_or_build_bvh
+            vertices, faces = self.arrays(subject)
+            self.ray_casters[subject] = load_or_build_bvh(vertices, faces, bvh_dir=os.path.join(self.store_dir, 'bvh', subject),
+                                                          key=[MESH_STORE_VERSION] + self.index['subjects'][subject]['source'])
+        return self.ray_casters[subject]
+
+
+def mesh_source_key(mesh_path):
+    stat = os.stat(mesh_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def build_mesh_store(store_dir, mesh_paths):
+    '''
+    Pack meshes into a MeshStore directory. The arrays are written to temporary files and the index last, so a
+    store is never read half-written. Every mesh goes through trimesh.load, as the datasets loaded them before the store.
+    :param mesh_paths: dict of subject: mesh file
+    '''
+    import trimesh
+    os.makedirs(store_dir, exist_ok=True)
+    subjects = {}
+    num_verts, num_faces = 0, 0
+    suffix = '.%d.tmp' % os.getpid()
+    with open(os.path.join(store_dir, 'vertices.f32' + suffix), 'wb') as vertex_file, \
+         open(os.path.join(store_dir, 'faces.i32' + suffix), 'wb') as face_file:
+        for subject in sorted(mesh_paths):
+            mesh_path = mesh_paths[subject]
+            # not the OBJ loader: trimesh.load keeps the vertices of texture seams apart when it merges them
+            mesh = trimesh.load(mesh_path, force='mesh')
+            vertices, faces = mesh.vertices, mesh.faces
+            vertex_file.write(np.ascontiguousarray(vertices, dtype=np.float32).tobytes())
+            face_file.write(np.ascontiguousarray(faces, dtype=np.int32).tobytes())
+            subjects[subject] = {'path': mesh_path, 'source': mesh_source_key(mesh_path),
+                                 'vertex_offset': num_verts, 'num_verts': len(vertices),
+                                 'face_offset': num_faces, 'num_faces': len(faces)}
+            num_verts += len(vertices)
+            num_faces += len(faces)
+
+    for name in ['vertices.f32', 'faces.i32']:
+        os.replace(os.path.join(store_dir, name + suffix), os.path.join(store_dir, name))
+    with open(os.path.join(store_dir, 'index.json' + suffix), 'w') as f:
+        json.dump({'version': MESH_STORE_VERSION, 'subjects': subjects}, f)
+    os.replace(os.path.join(store_dir, 'index.json' + suffix), os.path.join(store_dir, 'index.json'))
+
+
+def open_mesh_store(store_dir, mesh_paths):
+    '''
+    MeshStore of the meshes, (re)built when it is missing, has another format version, lacks one of them or one of
+    their files changed since.
+    :param mesh_paths: dict of subject: mesh file
+    '''
+    index_path = os.path.join(store_dir, 'index.json')
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        subjects = index['subjects']
+        if index.get('version') == MESH_STORE_VERSION and all(subject in subjects and subjects[subject]['path'] == mesh_path and subjects[subject]['source'] == mesh_source_key(mesh_path)
+               for subject, mesh_path in mesh_paths.items()):
+            return MeshStore(store_dir)
+        # keep the subjects of the other datasets sharing the store
+        mesh_paths = dict({subject: entry['path'] for subject, entry in subjects.items() if os.path.exists(entry['path'])}, **mesh_paths)
+    build_mesh_store(store_dir, mesh_paths)
+    return MeshStore(store_dir)
@@ -22,16 +22,29 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 from skimage import measure
+import os
+import itertools
+import threading
+import json
+import struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import torch
-from .sdf import create_grid, eval_grid_octree, eval_grid
+from .sdf import create_grid_coords, batch_eval, eval_grid_octree, eval_grid, eval_grid_tensor, eval_grid_columns, column_axis, BatchedQuery, ChunkSizer, estimate_bytes_per_point, occupancy_scale
+from .octree import eval_grid_octree_sparse, eval_grid_narrow_band
+from .visual_hull import VisualHull, DepthInterval
 from skimage import measure
 
 from numpy.linalg import inv
 
 def reconstruction(net, cuda, calib_tensor,
                    resolution, thresh=0.5,
-                   use_octree=False, num_samples=10000, transform=None, b_min = np.array([-1,-1,-1]), b_max = np.array([1,1,1]) ):
+                   use_octree=False, num_samples=10000, transform=None, b_min = np.array([-1,-1,-1]), b_max = np.array([1,1,1]),
+                   use_sparse_octree=False, use_narrow_band=False, narrow_band=1, memory_budget=None, num_mc_workers=1,
+                   use_streaming=False, slab_size=32, occupancy_dtype=np.float32, mask=None,
+                   depth_map=None, back_depth_map=None, depth_margin=4, use_column_features=False,
+                   refine_steps=0, refine_tolerance=1e-3, normal_mode=None, verbose=False ):
     
     
     '''
@@ -44,41 +57,492 @@ def reconstruction(net, cuda, calib_tensor,
     :param b_max: bounding box corner [x_max, y_max, z_max]
     :param use_octree: whether to use octree acceleration
     :param num_samples: how many points to query each gpu iteration
+    :param use_sparse_octree: evaluate with the sparse octree, which never allocates the full grid
+    :param use_narrow_band: only refine the cells that straddle the surface, plus narrow_band cells around them.
+        Off by default: it only saves queries over use_octree from about 256^3 on (see eval_grid_narrow_band)
+    :param narrow_band: number of cells around the surface that are refined in narrow-band mode
+    :param memory_budget: bytes that one query chunk may use. When given, it replaces num_samples and the chunk size adapts at runtime
+    :param num_mc_workers: number of processes that run marching cubes on blocks of the volume (1 runs it serially on the whole volume)
+    :param use_streaming: evaluate the dense grid slab by slab and mesh each slab in the background (see reconstruction_streaming).
+        The volume is not kept, so it cannot be combined with refine_steps
+    :param slab_size: number of grid planes per slab in streaming mode
+    :param occupancy_dtype: storage of the dense volume: np.float32, np.float16 or np.uint8 (quantized to 1/255).
+        The sparse octree and narrow-band grids always store float32
+    :param mask: [H, W] silhouette of the view of calib_tensor (orthogonal projection). When given, the bounding box
+        is tightened to the visual hull (the grid keeps its resolution) and points outside the silhouette are not queried
+    :param depth_map: [H, W] front depth map of the view (normalized as in TrainDataset). When given, only the points
+        inside the z-interval of their pixel are queried, and the points in front of it are set to outside
+    :param back_depth_map: optional [H, W] depth map of the far side that closes the interval at the back
+    :param depth_margin: slack on both ends of the z-interval, in grid cells
+    :param use_column_features: evaluate the dense grid column by column with net.query_columns, which samples the image
+        features once per column. Only used without octree, streaming and culling, and when the view direction is a grid axis
+    :param refine_steps: when > 0, the marching cubes vertices are moved onto the 0.5 level of the network with up to
+        refine_steps queries each, along their grid edge (see refine_surface)
+    :param refine_tolerance: occupancy error at which a vertex stops refining
+    :param normal_mode: None keeps the marching cubes normals (grid index space). 'autograd' or 'central' replaces
+        them with the normals of the network at the vertices, in bounding box space (see vertex_normals)
+    :param verbose: print the reports of the chunk sizer, the visual hull, the depth interval and the surface refinement
     :return: marching cubes results.
     '''
+    if use_streaming and refine_steps > 0 and not (use_octree or use_sparse_octree or use_narrow_band):
+        # the refinement reads the edge end values from the volume, which streaming drops slab by slab
+        raise ValueError('use_streaming cannot be combined with refine_steps')
 
-    coords, mat = create_grid(resolution, resolution, resolution, b_min=b_min, b_max=b_max)    
+    if mask is not None:
+        hull = VisualHull(calib_tensor[0].cpu().numpy(), mask.cpu().numpy() if torch.is_tensor(mask) else mask)
+        b_min, b_max = hull.bounds(b_min, b_max, padding=2 * np.max(np.asarray(b_max) - np.asarray(b_min)) / resolution)
+
+    coords = create_grid_coords(resolution, resolution, resolution, b_min=b_min, b_max=b_max) # lazy, coordinates are computed per chunk
+    mat = coords.coords_matrix
 
 
 
     # Then we define the lambda function for cell evaluation
     def eval_func(points):
-        points = np.expand_dims(points, axis=0)
-        points = np.repeat(points, 1, axis=0)  
-        samples = torch.from_numpy(points).to(device=cuda).float() 
-        
-        net.query(samples, calib_tensor)
-        pred = net.get_preds()[0][0]
+        samples = torch.from_numpy(points).float().to(device=cuda).unsqueeze(0)
+        with torch.inference_mode():
+            net.query(samples, calib_tensor)
+            pred = net.get_preds()[0][0]
+
+        return pred.cpu().numpy()
+
+    # the dense grid stays on the device: points are generated there and only the final volume is copied back
+    def eval_func_tensor(samples):
+        net.query(samples.unsqueeze(0), calib_tensor)
+        return net.get_preds()[0][0]
+
+    if mask is not None:
+        # columns outside the silhouette are empty: they are set to 0 without running the network
+        eval_func = hull.wrap(eval_func)
+        eval_func_tensor = hull.wrap(eval_func_tensor)
+
+    if depth_map is not None:
+        interval = create_depth_interval(calib_tensor[0], depth_map, back_depth_map, depth_margin, b_min, b_max, resolution)
+        eval_func = interval.wrap(eval_func)
+        eval_func_tensor = interval.wrap(eval_func_tensor)
+
+    if memory_budget is not None:
+        chunk_sizer = create_chunk_sizer(net, cuda, memory_budget)
+        eval_func = chunk_sizer.wrap(eval_func)
+        eval_func_tensor = chunk_sizer.wrap(eval_func_tensor)
+        num_samples = chunk_sizer.limit
 
-        return pred.detach().cpu().numpy()
     # Then we evaluate the grid
-    if use_octree:
-        sdf = eval_grid_octree(coords, eval_func, num_samples=num_samples) # shape of (256, 256, 256)
+    if use_octree or use_sparse_octree or use_narrow_band:
+        sdf = evaluate_grid(coords, eval_func, num_samples=num_samples, use_octree=use_octree,
+                            use_sparse_octree=use_sparse_octree, use_narrow_band=use_narrow_band, narrow_band=narrow_band,
+                            dtype=occupancy_dtype)
+    elif use_streaming:
+        # evaluation and marching cubes overlap, the full volume is never stored
+        sdf = None
+        result = surface_from_slabs(stream_surface_slabs(eval_func_tensor, resolution, mat, cuda, num_samples=num_samples, slab_size=slab_size), mat)
+    elif use_column_features and mask is None and depth_map is None and column_axis(calib_tensor[0].cpu().numpy(), mat) is not None:
+        with torch.inference_mode():
+            sdf = eval_grid_columns((resolution, resolution, resolution), mat, calib_tensor[0].cpu().numpy(), create_column_eval_func(net),
+                                    device=cuda, num_samples=num_samples, dtype=occupancy_dtype)
+        sdf = sdf.cpu().numpy()
     else:
-        sdf = eval_grid(coords, eval_func, num_samples=num_samples)
-
+        with torch.inference_mode():
+            sdf = eval_grid_tensor((resolution, resolution, resolution), mat, eval_func_tensor, device=cuda, num_samples=num_samples,
+                                   dtype=occupancy_dtype)
+        sdf = sdf.cpu().numpy()
 
+    if verbose and memory_budget is not None:
+        print(chunk_sizer.report())
+    if verbose and mask is not None:
+        print(hull.report())
+    if verbose and depth_map is not None:
+        print(interval.report())
 
     # Finally we do marching cubes
+    if sdf is not None:
+        result = extract_surface(sdf, mat, num_workers=num_mc_workers)
+    if refine_steps > 0 and result != -1:
+        result = refine_mesh(result, eval_func, mat, sdf, num_samples=num_samples, num_steps=refine_steps, tolerance=refine_tolerance,
+                             verbose=verbose)
+    if normal_mode is not None and result != -1:
+        verts, faces, _, values = result
+        result = verts, faces, vertex_normals(net, cuda, calib_tensor, [verts], normal_mode, num_samples)[0], values
+    return result
+
+
+def reconstruction_batch(net, cuda, calib_tensor,
+                         resolution, b_min, b_max, thresh=0.5,
+                         use_octree=False, num_samples=10000,
+                         use_sparse_octree=False, use_narrow_band=False, narrow_band=1, memory_budget=None, num_mc_workers=1,
+                         occupancy_dtype=np.float32, masks=None, depth_maps=None, back_depth_maps=None, depth_margin=4,
+                         use_column_features=False, refine_steps=0, refine_tolerance=1e-3, normal_mode=None, verbose=False ):
+    '''
+    Reconstruct one mesh per image of a batch that was filtered in one go.
+    Every image keeps its own octree / narrow-band state; their point chunks are gathered into a single
+    [B, 3, N] query, so the network runs at batch size B.
+    :param calib_tensor: [B, 4, 4] calibration tensor
+    :param b_min: [B, 3] bounding box corners
+    :param b_max: [B, 3] bounding box corners
+    :param memory_budget: bytes that one [B, 3, N] query may use (see reconstruction)
+    :param occupancy_dtype: storage of the dense volumes (see reconstruction)
+    :param masks: [B, H, W] silhouettes for visual hull culling (see mask in reconstruction)
+    :param depth_maps: [B, H, W] front depth maps for z-interval evaluation (see depth_map in reconstruction)
+    :param back_depth_maps: optional [B, H, W] back depth maps
+    :param use_column_features: sample the image features once per grid column on the dense path (see reconstruction)
+    :param refine_steps: queries per vertex of the surface refinement, which runs batched as well (see reconstruction)
+    :param refine_tolerance: occupancy error at which a vertex stops refining
+    :param normal_mode: None, 'autograd' or 'central' (see reconstruction)
+    :param verbose: print the reports of the chunk sizer, the visual hulls, the depth intervals and the surface refinement
+    (see reconstruction for the other arguments)
+    :return: list of B marching cubes results (-1 for the images that could not be meshed)
+    '''
+    num_items = calib_tensor.shape[0]
+    hulls = [None] * num_items
+    if masks is not None:
+        hulls = [VisualHull(calib_tensor[i].cpu().numpy(), masks[i].cpu().numpy() if torch.is_tensor(masks[i]) else masks[i]) for i in range(num_items)]
+        bounds = [hull.bounds(b_min[i], b_max[i], padding=2 * np.max(np.asarray(b_max[i]) - np.asarray(b_min[i])) / resolution)
+                  for i, hull in enumerate(hulls)]
+        b_min = [bound[0] for bound in bounds]
+        b_max = [bound[1] for bound in bounds]
+    coords_list = [create_grid_coords(resolution, resolution, resolution, b_min=b_min[i], b_max=b_max[i]) for i in range(num_items)]
+    mats = [coords.coords_matrix for coords in coords_list]
+    intervals = [None] * num_items
+    if depth_maps is not None:
+        intervals = [create_depth_interval(calib_tensor[i], depth_maps[i], None if back_depth_maps is None else back_depth_maps[i],
+                                           depth_margin, b_min[i], b_max[i], resolution) for i in range(num_items)]
+
+    def eval_func_tensor(samples):
+        net.query(samples, calib_tensor)
+        return net.get_preds()[:, 0]
+
+    def query_func(points):
+        samples = torch.from_numpy(points).float().to(device=cuda)
+        with torch.inference_mode():
+            net.query(samples, calib_tensor)
+            pred = net.get_preds()[:, 0]
+        return pred.cpu().numpy()
+
+    if memory_budget is not None:
+        chunk_sizer = create_chunk_sizer(net, cuda, memory_budget)
+        eval_func_tensor = chunk_sizer.wrap(eval_func_tensor)
+        query_func = chunk_sizer.wrap(query_func)
+        num_samples = max(chunk_sizer.limit // num_items, 1)
+
+    # with masks or depth maps the dense grids are evaluated per image as well, so each one skips its own culled points
+    if not (use_octree or use_sparse_octree or use_narrow_band or masks is not None or depth_maps is not None):
+        with torch.inference_mode():
+            if use_column_features and column_axis(calib_tensor.cpu().numpy(), np.stack(mats, 0)) is not None:
+                sdf = eval_grid_columns((resolution, resolution, resolution), np.stack(mats, 0), calib_tensor.cpu().numpy(), create_column_eval_func(net),
+                                        device=cuda, num_samples=num_samples, dtype=occupancy_dtype)
+            else:
+                sdf = eval_grid_tensor((resolution, resolution, resolution), np.stack(mats, 0), eval_func_tensor, device=cuda, num_samples=num_samples,
+                                       dtype=occupancy_dtype)
+        sdf = sdf.cpu().numpy()
+        if verbose and memory_budget is not None:
+            print(chunk_sizer.report())
+        results = [extract_surface(sdf[i], mats[i], num_workers=num_mc_workers) for i in range(num_items)]
+        if refine_steps > 0:
+            results = refine_mesh_batch(results, query_func, mats, sdf, num_samples, refine_steps, refine_tolerance, verbose=verbose)
+        return replace_normals(results, net, cuda, calib_tensor, normal_mode, num_samples)
+
+    batched_query = BatchedQuery(query_func, num_items)
+    results = [-1] * num_items
+    sdfs = [None] * num_items # kept for the refinement
+    errors = [None] * num_items
+
+    def run(i):
+        eval_func = batched_query.eval_func(i)
+        if hulls[i] is not None:
+            eval_func = hulls[i].wrap(eval_func)
+        if intervals[i] is not None:
+            eval_func = intervals[i].wrap(eval_func)
+        try:
+            sdf = evaluate_grid(coords_list[i], eval_func, num_samples=num_samples, use_octree=use_octree,
+                                use_sparse_octree=use_sparse_octree, use_narrow_band=use_narrow_band, narrow_band=narrow_band,
+                                dtype=occupancy_dtype)
+        except Exception as e:
+            errors[i] = e
+            return
+        finally:
+            batched_query.finish(i)
+        results[i] = extract_surface(sdf, mats[i], num_workers=num_mc_workers)
+        if refine_steps > 0:
+            sdfs[i] = sdf
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # raised in the caller, as reconstruction does for a single image
+    for error in errors:
+        if error is not None:
+            raise error
+    if verbose and memory_budget is not None:
+        print(chunk_sizer.report())
+    for hull in hulls + intervals:
+        if verbose and hull is not None:
+            print(hull.report())
+    if refine_steps > 0:
+        results = refine_mesh_batch(results, query_func, mats, sdfs, num_samples, refine_steps, refine_tolerance, verbose=verbose)
+    return replace_normals(results, net, cuda, calib_tensor, normal_mode, num_samples)
+
+
+def replace_normals(results, net, cuda, calib_tensor, normal_mode=None, num_samples=10000):
+    '''
+    Replace the normals of the marching cubes results of a batch by the network normals (see vertex_normals)
+    '''
+    valid = [i for i, result in enumerate(results) if result != -1]
+    if normal_mode is None or len(valid) == 0:
+        return results
+    # the items without a mesh are queried with no vertices, the batch still matches the filtered images
+    verts_list = [results[i][0] if i in valid else np.zeros((0, 3), dtype=np.float32) for i in range(len(results))]
+    normals = vertex_normals(net, cuda, calib_tensor, verts_list, normal_mode, num_samples)
+    results = list(results)
+    for i in valid:
+        verts, faces, _, values = results[i]
+        results[i] = verts, faces, normals[i], values
+    return results
+
+
+def refine_mesh(result, eval_func, mat, sdf=None, num_samples=10000, num_steps=4, tolerance=1e-3, verbose=False):
+    '''
+    Refine the vertices of a marching cubes result (see refine_surface), querying num_samples points at a time.
+    :param verbose: print the number of points queried
+    :return: marching cubes result with the refined vertices
+    '''
+    verts, faces, normals, values = result
+    verts, num_queries = refine_surface(verts, lambda points: batch_eval(points, eval_func, num_samples=num_samples), mat, sdf,
+                                        num_steps=num_steps, tolerance=tolerance)
+    if verbose:
+        print('surface refinement: {0} points queried for {1} vertices'.format(num_queries, len(verts)))
+    return verts, faces, normals, values
+
+
+def refine_mesh_batch(results, query_func, mats, sdfs, num_samples=10000, num_steps=4, tolerance=1e-3, verbose=False):
+    '''
+    Refine the meshes of a batch: the refinement of every item runs in its own thread and their queries are
+    gathered into [B, 3, N] calls of query_func (see BatchedQuery).
+    :param verbose: print the number of points queried for every mesh
+    :return: list of refined marching cubes results
+    '''
+    num_items = len(results)
+    batched_query = BatchedQuery(query_func, num_items)
+    results = list(results)
+    errors = [None] * num_items
+
+    def run(i):
+        try:
+            if results[i] != -1:
+                results[i] = refine_mesh(results[i], batched_query.eval_func(i), mats[i], sdfs[i], num_samples=num_samples,
+                                         num_steps=num_steps, tolerance=tolerance, verbose=verbose)
+        except Exception as e:
+            errors[i] = e
+        finally:
+            batched_query.finish(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # raised in the caller, as refine_mesh does for a single mesh
+    for i, error in enumerate(errors):
+        if error is not None:
+            print('error cannot refine mesh of item {0}'.format(i))
+            raise error
+    return results
+
+
+def vertex_normals(net, cuda, calib_tensor, verts_list, mode='autograd', num_samples=10000):
+    '''
+    Surface normals of the network at the vertices of the meshes of a filtered batch (see calc_vertex_normals).
+    The vertices of all items are sent as zero-padded [B, 3, n] chunks.
+    :param calib_tensor: [B, 4, 4] calibration tensor
+    :param verts_list: B arrays of [N_i, 3] vertices in bounding box space
+    :param mode: 'autograd' or 'central'
+    :return: list of B [N_i, 3] float32 normals
+    '''
+    num_items = len(verts_list)
+    normals = [np.zeros((len(verts), 3), dtype=np.float32) for verts in verts_list]
+    num_verts = max(len(verts) for verts in verts_list)
+    for start in range(0, num_verts, num_samples):
+        samples = torch.zeros(num_items, 3, min(num_samples, num_verts - start), device=cuda)
+        for i, verts in enumerate(verts_list):
+            chunk = verts[start:start + num_samples]
+            samples[i, :, :len(chunk)] = torch.from_numpy(chunk.T).float().to(device=cuda)
+        with torch.inference_mode(mode != 'autograd'):
+            nml = net.calc_vertex_normals(samples, calib_tensor, mode=mode).cpu().numpy()
+        for i, verts in enumerate(verts_list):
+            chunk = normals[i][start:start + num_samples]
+            chunk[:] = nml[i, :, :len(chunk)].T
+    return normals
+
+
+def create_depth_interval(calib, depth_map, back_depth_map, depth_margin, b_min, b_max, resolution):
+    '''
+    DepthInterval of one view, with the margin converted from grid cells to image space z units.
+    '''
+    calib = calib.cpu().numpy() if torch.is_tensor(calib) else np.asarray(calib)
+    calib = calib.reshape(-1, 4)
+    cell_size = np.max(np.asarray(b_max, dtype=np.float64) - np.asarray(b_min, dtype=np.float64)) / resolution
+    margin = depth_margin * cell_size * np.linalg.norm(calib[2, :3])
+    to_numpy = lambda x: x.cpu().numpy() if torch.is_tensor(x) else x
+    return DepthInterval(calib, to_numpy(depth_map), None if back_depth_map is None else to_numpy(back_depth_map), margin=margin)
+
+
+def create_column_eval_func(net):
+    '''
+    :return: eval_func of eval_grid_columns, which queries the columns with net.query_columns (filter must be called beforehand)
+    '''
+    def eval_func(xy, z):
+        return net.query_columns(xy, z)[:, 0].view(z.shape)
+    return eval_func
+
+
+def create_chunk_sizer(net, cuda, memory_budget):
+    '''
+    Chunk sizer for the queries of net, with the per-point cost estimated from its MLP options.
+    Call after filter, so the number of feature maps is known. On CUDA the estimate is refined
+    with the measured peak memory of the first chunks.
+    '''
+    opt = net.opt
+    bytes_per_point = estimate_bytes_per_point(opt.mlp_dim_low_res, opt.mlp_res_layers_low_res, opt.merge_layer_low_res,
+                                               num_feature_maps=max(len(net.im_feat_list), 1))
+    measure_func = None
+    reset_func = None
+    if torch.device(cuda).type == 'cuda':
+        baseline = [0]
+        def reset_func():
+            torch.cuda.reset_peak_memory_stats(cuda)
+            baseline[0] = torch.cuda.memory_allocated(cuda)
+        def measure_func():
+            return torch.cuda.max_memory_allocated(cuda) - baseline[0]
+    return ChunkSizer(memory_budget, bytes_per_point, measure_func=measure_func, reset_func=reset_func)
+
+
+def evaluate_grid(coords, eval_func, num_samples=10000, use_octree=False,
+                  use_sparse_octree=False, use_narrow_band=False, narrow_band=1, dtype=np.float32):
+    '''
+    Evaluate the grid with the selected evaluator.
+    :param coords: GridCoords of the grid
+    :param dtype: storage dtype of the dense volumes (see quantize_occupancy)
+    :return: a dense [res, res, res] volume, or a SparseOctreeGrid for the sparse evaluators
+    '''
+    resolution = coords.resolution[0]
+    mat = coords.coords_matrix
+    if use_narrow_band:
+        return eval_grid_narrow_band(resolution, mat, eval_func, level=0.5, band=narrow_band, num_samples=num_samples)
+    elif use_sparse_octree:
+        return eval_grid_octree_sparse(resolution, mat, eval_func, num_samples=num_samples)
+    elif use_octree:
+        return eval_grid_octree(coords, eval_func, num_samples=num_samples, dtype=dtype) # shape of (256, 256, 256)
+    else:
+        return eval_grid(coords, eval_func, num_samples=num_samples, dtype=dtype)
+
+
+def reconstruction_streaming(net, cuda, calib_tensor, resolution, b_min, b_max,
+                             num_samples=10000, slab_size=32, on_slab=None):
+    '''
+    Reconstruct the mesh of a dense grid that is evaluated slab by slab along the first grid axis.
+    Each finished slab, together with the last plane of the previous one, is meshed by a background worker
+    while the next slab is queried, so only a few slabs are held in memory.
+    :param on_slab: called with (verts, faces) of every slab in bounding box space as soon as it is meshed.
+        The slab meshes are not welded to each other
+    (see reconstruction for the other arguments)
+    :return: the welded marching cubes results, as from reconstruction
+    '''
+    mat = create_grid_coords(resolution, resolution, resolution, b_min=b_min, b_max=b_max).coords_matrix
+
+    def eval_func_tensor(samples):
+        net.query(samples.unsqueeze(0), calib_tensor)
+        return net.get_preds()[0][0]
+
+    return surface_from_slabs(stream_surface_slabs(eval_func_tensor, resolution, mat, cuda, num_samples=num_samples, slab_size=slab_size),
+                              mat, on_slab=on_slab)
+
+
+def stream_surface_slabs(eval_func_tensor, resolution, mat, device, num_samples=10000, slab_size=32):
+    '''
+    Evaluate the grid slab by slab and run marching cubes on the finished slabs in a background thread.
+    :return: generator of (origin, marching_cubes_block result) in slab order
+    '''
+    resX, resY, resZ = (resolution, resolution, resolution) if np.isscalar(resolution) else resolution
+    with ThreadPoolExecutor(1) as mesher:
+        pending = []
+        last_plane = None
+        for start in range(0, resX, slab_size):
+            stop = min(start + slab_size, resX)
+            # the grid of planes [start, stop) is the full grid shifted by start along the first axis
+            shift = np.eye(4)
+            shift[0, 3] = start
+            with torch.inference_mode():
+                slab = eval_grid_tensor((stop - start, resY, resZ), np.matmul(mat, shift), eval_func_tensor,
+                                        device=device, num_samples=num_samples)
+            slab = slab.cpu().numpy()
+            if last_plane is not None:
+                # one plane of overlap, so the slab meshes meet on a shared plane of samples
+                slab = np.concatenate([last_plane, slab], 0)
+            origin = np.array([start - (last_plane is not None), 0, 0])
+            last_plane = slab[-1:]
+            pending.append((origin, mesher.submit(marching_cubes_block, slab, 0.5)))
+            del slab
+            # keep at most one slab meshing while the next one is evaluated
+            while len(pending) > 1:
+                origin, future = pending.pop(0)
+                yield origin, future.result()
+        for origin, future in pending:
+            yield origin, future.result()
+
+
+def surface_from_slabs(slabs, mat, on_slab=None):
+    '''
+    Weld the slab meshes of stream_surface_slabs and map them to bounding box space.
+    :return: verts, faces, normals, values, or -1 if there is no surface
+    '''
     try:
-        verts, faces, normals, values = measure.marching_cubes_lewiner(sdf, 0.5)  
+        origins, results = [], []
+        for origin, result in slabs:
+            origins.append(origin)
+            results.append(result)
+            if on_slab is not None and result is not None:
+                verts, faces = transform_mesh(result[0] + origin, result[1], mat)
+                on_slab(verts, faces)
+        verts, faces, normals, values = weld_blocks(origins, results)
+        verts, faces = transform_mesh(verts, faces, mat)
+        return verts, faces, normals, values
+    except:
+        print('error cannot marching cubes')
+        return -1
+
+
+def transform_mesh(verts, faces, mat):
+    '''
+    Map vertices from grid index to bounding box space.
+    '''
+    trans_mat = mat  
+    verts = np.matmul(trans_mat[:3, :3], verts.T) + trans_mat[:3, 3:4]  
+    verts = verts.T
+    # in case mesh has flip transformation
+    if np.linalg.det(trans_mat[:3, :3]) < 0.0:
+        faces = faces[:,::-1]
+    return verts, faces
+
+
+def extract_surface(sdf, mat, num_workers=1):
+    '''
+    Marching cubes at 0.5, then map the vertices from grid index to bounding box space.
+    :param sdf: dense volume (float32, float16 or uint8, see quantize_occupancy) or SparseOctreeGrid
+    :param mat: [4, 4] transform from grid index space
+    :param num_workers: number of marching cubes worker processes
+    :return: verts, faces, normals, values, or -1 if there is no surface
+    '''
+    try:
+        if isinstance(sdf, np.ndarray) and (num_workers > 1 or sdf.dtype != np.float32):
+            # marching cubes works in float32: blocks are converted one at a time instead of the whole volume
+            verts, faces, normals, values = marching_cubes_parallel(sdf, 0.5 * occupancy_scale(sdf.dtype), num_workers=num_workers)
+        elif isinstance(sdf, np.ndarray):
+            verts, faces, normals, values = measure.marching_cubes_lewiner(sdf, 0.5)
+        else:
+            verts, faces, normals, values = marching_cubes_bricks(sdf.bricks(0.5), 0.5, num_workers=num_workers)
         
-        trans_mat = mat  
-        verts = np.matmul(trans_mat[:3, :3], verts.T) + trans_mat[:3, 3:4]  
-        verts = verts.T
-        # in case mesh has flip transformation
-        if np.linalg.det(trans_mat[:3, :3]) < 0.0:
-            faces = faces[:,::-1]
+        verts, faces = transform_mesh(verts, faces, mat)
         return verts, faces, normals, values
     except:
         print('error cannot marching cubes')
@@ -86,43 +550,400 @@ def reconstruction(net, cuda, calib_tensor,
 
 
 
+def refine_surface(verts, eval_func, mat, sdf=None, num_steps=4, tolerance=1e-3, level=0.5):
+    '''
+    Move marching cubes vertices onto the level set of eval_func along the grid edge each of them lies on.
+    The edge ends bracket the surface; every step is a secant (Illinois) step inside the bracket, with bisection when
+    the secant point falls at an end, and queries the unconverged vertices as one batch.
+    :param verts: [N, 3] vertices in bounding box space (as returned by extract_surface)
+    :param eval_func: function that maps [3, N] points in bounding box space to [N] occupancy
+    :param mat: [4, 4] transform from grid index to bounding box space
+    :param sdf: volume the mesh was extracted from (dense volume or SparseOctreeGrid). Its samples are the values at the
+        edge ends; without it they are queried
+    :param num_steps: number of queries per vertex at most
+    :param tolerance: a vertex stops once its occupancy is within tolerance of level
+    :return: [N, 3] refined vertices, number of points queried
+    '''
+    inv_mat = np.linalg.inv(mat)
+    grid = np.matmul(verts, inv_mat[:3, :3].T) + inv_mat[:3, 3]
+
+    # a vertex lies on the edge along its one fractional coordinate
+    start = np.round(grid)
+    axis = np.argmax(np.abs(grid - start), axis=1)
+    rows = np.arange(len(grid))
+    start[rows, axis] = np.floor(grid[rows, axis])
+    start = start.astype(np.int64)
+    stop = start.copy()
+    stop[rows, axis] += 1
+    if sdf is not None:
+        resolution = np.array(sdf.shape if isinstance(sdf, np.ndarray) else [sdf.resolution] * 3)
+        stop[rows, axis] = np.minimum(stop[rows, axis], resolution[axis] - 1)
+    t = grid[rows, axis] - start[rows, axis]
+
+    def points_at(t, idx):
+        p = start[idx].astype(np.float64)
+        p[np.arange(len(idx)), axis[idx]] += t
+        return (np.matmul(mat[:3, :3], p.T) + mat[:3, 3:4]).astype(np.float32)
+
+    num_queries = 0
+    if sdf is None:
+        f_start = eval_func(points_at(np.zeros(len(grid)), rows))
+        f_stop = eval_func(points_at(np.ones(len(grid)), rows))
+        num_queries += 2 * len(grid)
+    elif isinstance(sdf, np.ndarray):
+        scale = occupancy_scale(sdf.dtype)
+        f_start = sdf[start[:, 0], start[:, 1], start[:, 2]].astype(np.float32) / scale
+        f_stop = sdf[stop[:, 0], stop[:, 1], stop[:, 2]].astype(np.float32) / scale
+    else:
+        f_start = sdf.lookup(start)
+        f_stop = sdf.lookup(stop)
+    f_start = f_start.astype(np.float64) - level
+    f_stop = f_stop.astype(np.float64) - level
+    t_start = np.zeros(len(grid))
+    t_stop = np.ones(len(grid))
+    side = np.zeros(len(grid), dtype=np.int8) # end of the bracket that moved last (-1 start, 1 stop)
+
+    # the vertices whose edge does not straddle the level (e.g. interpolated octree values) are left in place
+    active = np.nonzero((f_start <= 0) != (f_stop <= 0))[0]
+    for step in range(num_steps):
+        if len(active) == 0:
+            break
+        if step > 0:
+            # secant point of the bracket, bisection when it is not strictly inside
+            t0, t1, f0, f1 = t_start[active], t_stop[active], f_start[active], f_stop[active]
+            secant = t0 - f0 * (t1 - t0) / (f1 - f0)
+            inside = (secant > t0) & (secant < t1)
+            t[active] = np.where(inside, secant, 0.5 * (t0 + t1))
+        f = eval_func(points_at(t[active], active)).astype(np.float64) - level
+        num_queries += len(active)
+
+        converged = np.abs(f) <= tolerance
+        same_side = (f <= 0) == (f_start[active] <= 0)
+        move_start = ~converged & same_side
+        move_stop = ~converged & ~same_side
+        for move, t_end, f_end, f_other, end in [(move_start, t_start, f_start, f_stop, -1), (move_stop, t_stop, f_stop, f_start, 1)]:
+            idx = active[move]
+            # Illinois: halve the value of the end that stays twice in a row, so the secant does not stall there
+            f_other[idx[side[idx] == end]] *= 0.5
+            t_end[idx] = t[idx]
+            f_end[idx] = f[move]
+            side[idx] = end
+        active = active[~converged]
+
+    if len(active) > 0:
+        # the final secant estimate needs no query
+        t0, t1, f0, f1 = t_start[active], t_stop[active], f_start[active], f_stop[active]
+        t[active] = np.clip(t0 - f0 * (t1 - t0) / (f1 - f0), t0, t1)
+
+    grid[rows, axis] = start[rows, axis] + t
+    verts = np.matmul(grid, mat[:3, :3].T) + mat[:3, 3]
+    return verts, num_queries
+
+
+def lift_level(volume, level=0.5):
+    '''
+    Lift the samples that lie exactly on the level slightly above it. Such a sample would emit one vertex per incident
+    edge at the same position, which cannot be matched across blocks; lifted, every vertex lies inside an edge.
+    Marching cubes works in float32, so the comparison is at that precision. Only the meshes that are welded from blocks
+    are lifted, so they differ from the single-volume mesh of extract_surface around the samples on the level.
+    :return: float32 volume, a copy if any sample was lifted
+    '''
+    volume = volume.astype(np.float32, copy=False)
+    on_level = volume == np.float32(level)
+    if on_level.any():
+        volume = volume.copy()
+        volume[on_level] = level + 1e-4
+    return volume
+
+
+def marching_cubes_block(block, level=0.5):
+    '''
+    Marching cubes on one block of a volume that is meshed block by block.
+    :return: verts, faces, normals, values and a mask of the vertices on the faces of the block, or None if the block has no surface
+    '''
+    if min(block.shape) < 2 or block.min() > level or block.max() < level:
+        return None
+    block = lift_level(block, level)
+    verts, faces, normals, values = measure.marching_cubes_lewiner(block, level)
+    # only vertices on the faces of a block can be shared with a neighbour
+    seam = np.any((verts == 0) | (verts == np.array(block.shape) - 1), axis=1)
+    return verts, faces, normals, values, seam
+
+
+def weld_blocks(origins, results):
+    '''
+    Merge the meshes of neighbouring blocks and weld the vertices on the shared seams.
+    :param origins: grid index of the first sample of every block
+    :param results: output of marching_cubes_block for every block
+    :return: verts, faces, normals, values in grid index space, as from measure.marching_cubes_lewiner
+    '''
+    verts_list, faces_list, normals_list, values_list, seam_list = [], [], [], [], []
+    num_verts = 0
+    for origin, result in zip(origins, results):
+        if result is None:
+            continue
+        verts, faces, normals, values, seam = result
+        seam_list.append(seam)
+        verts_list.append(verts + origin)
+        faces_list.append(faces + num_verts)
+        normals_list.append(normals)
+        values_list.append(values)
+        num_verts += len(verts)
+
+    if num_verts == 0:
+        raise ValueError('Surface level must be within volume data range.')
+
+    verts = np.concatenate(verts_list, 0)
+    faces = np.concatenate(faces_list, 0)
+    normals = np.concatenate(normals_list, 0)
+    values = np.concatenate(values_list, 0)
+
+    # a seam vertex has the same local coordinates along the shared face in both blocks, so the copies match exactly
+    seam = np.where(np.concatenate(seam_list, 0))[0]
+    _, first, inverse = np.unique(verts[seam], axis=0, return_index=True, return_inverse=True)
+    remap = np.arange(num_verts)
+    remap[seam] = seam[first][inverse.reshape(-1)]
+    keep = remap == np.arange(num_verts)
+    faces = (np.cumsum(keep) - 1)[remap[faces]]
+    return verts[keep], faces, normals[keep], values[keep]
+
+
+def marching_cubes_bricks(bricks, level=0.5, num_workers=1):
+    '''
+    Run marching cubes on each block of a volume and weld the vertices on the shared seams.
+    :param bricks: iterable of (origin, block) pairs. Neighbouring blocks must share one plane of samples
+    :param level: iso-value to extract
+    :param num_workers: number of worker processes. The blocks are sent to the workers, so keep them small
+    :return: verts, faces, normals, values in grid index space, as from measure.marching_cubes_lewiner
+    '''
+    if num_workers <= 1:
+        origins, results = [], []
+        for origin, block in bricks:
+            origins.append(origin)
+            results.append(marching_cubes_block(block, level))
+        return weld_blocks(origins, results)
+
+    origins, futures = [], []
+    with ProcessPoolExecutor(num_workers) as pool:
+        for origin, block in bricks:
+            origins.append(origin)
+            futures.append(pool.submit(marching_cubes_block, block, level))
+        results = [future.result() for future in futures]
+    return weld_blocks(origins, results)
+
+
+def _marching_cubes_shared_block(name, shape, dtype, start, stop, level):
+    # runs in a worker process: the volume is read from shared memory, only the block mesh is sent back
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        volume = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return marching_cubes_block(volume[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]], level)
+    finally:
+        del volume
+        shm.close()
+
+
+def marching_cubes_parallel(volume, level=0.5, block_size=128, num_workers=None):
+    '''
+    Marching cubes on a dense volume, split into blocks that are meshed by a pool of worker processes.
+    The volume is placed in shared memory once, so it is never pickled. Neighbouring blocks share one plane
+    of samples and their seam vertices are welded, so the mesh is the single-block mesh up to vertex and face order.
+    :param volume: [resX, resY, resZ] volume
+    :param block_size: number of cells along each side of a block
+    :param num_workers: number of worker processes, os.cpu_count() by default
+    :return: verts, faces, normals, values in grid index space, as from measure.marching_cubes_lewiner
+    '''
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    starts = [np.arange(0, max(res - 1, 1), block_size) for res in volume.shape]
+    origins = [np.array(origin) for origin in itertools.product(*starts)]
+    stops = [np.minimum(origin + block_size + 1, volume.shape) for origin in origins]
+    if num_workers <= 1 or len(origins) == 1:
+        return weld_blocks(origins, [marching_cubes_block(volume[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]], level)
+                                     for start, stop in zip(origins, stops)])
+
+    shm = shared_memory.SharedMemory(create=True, size=max(volume.nbytes, 1))
+    try:
+        shared = np.ndarray(volume.shape, dtype=volume.dtype, buffer=shm.buf)
+        shared[...] = volume
+        with ProcessPoolExecutor(num_workers) as pool:
+            futures = [pool.submit(_marching_cubes_shared_block, shm.name, volume.shape, volume.dtype, start, stop, level)
+                       for start, stop in zip(origins, stops)]
+            results = [future.result() for future in futures]
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    return weld_blocks(origins, results)
+
+
+def write_rows(file, fmt, rows, block_size=65536):
+    '''
+    Write every row of a 2d array with the %-format fmt, block_size rows per write.
+    Each block is formatted by a single % on the repeated format, so the text is the same as formatting row by row.
+    '''
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        file.write((fmt * len(block)) % tuple(block.ravel().tolist()))
+
+
+def obj_faces(faces, columns=(0, 2, 1)):
+    # 1-based indices in the winding of the written faces, one column per index in the record
+    return np.asarray(faces)[:, list(columns)].astype(np.int64) + 1
+
+
 def save_obj_mesh(mesh_path, verts, faces=None):
     file = open(mesh_path, 'w')
 
-    for v in verts:
-        file.write('v %.4f %.4f %.4f\n' % (v[0], v[1], v[2]))
+    write_rows(file, 'v %.4f %.4f %.4f\n', np.asarray(verts)[:, :3].astype(np.float64))
     if faces is not None:
-        for f in faces:
-            if f[0] == f[1] or f[1] == f[2] or f[0] == f[2]:
-                continue
-            f_plus = f + 1
-            file.write('f %d %d %d\n' % (f_plus[0], f_plus[2], f_plus[1]))
+        faces = np.asarray(faces)
+        degenerate = (faces[:, 0] == faces[:, 1]) | (faces[:, 1] == faces[:, 2]) | (faces[:, 0] == faces[:, 2])
+        write_rows(file, 'f %d %d %d\n', obj_faces(faces[~degenerate]))
     file.close()
 
 
-def save_obj_mesh_with_color(mesh_path, verts, faces, colors):
+def save_obj_mesh_with_color(mesh_path, verts, faces, colors, normals=None):
     file = open(mesh_path, 'w')
 
-    for idx, v in enumerate(verts):
-        c = colors[idx]
-        file.write('v %.4f %.4f %.4f %.4f %.4f %.4f\n' % (v[0], v[1], v[2], c[0], c[1], c[2]))
-    for f in faces:
-        f_plus = f + 1
-        file.write('f %d %d %d\n' % (f_plus[0], f_plus[2], f_plus[1]))
+    write_rows(file, 'v %.4f %.4f %.4f %.4f %.4f %.4f\n',
+               np.concatenate([np.asarray(verts)[:, :3], np.asarray(colors)[:len(verts), :3]], 1).astype(np.float64))
+    if normals is not None:
+        write_rows(file, 'vn %.4f %.4f %.4f\n', np.asarray(normals)[:, :3].astype(np.float64))
+        write_rows(file, 'f %d//%d %d//%d %d//%d\n', obj_faces(faces, (0, 0, 2, 2, 1, 1)))
+    else:
+        write_rows(file, 'f %d %d %d\n', obj_faces(faces))
     file.close()
 
 
 def save_obj_mesh_with_uv(mesh_path, verts, faces, uvs):
     file = open(mesh_path, 'w')
 
-    for idx, v in enumerate(verts):
-        vt = uvs[idx]
-        file.write('v %.4f %.4f %.4f\n' % (v[0], v[1], v[2]))
-        file.write('vt %.4f %.4f\n' % (vt[0], vt[1]))
-
-    for f in faces:
-        f_plus = f + 1
-        file.write('f %d/%d %d/%d %d/%d\n' % (f_plus[0], f_plus[0],
-                                              f_plus[2], f_plus[2],
-                                              f_plus[1], f_plus[1]))
+    write_rows(file, 'v %.4f %.4f %.4f\nvt %.4f %.4f\n',
+               np.concatenate([np.asarray(verts)[:, :3], np.asarray(uvs)[:len(verts), :2]], 1).astype(np.float64))
+    write_rows(file, 'f %d/%d %d/%d %d/%d\n', obj_faces(faces, (0, 0, 2, 2, 1, 1)))
     file.close()
+
+
+def ply_vertex_array(verts, colors=None, normals=None):
+    '''
+    Little-endian vertex records: float x, y, z, then float nx, ny, nz and uchar red, green, blue when given.
+    Colors in [0, 1] are scaled to 0..255
+    :return: structured array, and the PLY property lines
+    '''
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    properties = ['property float x', 'property float y', 'property float z']
+    if normals is not None:
+        fields += [('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4')]
+        properties += ['property float nx', 'property float ny', 'property float nz']
+    if colors is not None:
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+        properties += ['property uchar red', 'property uchar green', 'property uchar blue']
+
+    vertex = np.empty(len(verts), dtype=fields)
+    for i, name in enumerate(['x', 'y', 'z']):
+        vertex[name] = verts[:, i]
+    if normals is not None:
+        for i, name in enumerate(['nx', 'ny', 'nz']):
+            vertex[name] = normals[:, i]
+    if colors is not None:
+        colors = np.asarray(colors)
+        if colors.dtype != np.uint8:
+            colors = np.round(np.clip(colors[:, :3], 0, 1) * 255).astype(np.uint8)
+        for i, name in enumerate(['red', 'green', 'blue']):
+            vertex[name] = colors[:, i]
+    return vertex, properties
+
+
+def save_ply_mesh(mesh_path, verts, faces=None, colors=None, normals=None):
+    '''
+    Binary little-endian PLY with optional per-vertex colors ([0, 1] floats or uint8) and normals.
+    The faces are written in the winding of the OBJ writers. Without faces it is a point cloud
+    '''
+    verts = np.asarray(verts)
+    vertex, properties = ply_vertex_array(verts, colors, normals)
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex {0:d}'.format(len(verts))] + properties
+    if faces is not None:
+        faces = np.asarray(faces)
+        face = np.empty(len(faces), dtype=[('count', 'u1'), ('index', '<i4', (3,))])
+        face['count'] = 3
+        face['index'] = faces[:, [0, 2, 1]]
+        header += ['element face {0:d}'.format(len(faces)), 'property list uchar int vertex_indices']
+    header.append('end_header')
+
+    with open(mesh_path, 'wb') as file:
+        file.write(('\n'.join(header) + '\n').encode('ascii'))
+        file.write(vertex.tobytes())
+        if faces is not None:
+            file.write(face.tobytes())
+
+
+def save_glb_mesh(mesh_path, verts, faces=None, colors=None, normals=None):
+    '''
+    Minimal binary glTF 2.0: one mesh with float positions, optional float normals and colors, and uint32 indices
+    in the winding of the OBJ writers. Without faces the primitive is a point cloud
+    '''
+    verts = np.asarray(verts, dtype='<f4')
+    arrays = [('POSITION', verts)]
+    if normals is not None:
+        arrays.append(('NORMAL', np.asarray(normals, dtype='<f4')[:, :3]))
+    if colors is not None:
+        colors = np.asarray(colors)
+        colors = colors[:, :3] / 255.0 if colors.dtype == np.uint8 else np.clip(colors[:, :3], 0, 1)
+        arrays.append(('COLOR_0', colors.astype('<f4')))
+
+    binary = bytearray()
+    buffer_views = []
+    accessors = []
+    attributes = {}
+    def add_view(data, target):
+        buffer_views.append({'buffer': 0, 'byteOffset': len(binary), 'byteLength': data.nbytes, 'target': target})
+        binary.extend(np.ascontiguousarray(data).tobytes())
+        binary.extend(b'\0' * (-len(binary) % 4))
+        return len(buffer_views) - 1
+
+    for name, data in arrays:
+        accessor = {'bufferView': add_view(data, 34962), 'componentType': 5126, 'count': len(data), 'type': 'VEC3'}
+        if name == 'POSITION':
+            accessor['min'] = data.min(0).tolist() if len(data) else [0, 0, 0]
+            accessor['max'] = data.max(0).tolist() if len(data) else [0, 0, 0]
+        attributes[name] = len(accessors)
+        accessors.append(accessor)
+    primitive = {'attributes': attributes, 'mode': 0}
+    if faces is not None:
+        indices = np.asarray(faces)[:, [0, 2, 1]].astype('<u4').ravel()
+        primitive['indices'] = len(accessors)
+        primitive['mode'] = 4
+        accessors.append({'bufferView': add_view(indices, 34963), 'componentType': 5125, 'count': len(indices), 'type': 'SCALAR'})
+
+    gltf = {'asset': {'version': '2.0'}, 'scene': 0, 'scenes': [{'nodes': [0]}], 'nodes': [{'mesh': 0}],
+            'meshes': [{'primitives': [primitive]}], 'accessors': accessors, 'bufferViews': buffer_views,
+            'buffers': [{'byteLength': len(binary)}]}
+    content = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    content += b' ' * (-len(content) % 4)
+
+    with open(mesh_path, 'wb') as file:
+        file.write(struct.pack('<III', 0x46546C67, 2, 12 + 8 + len(content) + 8 + len(binary)))
+        file.write(struct.pack('<II', len(content), 0x4E4F534A))
+        file.write(content)
+        file.write(struct.pack('<II', len(binary), 0x004E4942))
+        file.write(bytes(binary))
+
+
+def save_mesh(mesh_path, verts, faces=None, colors=None, normals=None):
+    '''
+    Write a mesh (or a point cloud without faces) in the format of the extension of mesh_path: .obj (ASCII),
+    .ply (binary) or .glb
+    '''
+    extension = os.path.splitext(mesh_path)[1].lower()
+    if extension == '.ply':
+        save_ply_mesh(mesh_path, verts, faces, colors, normals)
+    elif extension == '.glb':
+        save_glb_mesh(mesh_path, verts, faces, colors, normals)
+    elif extension == '.obj':
+        if colors is not None:
+            save_obj_mesh_with_color(mesh_path, verts, faces, colors, normals=normals)
+        else:
+            save_obj_mesh(mesh_path, verts, faces)
+    else:
+        raise ValueError('unsupported mesh format: {0}'.format(extension))
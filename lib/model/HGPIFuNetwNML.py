@@ -4,8 +4,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F 
 from .BasePIFuNet import BasePIFuNet
-from .MLP import MLP
+from .MLP import MLP, FactorizedMLP
 from .DepthNormalizer import DepthNormalizer
+from ..geometry import index_aligned
 from .HGFilters import HGFilter
 from ..net_util import init_net
 from ..net_util import CustomBCELoss
@@ -83,6 +84,7 @@ class HGPIFuNetwNML(BasePIFuNet):
             res_layers=self.opt.mlp_res_layers_low_res,   
             norm="no_norm",
             last_op=nn.Sigmoid())
+        self.factorized_mlp = FactorizedMLP(self.mlp) # shares the weights of self.mlp, used by query_columns
 
         self.spatial_enc = DepthNormalizer(opt)
 
@@ -228,6 +230,110 @@ class HGPIFuNetwNML(BasePIFuNet):
             self.intermediate_preds_list = intermediate_preds_list
             self.preds = self.intermediate_preds_list[-1]
 
+    def query_columns(self, xy, z, update_pred=True):
+        '''
+        reconstruction-time query for points that are laid out in columns along the view direction (orthogonal projection).
+        every point of a column projects to the same pixel, so the pixel-aligned features are sampled once per column
+        and their contribution to the layers that read the MLP input is computed once per column (see FactorizedMLP);
+        only sp_feat is computed per point.
+        the prediction is stored to self.preds, in the same way as query
+        args:
+            xy: [B, 2, C] image space coordinates of the columns
+            z: [B, C, Z] image space depth of the points of each column
+        return:
+            [B, 1, C * Z] prediction, the Z points of a column are consecutive
+        '''
+        B, C, Z = z.shape
+        use_mask = (self.use_High_Res_Component and self.opt.use_mask_for_rendering_high_res and (self.mask_high_res_tensor is not None)) or \
+                   ((not self.use_High_Res_Component) and self.opt.use_mask_for_rendering_low_res and (self.mask_low_res_tensor is not None))
+        if use_mask:
+            mask_tensor = self.mask_high_res_tensor if self.use_High_Res_Component else self.mask_low_res_tensor
+            mask_values = self.index(mask_tensor, xy)[:, :, :, None] # [B, 1, C, 1]
+
+        in_bb = ((xy >= -1) & (xy <= 1)).all(1)[:, :, None] & (z >= -1) & (z <= 1) # [B, C, Z]
+        in_bb = in_bb.view(B, 1, -1).float()
+
+        is_zero_bool = (xy == 0).all(1)[:, :, None] & (z == 0) # [B, C, Z]
+        not_zero_bool = torch.logical_not(is_zero_bool).view(B, 1, -1).float()
+
+        # spatial_enc only reads the z channel
+        sp_feat = self.spatial_enc(z.view(B, 1, -1).expand(B, 3, C * Z)).view(B, -1, C, Z)
+
+        intermediate_preds_list = []
+        for im_feat in self.im_feat_list:
+            pixel_feat_list = [index_aligned(im_feat, xy)]
+            if self.opt.use_depth_map and not self.opt.depth_in_front:
+                pixel_feat_list.append(index_aligned(self.current_depth_map, xy))
+            # the MLP input is [pixel features, sp_feat]: its pixel part goes through the first layers once per column
+            pred = self.factorized_mlp(torch.cat(pixel_feat_list, 1), sp_feat)[0]
+            pred = in_bb * pred
+            pred = not_zero_bool * pred
+            if use_mask:
+                pred = (mask_values * pred.view(B, 1, C, Z)).view(B, 1, -1)
+            intermediate_preds_list.append(pred)
+
+        if update_pred:
+            self.intermediate_preds_list = intermediate_preds_list
+            self.preds = self.intermediate_preds_list[-1]
+        return intermediate_preds_list[-1]
+
+    def calc_vertex_normals(self, points, calibs, mode='autograd', delta=1e-3):
+        '''
+        return unit surface normals of the occupancy (pointing outside) at the given points, in world space.
+        filter needs to be called beforehand; self.preds is left untouched.
+        args:
+            points: [B, 3, N] 3d points in world space
+            calibs: [B, 3, 4] calibration matrices for each image
+            mode: 'autograd' back-propagates the occupancy to the points in one backward pass, about 2x a query.
+                'central' takes central differences in image space (orthogonal projection only): the two z samples of a
+                point share its feature lookup (see query_columns), the x and y samples are looked up on their own.
+                The layers after the pixel part still run for all six samples, so it costs about 4.5x a query
+            delta: image space step of the central differences. The features are interpolated bilinearly, so the step
+                has to stay well below a pixel of the feature map (2 / 127 at 128) to follow the gradient
+        return:
+            [B, 3, N] normals
+        '''
+        rot = calibs[:, :3, :3]
+        if mode == 'autograd':
+            with torch.inference_mode(False), torch.enable_grad():
+                # tensors made in inference mode cannot be saved for backward: use plain copies of them
+                saved = (self.im_feat_list, self.current_depth_map, self.mask_low_res_tensor, self.mask_high_res_tensor,
+                         self.preds, self.intermediate_preds_list)
+                def plain(x):
+                    return x.clone() if torch.is_tensor(x) and x.is_inference() else x
+                try:
+                    self.im_feat_list = [plain(im_feat) for im_feat in self.im_feat_list]
+                    self.current_depth_map = plain(self.current_depth_map)
+                    self.mask_low_res_tensor = plain(self.mask_low_res_tensor)
+                    self.mask_high_res_tensor = plain(self.mask_high_res_tensor)
+                    points = points.detach().clone().requires_grad_(True)
+                    self.query(points, plain(calibs), update_phi=False)
+                    grad = torch.autograd.grad(self.preds.sum(), points)[0]
+                finally:
+                    self.im_feat_list, self.current_depth_map, self.mask_low_res_tensor, self.mask_high_res_tensor, \
+                        self.preds, self.intermediate_preds_list = saved
+            return -F.normalize(grad.detach(), dim=1, eps=1e-8)
+
+        if mode != 'central':
+            raise ValueError('unknown normal mode: {0}'.format(mode))
+        B, _, N = points.shape
+        xyz = self.projection(points, calibs)
+        steps = torch.tensor([delta, -delta], dtype=xyz.dtype, device=xyz.device)
+
+        # z: one column per point, two samples along it
+        pred_z = self.query_columns(xyz[:, :2], xyz[:, 2:3].transpose(1, 2) + steps, update_pred=False).view(B, N, 2)
+
+        # x and y: four columns per point, one sample each
+        offsets = torch.tensor([[delta, 0], [-delta, 0], [0, delta], [0, -delta]], dtype=xyz.dtype, device=xyz.device)
+        xy = (xyz[:, :2, :, None] + offsets.T[None, :, None, :]).view(B, 2, -1)
+        z = xyz[:, 2, :, None].expand(B, N, 4).reshape(B, -1, 1)
+        pred_xy = self.query_columns(xy, z, update_pred=False).view(B, N, 4)
+
+        grad_image = torch.stack([pred_xy[:, :, 0] - pred_xy[:, :, 1], pred_xy[:, :, 2] - pred_xy[:, :, 3],
+                                  pred_z[:, :, 0] - pred_z[:, :, 1]], 1) # [B, 3, N], the division by 2 * delta is omitted
+        grad = torch.bmm(rot.transpose(1, 2), grad_image)
+        return -F.normalize(grad, dim=1, eps=1e-8)
+
     def calc_normal(self, points, calibs, transforms=None, labels=None, delta=0.01, fd_type='forward'):
         '''
         return surface normal in 'model' space.
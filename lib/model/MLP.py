@@ -64,3 +64,89 @@ class MLP(nn.Module):
             y = self.last_op(y)
 
         return y, phi  # y is the output; phi is the activations from one of the intermediate layers.
+
+
+class FactorizedMLP(object):
+    '''
+    Inference-time evaluation of an MLP for points laid out in columns: the input of every point is
+    [pixel features of its column, point features], e.g. [image features, depth map, sp_feat] for a column along z.
+    The layers that read the input (layer 0 and the res layers) are linear in it, so their pixel part is computed
+    once per column and only the point part (rank 1 for a single z feature) is added per point.
+    The weights are read from the wrapped MLP at every call, so it follows its training.
+    '''
+
+    def __init__(self, mlp, num_point_channels=1):
+        '''
+        args:
+            mlp: MLP built with norm 'no_norm' (group and batch norms mix the points)
+            num_point_channels: number of input channels at the end of the feature that change along a column
+        '''
+        if mlp.norm in ['batch', 'group']:
+            raise ValueError('FactorizedMLP does not support {0} normalization'.format(mlp.norm))
+        self.mlp = mlp
+        self.num_point_channels = num_point_channels
+
+    def input_weights(self, i):
+        '''
+        return the pixel and point parts of the weights that layer i applies to the MLP input
+        '''
+        weight = self.mlp.filters[i].weight
+        start = 0 if i == 0 else weight.shape[1] - self.mlp.filters[0].weight.shape[1]
+        stop = weight.shape[1] - self.num_point_channels
+        return weight[:, start:stop], weight[:, stop:, 0]
+
+    def precompute(self, pixel_feat):
+        '''
+        args:
+            pixel_feat: [B, C_pixel, C] input features shared by the points of each column
+        return:
+            dict from the layers that read the input to their [B, C_out, C] pixel contribution, bias included
+        '''
+        contributions = {}
+        for i, f in enumerate(self.mlp.filters):
+            if i == 0 or i in self.mlp.res_layers:
+                contributions[i] = F.conv1d(pixel_feat, self.input_weights(i)[0], f.bias)
+        return contributions
+
+    def __call__(self, pixel_feat, point_feat, contributions=None):
+        '''
+        args:
+            pixel_feat: [B, C_pixel, C] features shared by the points of each column
+            point_feat: [B, C_point, C, Z] features of every point
+            contributions: output of precompute(pixel_feat), computed here when None
+        return:
+            [B, C_out, C * Z] prediction, the same as mlp(cat([pixel_feat broadcast along Z, point_feat], 1)), and phi
+        '''
+        if contributions is None:
+            contributions = self.precompute(pixel_feat)
+        B, _, C, Z = point_feat.shape
+        y = None
+        phi = None
+        for i, f in enumerate(self.mlp.filters):
+            if i in contributions:
+                # pixel part (with the bias) broadcast along the column, plus the point part
+                point_weight = self.input_weights(i)[1]
+                if y is None:
+                    out = contributions[i][:, :, :, None].expand(-1, -1, C, Z)
+                    out = torch.addcmul(out, point_weight[None, :, :, None], point_feat) if point_weight.shape[1] == 1 else \
+                        out + torch.einsum('oc,bcnz->bonz', point_weight, point_feat)
+                else:
+                    out = F.conv1d(y, f.weight[:, :y.shape[1]]).view(B, -1, C, Z)
+                    out += contributions[i][:, :, :, None]
+                    if point_weight.shape[1] == 1:
+                        out.addcmul_(point_weight[None, :, :, None], point_feat)
+                    else:
+                        out += torch.einsum('oc,bcnz->bonz', point_weight, point_feat)
+                out = out.reshape(B, -1, C * Z)
+            else:
+                out = f(y)
+            y = out
+            if i != len(self.mlp.filters)-1:
+                y = F.leaky_relu_(y)
+            if i == self.mlp.merge_layer:
+                phi = y
+
+        if self.mlp.last_op is not None:
+            y = self.mlp.last_op(y)
+
+        return y, phi
@@ -0,0 +1,299 @@
+import numpy as np
+
+
+# offsets of the 8 corners of a unit cell, in units of the cell size
+CORNER_OFFSETS = np.stack(np.meshgrid([0, 1], [0, 1], [0, 1], indexing='ij'), -1).reshape(-1, 3)
+
+# offsets of the 27 lattice points of a cell split into 8 children, in units of the child size
+CHILD_LATTICE_OFFSETS = np.stack(np.meshgrid([0, 1, 2], [0, 1, 2], [0, 1, 2], indexing='ij'), -1).reshape(-1, 3)
+
+
+def ravel_index(idx, resolution):
+    '''
+    Flatten integer grid indices into int64 keys.
+    :param idx: [N, 3] integer indices, each in [0, resolution)
+    :param resolution: grid resolution
+    :return: [N] int64 keys
+    '''
+    idx = idx.astype(np.int64)
+    return (idx[:, 0] * resolution + idx[:, 1]) * resolution + idx[:, 2]
+
+
+def unravel_index(keys, resolution):
+    '''
+    Inverse of ravel_index.
+    :return: [N, 3] int64 indices
+    '''
+    return np.stack([keys // (resolution * resolution), (keys // resolution) % resolution, keys % resolution], 1)
+
+
+def find_sorted(sorted_keys, keys):
+    '''
+    Look up keys in a sorted key array.
+    :return: positions into sorted_keys, and a boolean mask of the keys that were found
+    '''
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+    pos = np.searchsorted(sorted_keys, keys)
+    pos = np.minimum(pos, len(sorted_keys) - 1)
+    return pos, sorted_keys[pos] == keys
+
+
+class SparseOctreeGrid(object):
+    '''
+    Compact result of refine_octree (eval_grid_octree_sparse, eval_grid_narrow_band).
+
+    Only the points that were sent to the network and the leaf cells of the octree are
+    stored. Every other grid point takes the value of the leaf that contains it, so the full
+    resolution^3 volume is never allocated. Points on the last plane of each axis are left at zero,
+    as in eval_grid_octree.
+    '''
+
+    def __init__(self, resolution, keys, values, leaf_levels, surface_cells, surface_min, surface_max):
+        self.resolution = resolution
+        self.keys = keys  # sorted int64 keys of the evaluated points
+        self.values = values  # float32 values of the evaluated points
+        self.leaf_levels = leaf_levels  # list of (cell size, sorted origin keys, corner min, corner max)
+        self.surface_cells = surface_cells  # [M, 3] origins of the unit cells of the finest level
+        self.surface_min = surface_min
+        self.surface_max = surface_max
+
+    @property
+    def num_evaluated(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        nbytes = self.keys.nbytes + self.values.nbytes
+        nbytes += self.surface_cells.nbytes + self.surface_min.nbytes + self.surface_max.nbytes
+        for _, cell_keys, vmin, vmax in self.leaf_levels:
+            nbytes += cell_keys.nbytes + vmin.nbytes + vmax.nbytes
+        return nbytes
+
+    def lookup(self, idx):
+        '''
+        Values at arbitrary grid points.
+        :param idx: [N, 3] integer grid indices
+        :return: [N] float32 values
+        '''
+        resolution = self.resolution
+        out = np.zeros(len(idx), dtype=np.float32)
+        valid = np.all(idx < resolution - 1, axis=1)
+        idx = idx[valid]
+        vals = np.zeros(len(idx), dtype=np.float32)
+
+        # leaf cells are half-open, so each point belongs to exactly one leaf
+        for size, cell_keys, vmin, vmax in self.leaf_levels:
+            pos, found = find_sorted(cell_keys, ravel_index((idx // size) * size, resolution))
+            pos = pos[found]
+            vals[found] = 0.5 * (vmin[pos] + vmax[pos])
+
+        # evaluated points override the interpolated leaf values
+        pos, found = find_sorted(self.keys, ravel_index(idx, resolution))
+        vals[found] = self.values[pos[found]]
+
+        out[valid] = vals
+        return out
+
+    def to_dense(self, dtype=np.float32, slab=16):
+        '''
+        Expand into a full resolution^3 volume. Only meant for debugging and for small resolutions.
+        '''
+        resolution = self.resolution
+        sdf = np.zeros((resolution, resolution, resolution), dtype=dtype)
+        for x in range(0, resolution, slab):
+            nx = min(slab, resolution - x)
+            idx = np.mgrid[x:x + nx, :resolution, :resolution].reshape(3, -1).T
+            sdf[x:x + nx] = self.lookup(idx).reshape(nx, resolution, resolution)
+        return sdf
+
+    def bricks(self, level=0.5, brick_size=32):
+        '''
+        Yield dense blocks of the volume around every cell that can hold the iso-surface.
+        Neighbouring blocks share one plane of samples, so every marching cube belongs to exactly one block.
+        :param level: iso-value that will be extracted
+        :param brick_size: number of cubes along each side of a block
+        :return: generator of ([3] origin, [X, Y, Z] float32 block)
+        '''
+        resolution = self.resolution
+
+        # cells whose corner range straddles the iso-value, plus leaves that touch the zero padding at the far end
+        origins = [self.surface_cells[(self.surface_min <= level) & (self.surface_max >= level)]]
+        sizes = [np.ones(len(origins[0]), dtype=np.int64)]
+        for size, cell_keys, vmin, vmax in self.leaf_levels:
+            cells = unravel_index(cell_keys, resolution)
+            straddle = (vmin <= level) & (vmax >= level)
+            straddle |= np.any(cells + size >= resolution - 1, axis=1) & (vmax >= level)
+            origins.append(cells[straddle])
+            sizes.append(np.full(straddle.sum(), size, dtype=np.int64))
+        origins = np.concatenate(origins, 0).astype(np.int64)
+        sizes = np.concatenate(sizes, 0)
+        if len(origins) == 0:
+            return
+
+        # a cell touches the cubes one step before its origin through its shared corners
+        lo = np.maximum(origins - 1, 0) // brick_size
+        hi = np.minimum(origins + sizes[:, None], resolution - 2) // brick_size
+        num_bricks = (resolution - 2) // brick_size + 1
+        span = np.arange(int((hi - lo).max()) + 1)
+        brick_keys = []
+        for offset in np.stack(np.meshgrid(span, span, span, indexing='ij'), -1).reshape(-1, 3):
+            b = lo + offset
+            inside = np.all(b <= hi, axis=1)
+            brick_keys.append(ravel_index(b[inside], num_bricks))
+        brick_keys = np.unique(np.concatenate(brick_keys))
+
+        for b in unravel_index(brick_keys, num_bricks):
+            start = b * brick_size
+            stop = np.minimum(start + brick_size, resolution - 1) + 1
+            shape = stop - start
+            idx = np.mgrid[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]].reshape(3, -1).T
+            yield start, self.lookup(idx).reshape(shape)
+
+
+def refine_octree(resolution, coords_matrix, eval_func, split_func,
+                  init_resolution=64, num_samples=512 * 512 * 512, num_cells_per_chunk=2 ** 18):
+    '''
+    Coarse-to-fine evaluation that only keeps the active cells of each level.
+
+    Every level, split_func decides from the corner values which cells are split in 8. The others become
+    leaves. No resolution^3 array is allocated, so memory grows with the number of cells that get split.
+    :param resolution: grid resolution along each axis
+    :param coords_matrix: [4, 4] transform from grid index to bounding box space (see create_grid_matrix)
+    :param eval_func: function that maps [3, N] points to [N] values
+    :param split_func: function (cells [M, 3], corner min [M], corner max [M], cell size) -> [M] mask of cells to split
+    :param init_resolution: number of cells along each axis of the coarsest level
+    :param num_samples: how many points to send to eval_func at once
+    :param num_cells_per_chunk: how many cells to split at once
+    :return: SparseOctreeGrid
+    '''
+    size = max(resolution // init_resolution, 1)
+    if size & (size - 1):
+        raise Exception('resolution / init_resolution must be a power of two, got {0}'.format(size))
+
+    def evaluate(idx):
+        vals = np.zeros(len(idx), dtype=np.float32)
+        for i in range(0, len(idx), num_samples):
+            points = np.matmul(coords_matrix[:3, :3], idx[i:i + num_samples].T) + coords_matrix[:3, 3:4]
+            vals[i:i + num_samples] = eval_func(points)
+        return vals
+
+    def corner_range(cells, size):
+        vmin = np.full(len(cells), np.inf, dtype=np.float32)
+        vmax = np.full(len(cells), -np.inf, dtype=np.float32)
+        for offset in CORNER_OFFSETS:
+            corner = cells + offset * size
+            v = np.zeros(len(cells), dtype=np.float32)
+            valid = np.all(corner < resolution - 1, axis=1)
+            pos, _ = find_sorted(keys, ravel_index(corner[valid], resolution))
+            v[valid] = values[pos]
+            np.minimum(vmin, v, out=vmin)
+            np.maximum(vmax, v, out=vmax)
+        return vmin, vmax
+
+    # coarsest level: every corner of every root cell
+    ticks = np.arange(0, resolution - 1, size)
+    cells = np.stack(np.meshgrid(ticks, ticks, ticks, indexing='ij'), -1).reshape(-1, 3).astype(np.int64)
+    keys = np.sort(ravel_index(cells, resolution))
+    values = evaluate(unravel_index(keys, resolution))
+
+    leaf_levels = []
+    while True:
+        vmin, vmax = corner_range(cells, size)
+        if size == 1:
+            break
+
+        split = split_func(cells, vmin, vmax, size)
+        leaf = np.logical_not(split)
+        leaf_keys = ravel_index(cells[leaf], resolution)
+        order = np.argsort(leaf_keys) # children are listed parent by parent, not in key order
+        leaf_levels.append((size, leaf_keys[order], vmin[leaf][order], vmax[leaf][order]))
+        cells = cells[split]
+        size //= 2
+
+        # the points of the next level that have not been evaluated yet
+        new_keys = []
+        for i in range(0, len(cells), num_cells_per_chunk):
+            lattice = (cells[i:i + num_cells_per_chunk, None, :] + CHILD_LATTICE_OFFSETS[None] * size).reshape(-1, 3)
+            lattice = lattice[np.all(lattice < resolution - 1, axis=1)]
+            new_keys.append(np.unique(ravel_index(lattice, resolution)))
+        new_keys = np.unique(np.concatenate(new_keys)) if new_keys else np.zeros(0, dtype=np.int64)
+        new_keys = new_keys[np.logical_not(find_sorted(keys, new_keys)[1])]
+        new_values = evaluate(unravel_index(new_keys, resolution))
+
+        keys = np.concatenate([keys, new_keys])
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        values = np.concatenate([values, new_values])[order]
+
+        cells = (cells[:, None, :] + CORNER_OFFSETS[None] * size).reshape(-1, 3)
+
+    return SparseOctreeGrid(resolution, keys, values, leaf_levels, cells, vmin, vmax)
+
+
+def eval_grid_octree_sparse(resolution, coords_matrix, eval_func,
+                            init_resolution=64, threshold=0.05,
+                            num_samples=512 * 512 * 512, num_cells_per_chunk=2 ** 18):
+    '''
+    Octree evaluation that only keeps the active cells of each level.
+
+    Follows the same coarse-to-fine scheme as eval_grid_octree: cells whose 8 corners differ by less than
+    threshold become homogeneous leaves, the others are split until they reach unit size. Unlike the dense
+    version, no resolution^3 array is allocated, so memory grows with the number of cells near the surface.
+    :param threshold: maximum corner spread of a homogeneous cell
+    (see refine_octree for the other arguments)
+    :return: SparseOctreeGrid
+    '''
+    def split_func(cells, vmin, vmax, size):
+        return (vmax - vmin) >= threshold
+
+    return refine_octree(resolution, coords_matrix, eval_func, split_func, init_resolution=init_resolution,
+                         num_samples=num_samples, num_cells_per_chunk=num_cells_per_chunk)
+
+
+def dilate_cells(cells, mask, size, band, resolution):
+    '''
+    Grow a selection of cells by band cells along each axis, without leaving the given set of cells.
+    :param cells: [M, 3] origins of the cells of one level
+    :param mask: [M] selected cells
+    :param size: cell size of the level
+    :param band: number of cells to grow by
+    :return: [M] dilated selection
+    '''
+    if band <= 0 or not mask.any():
+        return mask
+    selected = ravel_index(cells[mask], resolution)
+    for axis in range(3):
+        step = size * resolution ** (2 - axis)
+        coord = unravel_index(selected, resolution)[:, axis]
+        grown = [selected]
+        for d in range(1, band + 1):
+            grown.append(selected[coord - d * size >= 0] - d * step)
+            grown.append(selected[coord + d * size < resolution] + d * step)
+        selected = np.unique(np.concatenate(grown))
+    cell_keys = ravel_index(cells, resolution)
+    return find_sorted(selected, cell_keys)[1]
+
+
+def eval_grid_narrow_band(resolution, coords_matrix, eval_func,
+                          init_resolution=64, level=0.5, band=1,
+                          num_samples=512 * 512 * 512, num_cells_per_chunk=2 ** 18):
+    '''
+    Narrow-band evaluation: only the cells whose corners straddle the iso-level, and a band of band cells
+    around them, are split. Every other cell stays a leaf at the level it was found on and is never
+    interpolated inside, so the number of queries grows with the surface area (about resolution^2).
+    The result only describes the band, and is meant for surface extraction with SparseOctreeGrid.bricks.
+    Against eval_grid_octree it only pays off at high resolution: at 128^3 it queries about as many points and
+    takes longer, from 256^3 on it queries fewer (a quarter at 512^3 with band 0). Every band cell adds queries and
+    bookkeeping, so a wide band can end up slower (see benchmark_narrow_band in apps/benchmark_reconstruction.py).
+    :param level: iso-value of the surface
+    :param band: number of neighbouring cells around the straddling ones that are refined as well
+    (see refine_octree for the other arguments)
+    :return: SparseOctreeGrid
+    '''
+    def split_func(cells, vmin, vmax, size):
+        straddle = (vmin <= level) & (vmax >= level)
+        return dilate_cells(cells, straddle, size, band, resolution)
+
+    return refine_octree(resolution, coords_matrix, eval_func, split_func, init_resolution=init_resolution,
+                         num_samples=num_samples, num_cells_per_chunk=num_cells_per_chunk)
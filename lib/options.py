@@ -52,6 +52,11 @@ class BaseOptions():
 
         parser.add_argument('--sigma_low_resolution_pifu', type=float, default=3.5, help='sigma for sampling')
         parser.add_argument('--sigma_high_resolution_pifu', type=float, default=2.0, help='sigma for sampling') 
+        parser.add_argument('--sample_bank_dir', type=str, default=None, help='draw the training samples from this bank (apps/build_sample_bank.py) instead of sampling the meshes online')
+        parser.add_argument('--sample_bank_draws', type=int, default=8, help='# of pre-drawn sample sets per view in the sample bank')
+        parser.add_argument('--view_record_dir', type=str, default=None, help='read the inputs of the views from the records packed by apps/pack_view_records.py instead of their separate files')
+        parser.add_argument('--use_occupancy_volumes', action='store_true', help='label the samples with the volumes baked by apps/bake_occupancy_volumes.py instead of ray casting the meshes')
+        parser.add_argument('--ray_caster', type=str, default='trimesh', choices=['bvh', 'trimesh'], help='ray casting of the samplers: trimesh (inside tests, and signed distance for the DOS outside check) or the vectorized BVH of lib/ray_caster.py (ray parity; labels can differ on borderline points)')
 
         parser.add_argument('--use_front_normal', default=False)
         parser.add_argument('--use_back_normal', default=False)
@@ -0,0 +1,243 @@
+import os
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def spread_bits(x):
+    '''
+    Interleave two zero bits after each of the 10 low bits of x (for 30-bit Morton codes)
+    '''
+    x = x.astype(np.uint64) & np.uint64(0x3ff)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x030000ff)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x0300f00f)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x030c30c3)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x09249249)
+    return x
+
+
+def dot(a, b):
+    '''
+    Dot products of vectors given as lists of their 3 component arrays
+    '''
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+def cross(a, b):
+    return [a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]]
+
+
+class BVH(object):
+    '''
+    Bounding volume hierarchy of a triangle mesh in flat arrays, for batched ray queries with vectorized traversal.
+    The triangles are sorted along a Morton curve and grouped into leaves of leaf_size consecutive triangles; the
+    tree over the leaves is complete (padded with empty leaves to a power of two), so it needs no child pointers:
+    node i has children 2i+1 and 2i+2 and leaf k is node num_leaves-1+k.
+    All the rays of a chunk descend the tree together, one level per step, as (ray, node) pairs. The arrays are
+    stored by coordinate (one row per component) so that every gather reads a contiguous row.
+    '''
+    def __init__(self, bounds, triangles, leaf_size):
+        self.bounds = bounds # [6, 2L-1] float32 min xyz and max xyz of the nodes, nan for the empty nodes
+        self.triangles = triangles # [9, T] float64 v0, v1 - v0 and v2 - v0
+        self.leaf_size = int(leaf_size)
+        self.num_leaves = (bounds.shape[1] + 1) // 2
+        self.depth = int(np.log2(self.num_leaves))
+
+    @staticmethod
+    def build(vertices, faces, leaf_size=2):
+        vertices = np.asarray(vertices, dtype=np.float64)
+        tri = vertices[np.asarray(faces, dtype=np.int64)] # [T, 3, 3]
+
+        # Morton order of the centroids
+        centroids = tri.mean(1)
+        low, high = centroids.min(0), centroids.max(0)
+        quantized = ((centroids - low) / np.maximum(high - low, 1e-12) * 1023).astype(np.uint64)
+        codes = (spread_bits(quantized[:, 0]) << np.uint64(2)) | (spread_bits(quantized[:, 1]) << np.uint64(1)) | spread_bits(quantized[:, 2])
+        tri = tri[np.argsort(codes, kind='stable')]
+
+        num_leaves = 1 << int(np.ceil(np.log2(max((len(tri) + leaf_size - 1) // leaf_size, 1))))
+        padded = num_leaves * leaf_size
+        tri_min = np.full((padded, 3), np.inf)
+        tri_max = np.full((padded, 3), -np.inf)
+        tri_min[:len(tri)] = tri.min(1)
+        tri_max[:len(tri)] = tri.max(1)
+
+        # bounds level by level from the leaves up, in heap order
+        level_min = [tri_min.reshape(num_leaves, leaf_size, 3).min(1)]
+        level_max = [tri_max.reshape(num_leaves, leaf_size, 3).max(1)]
+        while len(level_min[0]) > 1:
+            level_min.insert(0, level_min[0].reshape(-1, 2, 3).min(1))
+            level_max.insert(0, level_max[0].reshape(-1, 2, 3).max(1))
+        # float32 bounds, padded to cover the rounding of the float32 slab tests; nan fails every slab test
+        pad = 1e-5 * np.abs(vertices).max()
+        bounds = np.concatenate([np.concatenate(level_min) - pad, np.concatenate(level_max) + pad], 1).T
+        bounds[:, np.isinf(bounds).any(0)] = np.nan
+        triangles = np.concatenate([tri[:, 0], tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0]], 1).T
+        return BVH(np.ascontiguousarray(bounds, dtype=np.float32), np.ascontiguousarray(triangles), leaf_size)
+
+    def save(self, bvh_dir, key=None):
+        '''
+        Write the arrays as .npy files of a directory, so that load can memory-map them
+        '''
+        tmp_dir = bvh_dir + '.%d.tmp' % os.getpid()
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in ['bounds', 'triangles']:
+            np.save(os.path.join(tmp_dir, name + '.npy'), getattr(self, name))
+        with open(os.path.join(tmp_dir, 'bvh.json'), 'w') as f:
+            json.dump({'leaf_size': self.leaf_size, 'key': key}, f)
+        if os.path.exists(bvh_dir):
+            shutil.rmtree(bvh_dir, ignore_errors=True)
+        os.replace(tmp_dir, bvh_dir)
+
+    @staticmethod
+    def load(bvh_dir, key=None, mmap_mode='r'):
+        '''
+        :return: the BVH saved in bvh_dir, memory-mapped (the processes that load it share its pages), or None when
+        there is none or it was saved with another key
+        '''
+        try:
+            with open(os.path.join(bvh_dir, 'bvh.json'), 'r') as f:
+                meta = json.load(f)
+            if meta['key'] != key:
+                return None
+            arrays = [np.load(os.path.join(bvh_dir, name + '.npy'), mmap_mode=mmap_mode) for name in ['bounds', 'triangles']]
+        except (OSError, ValueError, KeyError):
+            return None
+        return BVH(*arrays, meta['leaf_size'])
+
+    def intersect_chunk(self, origins, directions, t_min):
+        '''
+        Every intersection of a chunk of rays
+        :return: ray index (non-decreasing) and t (distance in units of the direction) of the hits with t > t_min
+        '''
+        # the boxes are tested in float32 as (bound * inv_dir - origin * inv_dir); zero components of the directions
+        # are nudged so that no slab gives nan
+        inv_dir = (1.0 / np.where(np.abs(directions) < 1e-12, np.where(directions < 0, -1e-12, 1e-12), directions)).T.astype(np.float32)
+        scaled_origins = (origins.T * inv_dir).astype(np.float32)
+        ray = np.arange(len(origins), dtype=np.int32)
+        node = np.zeros(len(origins), dtype=np.int32)
+        for level in range(self.depth + 1):
+            # slab test of the boxes
+            for axis in range(3):
+                inv, scaled = inv_dir[axis].take(ray), scaled_origins[axis].take(ray)
+                t0 = self.bounds[axis].take(node) * inv - scaled
+                t1 = self.bounds[axis + 3].take(node) * inv - scaled
+                if axis == 0:
+                    t_near, t_far = np.minimum(t0, t1), np.maximum(t0, t1)
+                else:
+                    np.maximum(t_near, np.minimum(t0, t1), out=t_near)
+                    np.minimum(t_far, np.maximum(t0, t1), out=t_far)
+            keep = (t_near <= t_far) & (t_far >= t_min)
+            ray, node = ray[keep], node[keep]
+            if level < self.depth:
+                ray = np.repeat(ray, 2)
+                node = np.repeat(2 * node + 1, 2)
+                node[1::2] += 1
+
+        # triangles of the leaves that were reached
+        tri = np.repeat((node - (self.num_leaves - 1)) * self.leaf_size, self.leaf_size) + np.tile(np.arange(self.leaf_size, dtype=np.int32), len(node))
+        ray = np.repeat(ray, self.leaf_size)
+        valid = tri < self.triangles.shape[1]
+        ray, tri = ray[valid], tri[valid]
+
+        # Moller-Trumbore
+        v0, e1, e2 = [[self.triangles[3 * i + axis].take(tri) for axis in range(3)] for i in range(3)]
+        d = [directions[:, axis].take(ray) for axis in range(3)]
+        s = [origins[:, axis].take(ray) - v0[axis] for axis in range(3)]
+        p = cross(d, e2)
+        det = dot(e1, p)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = 1.0 / det
+            u = dot(s, p) * inv_det
+            q = cross(s, e1)
+            v = dot(d, q) * inv_det
+            t = dot(e2, q) * inv_det
+            hit = (det != 0) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > t_min)
+        return ray[hit], t[hit]
+
+    def map_chunks(self, func, num_rays, chunk_size, num_threads):
+        chunks = [(start, min(start + chunk_size, num_rays)) for start in range(0, num_rays, chunk_size)]
+        if num_threads > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(num_threads) as pool:
+                list(pool.map(lambda chunk: func(*chunk), chunks))
+        else:
+            for chunk in chunks:
+                func(*chunk)
+
+    def first_hit(self, origins, directions, t_min=1e-5, chunk_size=4096, num_threads=1):
+        '''
+        Distance to the first intersection of each ray, as trimesh.proximity.longest_ray
+        :param origins: [N, 3] ray origins
+        :param directions: [N, 3] ray directions (need not be normalized)
+        :param t_min: intersections closer than this (in distance) are ignored
+        :return: [N] distance, inf for the rays that miss the mesh
+        '''
+        origins = np.asarray(origins, dtype=np.float64)
+        directions = np.asarray(directions, dtype=np.float64)
+        norms = np.linalg.norm(directions, axis=1)
+        result = np.full(len(origins), np.inf)
+
+        def run(start, end):
+            ray, t = self.intersect_chunk(origins[start:end], directions[start:end], 0.0)
+            t = t * norms[start:end][ray]
+            keep = t > t_min
+            ray, t = ray[keep], t[keep]
+            if len(ray):
+                starts = np.r_[0, np.flatnonzero(np.diff(ray)) + 1]
+                result[start + ray[starts]] = np.minimum.reduceat(t, starts)
+
+        self.map_chunks(run, len(origins), chunk_size, num_threads)
+        return result
+
+    def hit_count(self, origins, directions, t_min=0.0, chunk_size=4096, num_threads=1):
+        '''
+        :return: [N] number of intersections of each ray beyond t_min (in units of the direction)
+        '''
+        origins = np.asarray(origins, dtype=np.float64)
+        directions = np.asarray(directions, dtype=np.float64)
+        result = np.zeros(len(origins), dtype=np.int64)
+
+        def run(start, end):
+            ray, _ = self.intersect_chunk(origins[start:end], directions[start:end], t_min)
+            result[start:end] = np.bincount(ray, minlength=end - start)
+
+        self.map_chunks(run, len(origins), chunk_size, num_threads)
+        return result
+
+    def contains(self, points, chunk_size=4096, num_threads=1):
+        '''
+        Inside test by ray parity, as trimesh.Trimesh.contains: rays are cast both ways along a fixed direction, and
+        where the two parities disagree (open meshes, grazing hits) a third ray decides.
+        :return: [N] bool
+        '''
+        points = np.asarray(points, dtype=np.float64)
+        direction = np.array([0.4395064455, 0.617598629942, 0.652231566745]) # arbitrary, off the axes of the grid and the scans
+        parity = [self.hit_count(points, np.tile(sign * direction, (len(points), 1)), chunk_size=chunk_size, num_threads=num_threads) % 2 == 1
+                  for sign in [1, -1]]
+        inside = parity[0]
+        broken = np.flatnonzero(parity[0] != parity[1])
+        if len(broken):
+            third = np.array([-0.7071067811865475, 0.5773502691896258, 0.4082482904638631])
+            parity_third = self.hit_count(points[broken], np.tile(third, (len(broken), 1)), chunk_size=chunk_size, num_threads=num_threads) % 2 == 1
+            inside[broken] = parity_third
+        return inside
+
+
+def load_or_build_bvh(vertices, faces, bvh_dir=None, key=None, leaf_size=2):
+    '''
+    BVH of a mesh, cached in bvh_dir (memory-mapped when it is loaded from there) and rebuilt when the key differs
+    '''
+    if bvh_dir is not None:
+        bvh = BVH.load(bvh_dir, key=key)
+        if bvh is not None:
+            return bvh
+    bvh = BVH.build(vertices, faces, leaf_size=leaf_size)
+    if bvh_dir is not None:
+        try:
+            bvh.save(bvh_dir, key=key)
+            return BVH.load(bvh_dir, key=key)
+        except OSError:
+            pass
+    return bvh
@@ -21,45 +21,148 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
+import functools
+import itertools
+import threading
 import numpy as np
+import torch
 
 
-def create_grid(resX, resY, resZ, b_min=np.array([-1, -1, -1]), b_max=np.array([1, 1, 1]), transform=None):
+def create_grid_matrix(resX, resY, resZ, b_min=np.array([-1, -1, -1]), b_max=np.array([1, 1, 1]), transform=None):
     '''
-    Create a dense grid of given resolution and bounding box
+    Build the transform from grid index space to bounding box space without materializing the grid
     :param resX: resolution along X axis
     :param resY: resolution along Y axis
     :param resZ: resolution along Z axis
     :param b_min: vec3 (x_min, y_min, z_min) bounding box corner
     :param b_max: vec3 (x_max, y_max, z_max) bounding box corner
-    :return: [3, resX, resY, resZ] coordinates of the grid, and transform matrix from mesh index
+    :return: [4, 4] transform matrix from mesh index
     '''
-    coords = np.mgrid[:resX, :resY, :resZ] # coords has shape of (3, 512, 512, 512)
-    coords = coords.reshape(3, -1)
     coords_matrix = np.eye(4)
     length = b_max - b_min
     coords_matrix[0, 0] = length[0] / resX   # coords_matrix transform points from 'resolution' dimension to 'bounding box' dimension
     coords_matrix[1, 1] = length[1] / resY
     coords_matrix[2, 2] = length[2] / resZ
     coords_matrix[0:3, 3] = b_min
-    coords = np.matmul(coords_matrix[:3, :3], coords) + coords_matrix[:3, 3:4]
     if transform is not None:
-        coords = np.matmul(transform[:3, :3], coords) + transform[:3, 3:4]
         coords_matrix = np.matmul(transform, coords_matrix)
+    return coords_matrix
+
+
+def create_grid(resX, resY, resZ, b_min=np.array([-1, -1, -1]), b_max=np.array([1, 1, 1]), transform=None):
+    '''
+    Create a dense grid of given resolution and bounding box
+    :param resX: resolution along X axis
+    :param resY: resolution along Y axis
+    :param resZ: resolution along Z axis
+    :param b_min: vec3 (x_min, y_min, z_min) bounding box corner
+    :param b_max: vec3 (x_max, y_max, z_max) bounding box corner
+    :return: [3, resX, resY, resZ] coordinates of the grid, and transform matrix from mesh index
+    '''
+    coords = np.mgrid[:resX, :resY, :resZ] # coords has shape of (3, 512, 512, 512)
+    coords = coords.reshape(3, -1)
+    coords_matrix = create_grid_matrix(resX, resY, resZ, b_min=b_min, b_max=b_max, transform=transform)
+    coords = np.matmul(coords_matrix[:3, :3], coords) + coords_matrix[:3, 3:4]
     coords = coords.reshape(3, resX, resY, resZ)   # coords still has shape of (3, 512, 512, 512)
     return coords, coords_matrix  # coords_matrix has shape of [4,4] and it transforms 3D points from 'resolution' dimension to 'bounding box' dimension
 
 
-def batch_eval(points, eval_func, num_samples=512 * 512 * 512):
+class GridCoords(object):
+    '''
+    Lazy equivalent of the create_grid coordinates: points are computed from their grid index on demand
+    '''
+
+    def __init__(self, resX, resY, resZ, coords_matrix):
+        self.resolution = (resX, resY, resZ)
+        self.shape = (3, resX, resY, resZ)
+        self.coords_matrix = coords_matrix
+        # the transform is affine, so a point is the sum of one column per axis: three [3, res] tables cover the grid
+        self.axis_tables = [np.outer(coords_matrix[:3, axis], np.arange(res)) for axis, res in enumerate(self.resolution)]
+
+    def points(self, flat_index):
+        '''
+        :param flat_index: [N] indices into the flattened [resX, resY, resZ] grid
+        :return: [3, N] coordinates
+        '''
+        x, y, z = np.unravel_index(flat_index, self.resolution)
+        table_x, table_y, table_z = self.axis_tables
+        return table_x[:, x] + table_y[:, y] + table_z[:, z] + self.coords_matrix[:3, 3:4]
+
+    def points_in_range(self, start, stop):
+        return self.points(np.arange(start, stop))
+
+
+@functools.lru_cache(maxsize=16)
+def _create_grid_coords(resX, resY, resZ, b_min, b_max, transform):
+    if transform is not None:
+        transform = np.array(transform)
+    coords_matrix = create_grid_matrix(resX, resY, resZ, b_min=np.array(b_min), b_max=np.array(b_max), transform=transform)
+    return GridCoords(resX, resY, resZ, coords_matrix)
+
+
+def create_grid_coords(resX, resY, resZ, b_min=np.array([-1, -1, -1]), b_max=np.array([1, 1, 1]), transform=None):
+    '''
+    Same as create_grid, but returns a lazy GridCoords instead of the [3, resX, resY, resZ] array
+    The result is cached per resolution and bounding box, so it must not be modified
+    :return: GridCoords
+    '''
+    if transform is not None:
+        transform = tuple(map(tuple, np.asarray(transform, dtype=np.float64)))
+    return _create_grid_coords(resX, resY, resZ, tuple(np.asarray(b_min, dtype=np.float64)), tuple(np.asarray(b_max, dtype=np.float64)), transform)
+
+
+def occupancy_scale(dtype):
+    '''
+    Storage units per unit of occupancy: uint8 volumes store round(255 * p), float volumes store p.
+    '''
+    return 255.0 if np.dtype(dtype) == np.uint8 else 1.0
+
+
+def quantize_occupancy(values, dtype=np.float32):
+    '''
+    Convert occupancy probabilities in [0, 1] to the storage dtype of a volume (float32, float16 or uint8)
+    '''
+    if np.dtype(dtype) == np.uint8:
+        return np.round(np.clip(values, 0, 1) * 255).astype(np.uint8)
+    return np.asarray(values).astype(dtype, copy=False)
+
+
+def grid_points(coords, flat_index):
+    '''
+    Coordinates of some grid points, from either a GridCoords or a create_grid array
+    :param flat_index: [N] indices into the flattened grid
+    :return: [3, N] coordinates
+    '''
+    if isinstance(coords, GridCoords):
+        return coords.points(flat_index)
+    return coords.reshape(3, -1)[:, flat_index]
+
+
+def batch_eval_grid(coords, flat_index, eval_func, num_samples=512 * 512 * 512, dtype=np.float32):
+    '''
+    Evaluate grid points chunk by chunk, building the coordinates of one chunk at a time
+    :param coords: GridCoords or [3, resX, resY, resZ] array
+    :param flat_index: [N] indices into the flattened grid
+    :param dtype: storage dtype of the values (see quantize_occupancy)
+    :return: [N] values
+    '''
+    num_pts = len(flat_index)
+    sdf = np.zeros(num_pts, dtype=dtype)
+    for i in range(0, num_pts, num_samples):
+        sdf[i:i + num_samples] = quantize_occupancy(eval_func(grid_points(coords, flat_index[i:i + num_samples])), dtype)
+    return sdf
+
+
+def batch_eval(points, eval_func, num_samples=512 * 512 * 512, dtype=np.float32):
     num_pts = points.shape[1]
-    sdf = np.zeros(num_pts)
+    sdf = np.zeros(num_pts, dtype=dtype)
 
     num_batches = num_pts // num_samples
     for i in range(num_batches):
-        sdf[i * num_samples:i * num_samples + num_samples] = eval_func(
-            points[:, i * num_samples:i * num_samples + num_samples])
+        sdf[i * num_samples:i * num_samples + num_samples] = quantize_occupancy(eval_func(
+            points[:, i * num_samples:i * num_samples + num_samples]), dtype)
     if num_pts % num_samples:
-        sdf[num_batches * num_samples:] = eval_func(points[:, num_batches * num_samples:])
+        sdf[num_batches * num_samples:] = quantize_occupancy(eval_func(points[:, num_batches * num_samples:]), dtype)
 
     return sdf
 
@@ -75,24 +178,338 @@ def batch_eval_tensor(points, eval_func, num_samples=512 * 512 * 512):
 
     return np.concatenate(vals,0)
 
-def eval_grid(coords, eval_func, num_samples=512 * 512 * 512):
+def eval_grid_tensor(resolution, coords_matrix, eval_func, device, num_samples=512 * 512 * 512, dtype=np.float32):
+    '''
+    Evaluate a dense grid without leaving the device
+    Chunk coordinates are generated on the fly from the flat grid index, so the grid is never materialized
+    :param resolution: (resX, resY, resZ)
+    :param coords_matrix: [4, 4] transform from grid index to bounding box space (see create_grid_matrix),
+        or [B, 4, 4] to evaluate B grids at once
+    :param eval_func: function that maps a [3, N] float32 tensor to an [N] tensor ([B, 3, N] to [B, N] when batched)
+    :param device: device to generate the points and store the results on
+    :param num_samples: how many points to evaluate at once
+    :param dtype: storage dtype of the volume (see quantize_occupancy)
+    :return: [resX, resY, resZ] tensor on device ([B, resX, resY, resZ] when batched)
+    '''
+    resX, resY, resZ = resolution
+    num_pts = resX * resY * resZ
+    mat = torch.as_tensor(coords_matrix, dtype=torch.float32, device=device)
+    batched = mat.dim() == 3
+    if not batched:
+        mat = mat.unsqueeze(0)
+    quantize = np.dtype(dtype) == np.uint8
+    sdf = torch.empty(mat.shape[0], num_pts, dtype=getattr(torch, np.dtype(dtype).name), device=device)
+    for start in range(0, num_pts, num_samples):
+        stop = min(start + num_samples, num_pts)
+        flat = torch.arange(start, stop, device=device)
+        idx = torch.stack([flat // (resY * resZ), (flat // resZ) % resY, flat % resZ], 0).float()
+        points = torch.baddbmm(mat[:, :3, 3:4], mat[:, :3, :3], idx.expand(mat.shape[0], 3, stop - start))
+        values = eval_func(points) if batched else eval_func(points[0])
+        if quantize:
+            values = torch.round(torch.clamp(values, 0, 1) * 255)
+        sdf[:, start:stop] = values
+    if batched:
+        return sdf.view(-1, resX, resY, resZ)
+    return sdf.view(resX, resY, resZ)
+
+
+def grid_to_image_matrix(calib, coords_matrix):
+    '''
+    :param calib: [4, 4] orthogonal calibration matrix (or [B, 4, 4])
+    :param coords_matrix: [4, 4] transform from grid index to bounding box space (or [B, 4, 4])
+    :return: [4, 4] transform from grid index to image space ([B, 4, 4] when batched)
+    '''
+    return np.matmul(np.asarray(calib, dtype=np.float64), np.asarray(coords_matrix, dtype=np.float64))
+
+
+def column_axis(calib, coords_matrix, eps=1e-6):
+    '''
+    Grid axis that is parallel to the view direction of an orthogonal calibration, if there is one.
+    Along that axis all the points of a grid column project to the same pixel.
+    :return: 0, 1 or 2, None when the view direction is not a grid axis (for any of the batched calibrations)
+    '''
+    mat = grid_to_image_matrix(calib, coords_matrix).reshape(-1, 4, 4)
+    xy_rows = np.abs(mat[:, :2, :3]) # how much one step along each grid axis moves the projection
+    for axis in range(3):
+        if np.all(xy_rows[:, :, axis] <= eps * xy_rows.max()):
+            return axis
+    return None
+
+
+def eval_grid_columns(resolution, coords_matrix, calib, eval_func, device, num_samples=512 * 512 * 512, dtype=np.float32):
+    '''
+    Evaluate a dense grid whose columns along one axis are parallel to the view direction (see column_axis)
+    The points are passed column by column, so the pixel-aligned features can be sampled once per column
+    :param resolution: (resX, resY, resZ)
+    :param coords_matrix: [4, 4] transform from grid index to bounding box space, or [B, 4, 4] to evaluate B grids at once
+    :param calib: [4, 4] orthogonal calibration matrix of the grid ([B, 4, 4] when batched)
+    :param eval_func: function that maps the image space column coordinates xy [B, 2, C] and the depths z [B, C, Z]
+        of their points to [B, C, Z] values
+    :param device: device to generate the points and store the results on
+    :param num_samples: how many points to evaluate at once, rounded down to whole columns
+    :param dtype: storage dtype of the volume (see quantize_occupancy)
+    :return: [resX, resY, resZ] tensor on device ([B, resX, resY, resZ] when batched)
+    '''
+    axis = column_axis(calib, coords_matrix)
+    if axis is None:
+        raise ValueError('the view direction is not parallel to a grid axis')
+    batched = np.asarray(coords_matrix).ndim == 3
+    mat = torch.as_tensor(grid_to_image_matrix(calib, coords_matrix).reshape(-1, 4, 4), dtype=torch.float32, device=device)
+    num_items = mat.shape[0]
+
+    # the column index runs over the two other axes, and the points of a column along the view axis
+    other_axes = [i for i in range(3) if i != axis]
+    res_a, res_b = resolution[other_axes[0]], resolution[other_axes[1]]
+    res_column = resolution[axis]
+    num_columns = res_a * res_b
+    columns_per_chunk = max(num_samples // res_column, 1)
+    steps = torch.arange(res_column, device=device, dtype=torch.float32)
+    column_z = mat[:, 2, axis, None] * steps # [B, Z], depth of the points relative to the first one of their column
+
+    quantize = np.dtype(dtype) == np.uint8
+    sdf = torch.empty(num_items, num_columns, res_column, dtype=getattr(torch, np.dtype(dtype).name), device=device)
+    for start in range(0, num_columns, columns_per_chunk):
+        stop = min(start + columns_per_chunk, num_columns)
+        flat = torch.arange(start, stop, device=device)
+        idx = torch.stack([flat // res_b, flat % res_b], 0).float()
+        xyz = torch.baddbmm(mat[:, :3, 3:4], mat[:, :3, other_axes], idx.expand(num_items, 2, stop - start)) # [B, 3, C]
+        z = xyz[:, 2, :, None] + column_z[:, None, :] # [B, C, Z]
+        values = eval_func(xyz[:, :2], z)
+        if quantize:
+            values = torch.round(torch.clamp(values, 0, 1) * 255)
+        sdf[:, start:stop] = values
+
+    shape = [resolution[i] for i in other_axes] + [res_column]
+    sdf = sdf.view(num_items, *shape)
+    sdf = torch.movedim(sdf, 3, axis + 1).contiguous()
+    return sdf if batched else sdf[0]
+
+
+class BatchedQuery(object):
+    '''
+    Lets B grid evaluations, each running in its own thread, share one batched network query.
+    Each evaluation calls its own eval_func(item); once every unfinished evaluation is waiting for its chunk,
+    the chunks are padded to the same length and sent to query_func as a single [B, 3, N] array.
+    '''
+
+    def __init__(self, query_func, num_items):
+        self.query_func = query_func # maps [B, 3, N] points to [B, N] values
+        self.num_items = num_items
+        self.condition = threading.Condition()
+        self.active = set(range(num_items))
+        self.pending = {}
+        self.results = {}
+        self.error = None
+
+    def eval_func(self, item):
+        def eval_func(points):
+            with self.condition:
+                self.pending[item] = points
+                self._query_if_ready()
+                while item not in self.results and self.error is None:
+                    self.condition.wait()
+                if item not in self.results:
+                    raise self.error
+                return self.results.pop(item)
+        return eval_func
+
+    def finish(self, item):
+        '''
+        Must be called once the evaluation of item is done (or failed), so the others stop waiting for it.
+        '''
+        with self.condition:
+            self.active.discard(item)
+            self._query_if_ready()
+
+    def _query_if_ready(self):
+        if not self.pending or len(self.pending) < len(self.active):
+            return
+        pending, self.pending = self.pending, {}
+        num_pts = max(points.shape[1] for points in pending.values())
+        points = np.zeros((self.num_items, 3, num_pts)) # finished items and padding are queried at the origin
+        for item, item_points in pending.items():
+            points[item, :, :item_points.shape[1]] = item_points
+        try:
+            values = self.query_func(points)
+            for item, item_points in pending.items():
+                self.results[item] = values[item, :item_points.shape[1]]
+        except Exception as e:
+            self.error = e
+        self.condition.notify_all()
+
+
+def estimate_bytes_per_point(mlp_dim, res_layers=[], merge_layer=0, num_feature_maps=1, bytes_per_value=4):
+    '''
+    Rough peak memory of one query point, from the layout of the MLP (see lib/model/MLP.py)
+    :param mlp_dim: channel widths of the MLP, e.g. opt.mlp_dim_low_res
+    :param res_layers: layers that take the input features concatenated to their input
+    :param merge_layer: layer whose activations are kept as phi (0 for the default)
+    :param num_feature_maps: number of feature maps the point is classified against (one MLP pass each)
+    :return: bytes
+    '''
+    merge_layer = merge_layer if merge_layer > 0 else len(mlp_dim) // 2
+    # widest step: the input of the layer (plus the copy made by the concatenation) and its output
+    widest = 0
+    for l in range(len(mlp_dim) - 1):
+        width_in = mlp_dim[l] + mlp_dim[0] if l in res_layers else mlp_dim[l]
+        widest = max(widest, mlp_dim[l] + width_in + mlp_dim[l + 1])
+    # the sampled features and their concatenation stay alive during the pass, the predictions of every map are kept
+    values = 2 * mlp_dim[0] + widest + mlp_dim[min(merge_layer + 1, len(mlp_dim) - 1)] + num_feature_maps * mlp_dim[-1]
+    return values * bytes_per_value + 64 # point coordinates, projection and masks
+
+
+def is_out_of_memory(e):
+    return isinstance(e, MemoryError) or (isinstance(e, RuntimeError) and 'out of memory' in str(e))
+
+
+class ChunkSizer(object):
+    '''
+    Picks how many points to query at once from a memory budget, and adapts it while the grid is evaluated.
+    wrap(eval_func) returns an eval_func that accepts chunks of any length and splits them into sub-chunks
+    of the current size. After an allocation failure the size is halved and the sub-chunk retried;
+    after a run of successful sub-chunks it grows back towards the budget.
+    When measure_func is given (e.g. torch.cuda.max_memory_allocated), the per-point estimate is replaced
+    by the measured peak of the first sub-chunks.
+    '''
+
+    def __init__(self, memory_budget, bytes_per_point, min_samples=1024, max_samples=2 ** 22,
+                 grow_after=8, measure_func=None, reset_func=None):
+        self.memory_budget = memory_budget
+        self.bytes_per_point = bytes_per_point
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.grow_after = grow_after
+        self.measure_func = measure_func
+        self.reset_func = reset_func
+        self.limit = self._budget_samples()
+        self.num_samples = self.limit
+        self.num_measured = 0
+        self.num_successes = 0
+        self.chunk_sizes = [self.num_samples] # every size that was chosen, in order
+        self.lock = threading.Lock()
+
+    def _budget_samples(self):
+        num_samples = int(self.memory_budget // self.bytes_per_point)
+        return int(min(max(num_samples, self.min_samples), self.max_samples))
+
+    def _set_num_samples(self, num_samples):
+        num_samples = int(min(max(num_samples, self.min_samples), self.limit))
+        if num_samples != self.num_samples:
+            self.num_samples = num_samples
+            self.chunk_sizes.append(num_samples)
+
+    def backoff(self):
+        with self.lock:
+            if self.num_samples <= self.min_samples:
+                return False
+            # do not grow past the failing size again
+            self.limit = max(self.num_samples // 2, self.min_samples)
+            self._set_num_samples(self.num_samples // 2)
+            self.num_successes = 0
+            return True
+
+    def success(self, num_pts, peak_bytes=None):
+        with self.lock:
+            if peak_bytes is not None and self.num_measured < 2 and num_pts >= self.min_samples:
+                self.num_measured += 1
+                self.bytes_per_point = max(peak_bytes / num_pts, 1)
+                self.limit = self._budget_samples()
+                self._set_num_samples(self.limit)
+                return
+            self.num_successes += 1
+            if self.num_successes >= self.grow_after and self.num_samples < self.limit:
+                self.num_successes = 0
+                self._set_num_samples(self.num_samples * 2)
+
+    def wrap(self, eval_func):
+        def chunked_eval_func(points):
+            # a batch of B point sets costs B times as much per point
+            num_items = points.shape[0] if points.ndim == 3 else 1
+            num_pts = points.shape[-1]
+            values = []
+            start = 0
+            while start < num_pts:
+                stop = min(start + max(self.num_samples // num_items, 1), num_pts)
+                try:
+                    if self.reset_func is not None:
+                        self.reset_func()
+                    values.append(eval_func(points[..., start:stop]))
+                except Exception as e:
+                    if not is_out_of_memory(e) or not self.backoff():
+                        raise
+                    continue
+                peak_bytes = self.measure_func() if self.measure_func is not None else None
+                self.success((stop - start) * num_items, peak_bytes)
+                start = stop
+            if len(values) == 1:
+                return values[0]
+            if torch.is_tensor(values[0]):
+                return torch.cat(values, -1)
+            return np.concatenate(values, -1)
+        return chunked_eval_func
+
+    def report(self):
+        return 'chunk sizes: {0} (budget {1:.1f} MB, {2:.0f} bytes per point)'.format(
+            ' -> '.join(str(n) for n in self.chunk_sizes), self.memory_budget / 2 ** 20, self.bytes_per_point)
+
+
+def eval_grid(coords, eval_func, num_samples=512 * 512 * 512, dtype=np.float32):
     resolution = coords.shape[1:4]
+    if isinstance(coords, GridCoords):
+        num_pts = int(np.prod(resolution))
+        sdf = np.zeros(num_pts, dtype=dtype)
+        for i in range(0, num_pts, num_samples):
+            sdf[i:i + num_samples] = quantize_occupancy(eval_func(coords.points_in_range(i, min(i + num_samples, num_pts))), dtype)
+        return sdf.reshape(resolution)
     coords = coords.reshape([3, -1])
-    sdf = batch_eval(coords, eval_func, num_samples=num_samples)
+    sdf = batch_eval(coords, eval_func, num_samples=num_samples, dtype=dtype)
     return sdf.reshape(resolution)
 
 
 
+def fill_homogeneous_cells(sdf, notprocessed, skip_grid, v, reso):
+    '''
+    Fill every homogeneous cell, boundary samples included, with its interpolated value
+    :param sdf: [X, Y, Z] volume, modified in place
+    :param notprocessed: [X, Y, Z] mask of samples still to be evaluated, cleared in place for the filled samples
+    :param skip_grid: [nx, ny, nz] mask of the homogeneous cells
+    :param v: [nx, ny, nz] value of each cell
+    :param reso: cell size in samples
+    '''
+    n_x, n_y, n_z = skip_grid.shape
+    mask = skip_grid.reshape(n_x, 1, n_y, 1, n_z, 1)
+    v = v.reshape(n_x, 1, n_y, 1, n_z, 1)
+
+    # cell c covers [c*reso, (c+1)*reso] on each axis: the half-open run [c*reso, (c+1)*reso) plus the closing
+    # sample (c+1)*reso, which it shares with cell c+1. Painting the 8 run/closing combinations from the one
+    # owned by the lowest cell index to the highest keeps the shared samples of the later cell, as a loop over
+    # np.where(skip_grid) would
+    for closing in itertools.product([True, False], repeat=3):
+        slices = []
+        shape = []
+        for n, is_closing in zip([n_x, n_y, n_z], closing):
+            if is_closing:
+                slices.append(slice(reso, (n + 1) * reso, reso))
+                shape += [n, 1]
+            else:
+                slices.append(slice(0, n * reso))
+                shape += [n, reso]
+        # splitting axes never copies, so these reshapes are views into sdf / notprocessed
+        np.copyto(sdf[tuple(slices)].reshape(shape), v, where=mask)
+        np.copyto(notprocessed[tuple(slices)].reshape(shape), False, where=mask)
+
+
 def eval_grid_octree(coords, eval_func,
                      init_resolution=64, threshold=0.05,
-                     num_samples=512 * 512 * 512):
+                     num_samples=512 * 512 * 512, dtype=np.float32):
     resolution = coords.shape[1:4]  # 'coords' has shape of (3, 256, 256, 256)
 
-    sdf = np.zeros(resolution)  # Shape of (256, 256, 256)
+    sdf = np.zeros(resolution, dtype=dtype)  # Shape of (256, 256, 256)
+    scale = occupancy_scale(dtype)
 
-    notprocessed = np.zeros(resolution, dtype=np.bool) # Shape of (256, 256, 256)
+    notprocessed = np.zeros(resolution, dtype=bool) # Shape of (256, 256, 256)
     notprocessed[:-1,:-1,:-1] = True  # all except the last elements to be True
-    grid_mask = np.zeros(resolution, dtype=np.bool) # Shape of (256, 256, 256)
+    grid_mask = np.zeros(resolution, dtype=bool) # Shape of (256, 256, 256)
 
     reso = resolution[0] // init_resolution # equal to 256/64 = 4
 
@@ -102,19 +519,15 @@ def eval_grid_octree(coords, eval_func,
         # test samples in this iteration
         test_mask = np.logical_and(grid_mask, notprocessed)
         # print('step size:', reso, 'test sample size:', test_mask.sum())
-        points = coords[:, test_mask]
+        test_index = np.flatnonzero(test_mask)
 
-        sdf[test_mask] = batch_eval(points, eval_func, num_samples=num_samples)
-        notprocessed[test_mask] = False
+        sdf.reshape(-1)[test_index] = batch_eval_grid(coords, test_index, eval_func, num_samples=num_samples, dtype=dtype)
+        notprocessed.reshape(-1)[test_index] = False
 
         # do interpolation
         if reso <= 1:
             break
-        x_grid = np.arange(0, resolution[0], reso)
-        y_grid = np.arange(0, resolution[1], reso)
-        z_grid = np.arange(0, resolution[2], reso)
-
-        v = sdf[tuple(np.meshgrid(x_grid, y_grid, z_grid, indexing='ij'))]
+        v = sdf[0:resolution[0]:reso, 0:resolution[1]:reso, 0:resolution[2]:reso]
 
         v0 = v[:-1,:-1,:-1]
         v1 = v[:-1,:-1,1:]
@@ -125,27 +538,17 @@ def eval_grid_octree(coords, eval_func,
         v6 = v[1:,1:,:-1]
         v7 = v[1:,1:,1:]
 
-        x_grid = x_grid[:-1] + reso//2
-        y_grid = y_grid[:-1] + reso//2
-        z_grid = z_grid[:-1] + reso//2
-
-        nonprocessed_grid = notprocessed[tuple(np.meshgrid(x_grid, y_grid, z_grid, indexing='ij'))]
+        nonprocessed_grid = notprocessed[reso//2:resolution[0]:reso, reso//2:resolution[1]:reso, reso//2:resolution[2]:reso]
+        nonprocessed_grid = nonprocessed_grid[:v0.shape[0], :v0.shape[1], :v0.shape[2]]
 
         v = np.stack([v0,v1,v2,v3,v4,v5,v6,v7], 0)
-        v_min = v.min(0)
-        v_max = v.max(0)
-        v = 0.5*(v_min+v_max)
+        v_min = v.min(0).astype(np.float32) / scale
+        v_max = v.max(0).astype(np.float32) / scale
+        v = quantize_occupancy(0.5*(v_min+v_max), dtype)
 
         skip_grid = np.logical_and(((v_max - v_min) < threshold), nonprocessed_grid)
 
-        n_x = resolution[0] // reso
-        n_y = resolution[1] // reso
-        n_z = resolution[2] // reso
-
-        xs, ys, zs = np.where(skip_grid)
-        for x, y, z in zip(xs*reso, ys*reso, zs*reso):
-            sdf[x:(x+reso+1), y:(y+reso+1), z:(z+reso+1)] = v[x//reso,y//reso,z//reso]
-            notprocessed[x:(x+reso+1), y:(y+reso+1), z:(z+reso+1)] = False
+        fill_homogeneous_cells(sdf, notprocessed, skip_grid, v, reso)
         reso //= 2
 
     return sdf.reshape(resolution)
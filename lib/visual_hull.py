@@ -0,0 +1,232 @@
+import numpy as np
+import torch
+
+
+class VisualHull(object):
+    '''
+    Silhouette of one orthographic view, used to skip grid points that project outside the mask.
+    With orthogonal projection every point of a column (a line along the view direction) lands on the same
+    pixel, so the dilated mask is the occupied-column mask of the grid: a point outside it is empty.
+    '''
+
+    def __init__(self, calib, mask, dilation=1):
+        '''
+        :param calib: [4, 4] (or [1, 4, 4]) calibration matrix of the view
+        :param mask: [H, W] (or [1, H, W]) silhouette, nonzero inside
+        :param dilation: pixels added around the silhouette. One pixel covers the bilinear footprint of
+            index(), so every point whose sampled mask value is nonzero is kept
+        '''
+        calib = np.asarray(calib, dtype=np.float64).reshape(-1, 4)
+        self.proj = calib[:2, :3]
+        self.offset = calib[:2, 3:4]
+        mask = np.asarray(mask).reshape(np.asarray(mask).shape[-2:]) > 0
+        self.size = np.array([mask.shape[1], mask.shape[0]]).reshape(2, 1) # (W, H)
+        self.column_mask = dilate_mask(mask, dilation)
+        self.column_mask_tensors = {}
+        self.num_queried = 0
+        self.num_culled = 0
+
+    def pixels(self, points):
+        # image coordinates are in [-1, 1] with the pixel centers at the ends (grid_sample with align_corners=True)
+        uv = np.matmul(self.proj, points) + self.offset
+        return (uv + 1) * 0.5 * (self.size - 1)
+
+    def contains(self, points):
+        '''
+        :param points: [3, N] points
+        :return: [N] bool, False for the points that project outside the dilated silhouette
+        '''
+        pix = np.round(self.pixels(points))
+        inside = np.all((pix >= 0) & (pix <= self.size - 1), axis=0)
+        inside[inside] = self.column_mask[pix[1, inside].astype(np.int64), pix[0, inside].astype(np.int64)]
+        return inside
+
+    def contains_tensor(self, points):
+        '''
+        Same as contains, for a [3, N] tensor. The test runs on the device of points
+        '''
+        device = points.device
+        if device not in self.column_mask_tensors:
+            self.column_mask_tensors[device] = torch.from_numpy(self.column_mask).to(device)
+        column_mask = self.column_mask_tensors[device]
+        proj = torch.as_tensor(self.proj, dtype=points.dtype, device=device)
+        offset = torch.as_tensor(self.offset, dtype=points.dtype, device=device)
+        size = torch.as_tensor(self.size, dtype=points.dtype, device=device)
+        pix = torch.round((torch.addmm(offset, proj, points) + 1) * 0.5 * (size - 1))
+        inside = ((pix >= 0) & (pix <= size - 1)).all(0)
+        pix = pix.long()
+        inside[inside.clone()] = column_mask[pix[1, inside], pix[0, inside]]
+        return inside
+
+    def bounds(self, b_min, b_max, padding=0.0):
+        '''
+        Tighten a bounding box to the part that projects inside the silhouette.
+        The extent along the view direction comes from the box itself, since a single view does not bound it.
+        :param padding: margin added around the tightened box (without leaving the original box), so the
+            surface does not touch the last planes of the grid
+        :return: b_min, b_max
+        '''
+        b_min = np.asarray(b_min, dtype=np.float64)
+        b_max = np.asarray(b_max, dtype=np.float64)
+        ys, xs = np.nonzero(self.column_mask)
+        if len(xs) == 0:
+            return b_min, b_max
+
+        # lines through the corners of the silhouette pixels, along the view direction
+        corners = [np.stack([xs + dx, ys + dy], 0) for dx in [-0.5, 0.5] for dy in [-0.5, 0.5]]
+        uv = np.concatenate(corners, 1) / (self.size - 1) * 2 - 1
+        origins = np.matmul(np.linalg.pinv(self.proj), uv - self.offset) # [3, N]
+        direction = np.cross(self.proj[0], self.proj[1])
+        direction = direction / np.linalg.norm(direction)
+
+        # clip every line to the box (slab test)
+        s_enter = np.full(origins.shape[1], -np.inf)
+        s_exit = np.full(origins.shape[1], np.inf)
+        for axis in range(3):
+            if abs(direction[axis]) < 1e-12:
+                outside = (origins[axis] < b_min[axis]) | (origins[axis] > b_max[axis])
+                s_exit[outside] = -np.inf
+                continue
+            s0 = (b_min[axis] - origins[axis]) / direction[axis]
+            s1 = (b_max[axis] - origins[axis]) / direction[axis]
+            s_enter = np.maximum(s_enter, np.minimum(s0, s1))
+            s_exit = np.minimum(s_exit, np.maximum(s0, s1))
+        hit = s_enter <= s_exit
+        ends = [origins[:, hit] + s[hit] * direction.reshape(3, 1) for s in [s_enter, s_exit]]
+
+        # box corners that project inside the silhouette bound the hull where it leaves the box
+        box_corners = np.array([[x, y, z] for x in [b_min[0], b_max[0]] for y in [b_min[1], b_max[1]] for z in [b_min[2], b_max[2]]]).T
+        ends.append(box_corners[:, self.contains(box_corners)])
+
+        points = np.concatenate(ends, 1)
+        if points.shape[1] == 0:
+            return b_min, b_max
+        return np.maximum(points.min(1) - padding, b_min), np.minimum(points.max(1) + padding, b_max)
+
+    def wrap(self, eval_func):
+        '''
+        :param eval_func: function that maps [3, N] points (numpy or tensor) to [N] values
+        :return: eval_func that only queries the points inside the silhouette and returns 0 for the others
+        '''
+        def culled_eval_func(points):
+            if torch.is_tensor(points):
+                inside = self.contains_tensor(points)
+                values = torch.zeros(points.shape[1], dtype=torch.float32, device=points.device)
+            else:
+                inside = self.contains(points)
+                values = np.zeros(points.shape[1], dtype=np.float32)
+            num_inside = int(inside.sum())
+            self.num_queried += num_inside
+            self.num_culled += points.shape[1] - num_inside
+            if num_inside > 0:
+                values[inside] = eval_func(points[:, inside])
+            return values
+        return culled_eval_func
+
+    def report(self):
+        num_points = self.num_queried + self.num_culled
+        return 'visual hull: {0} of {1} points culled ({2:.1%})'.format(self.num_culled, num_points, self.num_culled / max(num_points, 1))
+
+
+class DepthInterval(VisualHull):
+    '''
+    Per-pixel z-interval of one orthographic view, from a front depth map and an optional back bound.
+    Points in front of the interval are outside; only the points inside it are queried.
+    Depth maps are normalized as in TrainDataset: the camera looks along -z from 10 units away, which gives
+    depth_map = 1 - z in image space, and 0 for the background.
+    '''
+
+    def __init__(self, calib, front_depth, back_depth=None, margin=0.0, dilation=1):
+        '''
+        :param calib: [4, 4] (or [1, 4, 4]) calibration matrix of the view
+        :param front_depth: [H, W] (or [1, H, W]) depth map of the visible surface, 0 where there is no subject
+        :param back_depth: [H, W] depth map of the far side of the subject. Without it the interval extends to the back of the grid
+        :param margin: slack added on both ends of the interval, in image space z units
+        :param dilation: pixels over which the bounds are widened, as the silhouette of VisualHull
+        '''
+        front_depth = np.asarray(front_depth, dtype=np.float32)
+        front_depth = front_depth.reshape(front_depth.shape[-2:])
+        super(DepthInterval, self).__init__(calib, front_depth > 0, dilation=dilation)
+        calib = np.asarray(calib, dtype=np.float64).reshape(-1, 4)
+        self.proj_z = calib[2:3, :3]
+        self.offset_z = calib[2:3, 3:4]
+
+        valid = front_depth > 0
+        # a column is bounded by the loosest bound among the pixels that index() may blend into it
+        self.z_front = extreme_filter(np.where(valid, 1 - front_depth, -np.inf), dilation, np.maximum) + margin
+        if back_depth is None:
+            self.z_back = np.full(front_depth.shape, -np.inf, dtype=np.float32)
+        else:
+            back_depth = np.asarray(back_depth, dtype=np.float32).reshape(front_depth.shape)
+            self.z_back = -extreme_filter(np.where(back_depth > 0, back_depth - 1, -np.inf), dilation, np.maximum) - margin
+        self.bound_tensors = {}
+        self.num_in_front = 0
+
+    def contains(self, points):
+        '''
+        :param points: [3, N] points
+        :return: [N] bool, True for the points inside the z-interval of their column
+        '''
+        pix = np.round(self.pixels(points))
+        inside = np.all((pix >= 0) & (pix <= self.size - 1), axis=0)
+        rows = pix[1, inside].astype(np.int64)
+        cols = pix[0, inside].astype(np.int64)
+        z = (np.matmul(self.proj_z, points[:, inside]) + self.offset_z)[0]
+        in_front = z > self.z_front[rows, cols]
+        self.num_in_front += int(in_front.sum())
+        inside[inside] = ~in_front & (z >= self.z_back[rows, cols])
+        return inside
+
+    def contains_tensor(self, points):
+        '''
+        Same as contains, for a [3, N] tensor. The test runs on the device of points
+        '''
+        device = points.device
+        if device not in self.bound_tensors:
+            self.bound_tensors[device] = (torch.from_numpy(self.z_front).to(device), torch.from_numpy(self.z_back).to(device))
+        z_front, z_back = self.bound_tensors[device]
+        proj = torch.as_tensor(np.concatenate([self.proj, self.proj_z], 0), dtype=points.dtype, device=device)
+        offset = torch.as_tensor(np.concatenate([self.offset, self.offset_z], 0), dtype=points.dtype, device=device)
+        size = torch.as_tensor(self.size, dtype=points.dtype, device=device)
+        xyz = torch.addmm(offset, proj, points)
+        pix = torch.round((xyz[:2] + 1) * 0.5 * (size - 1))
+        inside = ((pix >= 0) & (pix <= size - 1)).all(0)
+        pix = pix.long()
+        rows = pix[1, inside]
+        cols = pix[0, inside]
+        z = xyz[2, inside]
+        in_front = z > z_front[rows, cols]
+        self.num_in_front += int(in_front.sum())
+        inside[inside.clone()] = ~in_front & (z >= z_back[rows, cols])
+        return inside
+
+    def report(self):
+        num_points = self.num_queried + self.num_culled
+        return 'depth interval: {0} of {1} points culled ({2:.1%}), {3} of them in front of the interval'.format(
+            self.num_culled, num_points, self.num_culled / max(num_points, 1), self.num_in_front)
+
+
+def extreme_filter(image, dilation, op=np.maximum):
+    '''
+    Running maximum (or minimum with op=np.minimum) of a [H, W] image over a (2 * dilation + 1) square
+    '''
+    result = image.copy()
+    height, width = image.shape
+    padded = np.pad(image, dilation, mode='edge')
+    for dy in range(-dilation, dilation + 1):
+        for dx in range(-dilation, dilation + 1):
+            result = op(result, padded[dilation + dy:dilation + dy + height, dilation + dx:dilation + dx + width])
+    return result.astype(np.float32)
+
+
+def dilate_mask(mask, dilation=1):
+    '''
+    Binary dilation of a [H, W] mask with a (2 * dilation + 1) square
+    '''
+    dilated = mask.copy()
+    height, width = mask.shape
+    padded = np.pad(mask, dilation)
+    for dy in range(-dilation, dilation + 1):
+        for dx in range(-dilation, dilation + 1):
+            dilated |= padded[dilation + dy:dilation + dy + height, dilation + dx:dilation + dx + width]
+    return dilated
@@ -15,6 +15,7 @@ use_gpu = True
 
 curpath = os.path.abspath(os.path.dirname("."))
 sys.path.insert(0,curpath)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository root, for lib.mesh_io
 
 argv = sys.argv 
 argv = argv[argv.index("--") + 1:]
@@ -45,102 +46,8 @@ if not os.path.exists( save_folder_path ):
 	os.makedirs(save_folder_path)
 
 
-def load_obj_mesh(mesh_file, with_normal=False, with_texture=False):
-    vertex_data = []
-    norm_data = []
-    uv_data = []
-
-    face_data = []
-    face_norm_data = []
-    face_uv_data = []
-
-    if isinstance(mesh_file, str):
-        f = open(mesh_file, "r")
-    else:
-        f = mesh_file
-    for line in f:
-        if isinstance(line, bytes):
-            line = line.decode("utf-8")
-        if line.startswith('#'):
-            continue
-        values = line.split()
-        if not values:
-            continue
-
-        if values[0] == 'v':
-            v = list(map(float, values[1:4]))
-            vertex_data.append(v)
-        elif values[0] == 'vn':
-            vn = list(map(float, values[1:4]))
-            norm_data.append(vn)
-        elif values[0] == 'vt':
-            vt = list(map(float, values[1:3]))
-            uv_data.append(vt)
-
-        elif values[0] == 'f':
-            # quad mesh
-            if len(values) > 4:
-                f = list(map(lambda x: int(x.split('/')[0]), values[1:4]))
-                face_data.append(f)
-                f = list(map(lambda x: int(x.split('/')[0]), [values[3], values[4], values[1]]))
-                face_data.append(f)
-            # tri mesh
-            else:
-                f = list(map(lambda x: int(x.split('/')[0]), values[1:4]))
-                face_data.append(f)
-            
-            # deal with texture
-            if len(values[1].split('/')) >= 2:
-                # quad mesh
-                if len(values) > 4:
-                    f = list(map(lambda x: int(x.split('/')[1]), values[1:4]))
-                    face_uv_data.append(f)
-                    f = list(map(lambda x: int(x.split('/')[1]), [values[3], values[4], values[1]]))
-                    face_uv_data.append(f)
-                # tri mesh
-                elif len(values[1].split('/')[1]) != 0:
-                    f = list(map(lambda x: int(x.split('/')[1]), values[1:4]))
-                    face_uv_data.append(f)
-            # deal with normal
-            if len(values[1].split('/')) == 3:
-                # quad mesh
-                if len(values) > 4:
-                    f = list(map(lambda x: int(x.split('/')[2]), values[1:4]))
-                    face_norm_data.append(f)
-                    f = list(map(lambda x: int(x.split('/')[2]), [values[3], values[4], values[1]]))
-                    face_norm_data.append(f)
-                # tri mesh
-                elif len(values[1].split('/')[2]) != 0:
-                    f = list(map(lambda x: int(x.split('/')[2]), values[1:4]))
-                    face_norm_data.append(f)
-
-    vertices = np.array(vertex_data)
-    faces = np.array(face_data) - 1
-
-    # if with_texture and with_normal:
-    #     uvs = np.array(uv_data)
-    #     face_uvs = np.array(face_uv_data) - 1
-    #     norms = np.array(norm_data)
-    #     if norms.shape[0] == 0:
-    #         norms = compute_normal(vertices, faces)
-    #         face_normals = faces
-    #     else:
-    #         norms = normalize_v3(norms)
-    #         face_normals = np.array(face_norm_data) - 1
-    #     return vertices, faces, norms, face_normals, uvs, face_uvs
-
-    # if with_texture:
-    #     uvs = np.array(uv_data)
-    #     face_uvs = np.array(face_uv_data) - 1
-    #     return vertices, faces, uvs, face_uvs
-
-    # if with_normal:
-    #     norms = np.array(norm_data)
-    #     norms = normalize_v3(norms)
-    #     face_normals = np.array(face_norm_data) - 1
-    #     return vertices, faces, norms, face_normals
-
-    return vertices, faces
+# vectorized OBJ parser with a side-car cache, shared with training and evaluation (run from the repository root)
+from lib.mesh_io import load_obj_mesh
 
 
 def make_rotate(rx, ry, rz):